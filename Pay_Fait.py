@@ -1,6 +1,9 @@
-import httpx
-import asyncio
-from db import check_token_in_db, write_token_to_db, add_user, check_user_in_db
+import os
+import time
+
+import http_client
+from db import async_get_user_profile, async_write_token_to_db, async_add_user
+from single_flight import SingleFlight
 
 # Базовые настройки для запросов
 base_url = 'https://pay.fait.gl/'
@@ -10,34 +13,83 @@ save_order_endpoint = '/api/v2/licenseSale/saveOrder'
 user_payment_page_endpoint = '/api/v2/licenseSale/userPaymentPage'
 get_users_with_goods_endpoint = '/api/v2/licenseSale/getUsersWithGoods'
 
+# Сколько секунд доверяем результату проверки подписки
+ENTITLEMENT_TTL = float(os.getenv('ENTITLEMENT_TTL', '60'))
+
+entitlement_cache = {}
+goods_checks = SingleFlight("pay_fait")
 
-def auth(auth_data):
-    response = httpx.post(base_url + auth_endpoint, json=auth_data)
+
+async def auth(auth_data):
+    response = await http_client.request('pay_fait', 'POST', base_url + auth_endpoint, idempotent=True, json=auth_data)
     token = response.json().get('token')
     headers = {'auth-token': token}
     return headers
 
 
 async def auth_and_check_goods(user_id, email, password):
+    """
+    Returns the user's goods from Pay Fait.
+
+    Results are cached for ENTITLEMENT_TTL seconds, and concurrent checks for the same user
+    share a single upstream request.
+    """
+    cached = entitlement_cache.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    return await goods_checks.run(user_id, _fetch_goods, user_id, email, password)
+
+
+def goods_of(response):
+    """
+    Returns the goods list from a getOwnGoods response, or None when Pay Fait answered with an error,
+    which comes as {"error": ...} instead of goods.
+    """
+    if not isinstance(response, dict):
+        return None
+    return (response.get('data') or {}).get('goods')
+
+
+def invalidate_entitlement(user_id):
+    entitlement_cache.pop(user_id, None)
+
+
+async def _fetch_goods(user_id, email, password):
     auth_data = {
         'userName': email,
         'userPassword': password
     }
-    token = check_token_in_db(user_id)
+    profile = await async_get_user_profile(user_id)
+    token = profile.token if profile else None
+
+    if profile is None:
+        await async_add_user(user_id, email)
 
     if not token:
-        headers = auth(auth_data)
-        token = headers.get('auth-token')
-        write_token_to_db(user_id, token)
+        headers = await _refresh_token(user_id, auth_data)
     else:
         headers = {'auth-token': token}
 
-    user_exists = check_user_in_db(user_id)
-
-    if not user_exists:
-        add_user(user_id, email)
+    # getOwnGoods only reads, so it is retried like a GET.
+    response = await http_client.request('pay_fait', 'POST', base_url + get_own_goods_endpoint, idempotent=True,
+                                         headers=headers)
+    if response.status_code == 401:
+        # Токен истёк или отозван — получаем новый и повторяем запрос один раз
+        headers = await _refresh_token(user_id, auth_data)
+        response = await http_client.request('pay_fait', 'POST', base_url + get_own_goods_endpoint, idempotent=True,
+                                             headers=headers)
 
-    response = httpx.post(base_url + get_own_goods_endpoint, headers=headers)
-    return response.json()
+    try:
+        result = response.json()
+    except ValueError:
+        result = {'error': response.text[:200]}
+    if response.is_success:
+        entitlement_cache[user_id] = (time.monotonic() + ENTITLEMENT_TTL, result)
+    return result
 
 
+async def _refresh_token(user_id, auth_data):
+    headers = await auth(auth_data)
+    await async_write_token_to_db(user_id, headers.get('auth-token'))
+    return headers
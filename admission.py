@@ -0,0 +1,100 @@
+import logging
+import os
+import statistics
+from collections import deque, namedtuple
+
+import metering
+import metrics
+import transcoder
+from asr_router import router
+from custom_exceptions import ASRException, MediaRejectedException
+
+logger = logging.getLogger(__name__)
+
+# The cloud Bot API refuses to hand out files larger than 20 MB; a local Bot API server takes up to 2 GB.
+CLOUD_MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+LOCAL_MAX_DOWNLOAD_BYTES = 2000 * 1024 * 1024
+MAX_MEDIA_SECONDS = float(os.getenv("MAX_MEDIA_SECONDS", str(4 * 3600)))
+# Estimates use the observed throughput once this many jobs have finished, the backends' latency model before.
+HISTORY_SIZE = int(os.getenv("ETA_HISTORY_SIZE", "50"))
+HISTORY_MIN_JOBS = 5
+
+Admission = namedtuple("Admission", ["seconds", "size", "backend", "eta"])
+
+
+class ThroughputHistory:
+    """
+    Recent finished jobs as (seconds of audio, seconds it took), to predict how long the next ones take.
+    """
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.jobs = deque(maxlen=size)
+
+    def record(self, audio_seconds, elapsed):
+        self.jobs.append((audio_seconds or 0.0, elapsed))
+
+    def processing_seconds(self, audio_seconds, backend=None):
+        if len(self.jobs) < HISTORY_MIN_JOBS:
+            if backend is None:
+                return None
+            return backend.prior_latency(audio_seconds) * backend.stats.percentile(0.5)
+        audio_total = sum(audio for audio, _ in self.jobs)
+        elapsed_total = sum(elapsed for _, elapsed in self.jobs)
+        # Short jobs are dominated by fixed costs, so the shortest time seen is a floor.
+        floor = min(elapsed for _, elapsed in self.jobs)
+        return max(floor, elapsed_total / audio_total * audio_seconds) if audio_total else floor
+
+    def job_seconds(self):
+        if not self.jobs:
+            return None
+        return statistics.median(elapsed for _, elapsed in self.jobs)
+
+
+history = ThroughputHistory()
+
+
+def download_limit(bot):
+    return LOCAL_MAX_DOWNLOAD_BYTES if bot.session.api.is_local else CLOUD_MAX_DOWNLOAD_BYTES
+
+
+async def admit(bot, media):
+    """
+    Decides whether to take the media from its Telegram metadata, before any of it is downloaded.
+    Documents without a duration get it from their container header, or an estimate from their size.
+
+    :return: The Admission with the duration, size, the backend the router would pick and the expected
+        processing time in seconds, None when there is nothing to base it on yet.
+    :raises MediaRejectedException: If the file is too big to download or the recording too long.
+    """
+    size = getattr(media, "file_size", None)
+    limit = download_limit(bot)
+    if size is not None and size > limit:
+        metrics.admissions_total.inc(decision="too_big")
+        raise MediaRejectedException(f"File {media.file_unique_id} has {size} bytes", "too_big", limit)
+
+    seconds = await metering.probe_seconds(bot, media)
+    if seconds > MAX_MEDIA_SECONDS:
+        metrics.admissions_total.inc(decision="too_long")
+        raise MediaRejectedException(f"File {media.file_unique_id} lasts {seconds:.0f} s", "too_long",
+                                     MAX_MEDIA_SECONDS)
+
+    encoding = transcoder.native_encoding(media) or transcoder.TARGET_ENCODING
+    try:
+        backend = router.choose(encoding, seconds)[0]
+    except ASRException as e:
+        # Long recordings are split into parts that some backend takes; the router decides per part.
+        logger.debug(e)
+        backend = None
+    metrics.admissions_total.inc(decision="accepted")
+    return Admission(seconds, size, backend, history.processing_seconds(seconds, backend))
+
+
+def queue_seconds(position, free_workers, workers):
+    """
+    Returns how long a job at the given place in the queue waits for a worker, None without history.
+    """
+    ahead = position - free_workers
+    if ahead <= 0:
+        return 0.0
+    job_seconds = history.job_seconds()
+    return None if job_seconds is None else ahead / max(workers, 1) * job_seconds
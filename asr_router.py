@@ -0,0 +1,257 @@
+import logging
+import os
+import time
+from collections import deque
+
+import aiofiles
+
+import jobs
+import metrics
+import object_storage
+import openai_requests
+import transcoder
+import yandex_requests
+from custom_exceptions import ASRException
+
+logger = logging.getLogger(__name__)
+
+# Weight of one unit of cost (per minute of audio) against one second of expected latency.
+COST_WEIGHT = float(os.getenv("ASR_COST_WEIGHT", "1.0"))
+STATS_WINDOW = 100
+ERROR_RATE_DECAY = 0.2
+# After this many failures in a row a backend is skipped for COOLDOWN_SECONDS unless nothing else can take the job.
+MAX_CONSECUTIVE_FAILURES = 3
+COOLDOWN_SECONDS = 60.0
+
+
+class AudioSource:
+    """
+    Audio to be recognised, held as a file, as bytes in memory or as an object in storage.
+    Backends take whichever form they need; the others are produced on demand.
+    """
+
+    def __init__(self, encoding, seconds=None, path=None, content=None, key=None, size=None):
+        self.encoding = encoding
+        self.seconds = seconds
+        self.path = path
+        self.content = content
+        self.key = key
+        self.size = size if size is not None else len(content) if content is not None else \
+            os.path.getsize(path) if path else None
+
+    @property
+    def suffix(self):
+        return transcoder.ENCODING_SUFFIXES.get(self.encoding, '')
+
+    async def get_content(self):
+        if self.content is None:
+            if self.path:
+                async with aiofiles.open(self.path, 'rb') as file:
+                    self.content = await file.read()
+            else:
+                self.content = await object_storage.download(self.key)
+        return self.content
+
+    async def get_key(self):
+        if self.key is None:
+            if self.path:
+                self.key = await object_storage.upload_file(self.path, self.suffix)
+            else:
+                self.key = await object_storage.upload_bytes(self.content, self.suffix)
+            await jobs.advance(jobs.UPLOADED)
+        return self.key
+
+    async def release(self):
+        """
+        Releases the object the source was given or uploaded, deleting it from storage.
+        """
+        if self.key is not None:
+            await object_storage.release(self.key)
+            self.key = None
+
+
+class BackendStats:
+    """
+    Observed behaviour of a backend. Latency is kept as the slowdown against the backend's prior
+    estimate, so short and long recordings can share one distribution.
+    """
+
+    def __init__(self):
+        self.slowdowns = deque(maxlen=STATS_WINDOW)
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def record_success(self, slowdown):
+        self.slowdowns.append(slowdown)
+        self.error_rate *= 1 - ERROR_RATE_DECAY
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.error_rate = self.error_rate * (1 - ERROR_RATE_DECAY) + ERROR_RATE_DECAY
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+            self.cooldown_until = time.monotonic() + COOLDOWN_SECONDS
+
+    def percentile(self, q):
+        if not self.slowdowns:
+            return 1.0
+        ordered = sorted(self.slowdowns)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    @property
+    def cooling_down(self):
+        return time.monotonic() < self.cooldown_until
+
+
+class ASRBackend:
+    """
+    Base class of speech recognition backends.
+
+    Subclasses set their limits and prior latency model (fixed overhead plus seconds per second of audio)
+    and implement `recognize`, which returns the transcript as a list of transcript.Segment.
+    """
+    name = None
+    encodings = None
+    max_bytes = None
+    max_seconds = None
+    overhead = 1.0
+    realtime_factor = 0.2
+    cost_per_minute = 0.0
+    # True when the backend reads the audio from object storage rather than from the request body.
+    needs_object = False
+
+    def __init__(self):
+        self.stats = BackendStats()
+        self.cost_per_minute = float(os.getenv(f"ASR_COST_{self.name.upper()}", str(self.cost_per_minute)))
+
+    @property
+    def enabled(self):
+        return True
+
+    def accepts(self, encoding, seconds, size):
+        if self.encodings is not None and encoding not in self.encodings:
+            return False
+        if self.max_bytes is not None and size is not None and size > self.max_bytes:
+            return False
+        if self.max_seconds is not None and (seconds is None or seconds > self.max_seconds):
+            return False
+        return True
+
+    def prior_latency(self, seconds):
+        return self.overhead + self.realtime_factor * (seconds or 60.0)
+
+    def score(self, seconds):
+        """
+        Lower is better: the expected latency, pushed up by the tail latency and error rate, plus the weighted cost.
+        """
+        expected = self.prior_latency(seconds) * self.stats.percentile(0.5)
+        tail = self.prior_latency(seconds) * self.stats.percentile(0.95)
+        latency = (0.7 * expected + 0.3 * tail) * (1 + 4 * self.stats.error_rate)
+        return latency + COST_WEIGHT * self.cost_per_minute * (seconds or 60.0) / 60
+
+    async def recognize(self, source):
+        raise NotImplementedError
+
+
+class YandexSyncBackend(ASRBackend):
+    name = "yandex_sync"
+    encodings = set(yandex_requests.SYNC_FORMATS)
+    max_bytes = 1024 * 1024
+    max_seconds = 30
+    overhead = 0.5
+    realtime_factor = 0.1
+    cost_per_minute = 0.64
+
+    async def recognize(self, source):
+        return await yandex_requests.recognize_sync(await source.get_content(), source.encoding, source.seconds)
+
+
+class YandexLongRunningBackend(ASRBackend):
+    name = "yandex_long"
+    encodings = {"OGG_OPUS", "MP3"}
+    overhead = 6.0
+    realtime_factor = 0.17
+    cost_per_minute = 0.15
+    needs_object = True
+
+    async def recognize(self, source):
+        return await yandex_requests.recognize_object(await source.get_key(), source.encoding, source.seconds)
+
+
+class WhisperBackend(ASRBackend):
+    name = "whisper"
+    max_bytes = openai_requests.WHISPER_MAX_BYTES
+    overhead = 2.0
+    realtime_factor = 0.1
+    cost_per_minute = 0.55
+
+    @property
+    def enabled(self):
+        return bool(os.getenv('OPENAI_API_KEY_WHISPER'))
+
+    async def recognize(self, source):
+        return await openai_requests.transcribe_content(await source.get_content(), f"audio_file{source.suffix}",
+                                                        source.seconds)
+
+
+class ASRRouter:
+    """
+    Picks a backend for each job from its duration and size, the observed latency and error rate of the backends,
+    and their cost, and fails over to the next candidate when a backend errors.
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+
+    def choose(self, encoding, seconds=None, size=None):
+        """
+        Returns the backends that can take the job, best first. Backends cooling down after repeated
+        failures go last, so they are only tried when nothing else is left.
+        """
+        candidates = [backend for backend in self.backends
+                      if backend.enabled and backend.accepts(encoding, seconds, size)]
+        if not candidates:
+            raise ASRException(f"No ASR backend accepts {encoding} audio of {seconds} s and {size} bytes")
+        return sorted(candidates, key=lambda backend: (backend.stats.cooling_down, backend.score(seconds)))
+
+    def segment_max_bytes(self):
+        """
+        Returns the largest file any enabled backend takes, or None if one of them has no limit.
+        """
+        limits = [backend.max_bytes for backend in self.backends if backend.enabled and backend.max_seconds is None]
+        return None if not limits or None in limits else max(limits)
+
+    async def recognize(self, source, backends=None):
+        """
+        Recognises the source with the best backend, trying the next one when it fails.
+
+        :param source: The AudioSource to recognise.
+        :param backends: The candidates in order, as returned by `choose`; chosen here when omitted.
+        :return: The list of transcript.Segment.
+        """
+        if backends is None:
+            backends = self.choose(source.encoding, source.seconds, source.size)
+
+        with metrics.stage_seconds.time(stage="recognize"):
+            error = None
+            for backend in backends:
+                started = time.monotonic()
+                try:
+                    segments = await backend.recognize(source)
+                except Exception as e:
+                    metrics.asr_seconds.observe(time.monotonic() - started, backend=backend.name, outcome="error")
+                    backend.stats.record_failure()
+                    logger.warning(f"ASR backend {backend.name} failed: {e}")
+                    error = e
+                    continue
+                latency = time.monotonic() - started
+                metrics.asr_seconds.observe(latency, backend=backend.name, outcome="ok")
+                metrics.audio_seconds_processed.inc(source.seconds or 0)
+                backend.stats.record_success(latency / backend.prior_latency(source.seconds))
+                logger.info(f"Recognised {source.seconds} s of audio with {backend.name} in {latency:.1f} s")
+                return segments
+            raise error
+
+
+router = ASRRouter([YandexSyncBackend(), YandexLongRunningBackend(), WhisperBackend()])
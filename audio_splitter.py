@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import os
+import re
+import tempfile
+
+import jobs
+import transcoder
+import transcript
+from custom_exceptions import ASRException
+from media_pipeline import redact
+
+logger = logging.getLogger(__name__)
+
+FFPROBE_BINARY = os.getenv("FFPROBE_BINARY", "ffprobe")
+
+# Target and hard maximum length of one segment, in seconds.
+SEGMENT_SECONDS = float(os.getenv("SEGMENT_SECONDS", "300"))
+SEGMENT_MAX_SECONDS = float(os.getenv("SEGMENT_MAX_SECONDS", "360"))
+SEGMENT_CONCURRENCY = int(os.getenv("SEGMENT_CONCURRENCY", "4"))
+
+SILENCE_NOISE = os.getenv("SILENCE_NOISE", "-35dB")
+SILENCE_MIN_SECONDS = float(os.getenv("SILENCE_MIN_SECONDS", "0.4"))
+
+_silence_start_re = re.compile(r"silence_start: (-?[\d.]+)")
+_silence_end_re = re.compile(r"silence_end: (-?[\d.]+)")
+
+
+async def _run(*args):
+    process = await asyncio.create_subprocess_exec(
+        *args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await process.communicate()
+    except BaseException:
+        # A probe that timed out must not keep reading the file URL, which carries the bot token.
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    if process.returncode != 0:
+        logger.error(f"{args[0]} failed with code {process.returncode}: {redact(stderr.decode(errors='replace'))}")
+        raise ASRException(f"{os.path.basename(args[0])} exited with code {process.returncode}")
+    return stdout.decode(errors='replace'), stderr.decode(errors='replace')
+
+
+async def probe_duration(path):
+    """
+    Returns the duration of the media file in seconds.
+
+    :param path: A local path, or a Telegram download URL, which is never logged with its token.
+    """
+    stdout, _ = await _run(FFPROBE_BINARY, "-v", "error", "-show_entries", "format=duration",
+                           "-of", "default=noprint_wrappers=1:nokey=1", path)
+    try:
+        return float(stdout.strip())
+    except ValueError:
+        raise ASRException(f"Could not read the duration of {redact(path)}")
+
+
+async def detect_silences(path):
+    """
+    Returns a list of (start, end) pairs of silent intervals found by ffmpeg's silencedetect filter.
+    """
+    _, stderr = await _run(transcoder.FFMPEG_BINARY, "-hide_banner", "-nostats", "-i", path,
+                           "-af", f"silencedetect=noise={SILENCE_NOISE}:d={SILENCE_MIN_SECONDS}",
+                           "-f", "null", "-")
+    starts = [float(value) for value in _silence_start_re.findall(stderr)]
+    ends = [float(value) for value in _silence_end_re.findall(stderr)]
+    return list(zip(starts, ends))
+
+
+def plan_segments(duration, silences, target=SEGMENT_SECONDS, maximum=SEGMENT_MAX_SECONDS):
+    """
+    Splits [0, duration] into segments of about `target` seconds, cutting in the middle of a silence
+    when there is one between target/2 and `maximum` seconds after the segment start, and hard at `maximum` otherwise.
+
+    :return: A list of (start, end) pairs covering the whole duration.
+    """
+    cut_points = [(start + end) / 2 for start, end in silences]
+    segments = []
+    start = 0.0
+    while duration - start > maximum:
+        candidates = [point for point in cut_points if start + target / 2 <= point <= start + maximum]
+        end = min(candidates, key=lambda point: abs(point - start - target)) if candidates else start + maximum
+        segments.append((start, end))
+        start = end
+    segments.append((start, duration))
+    return segments
+
+
+def max_segment_seconds(max_bytes):
+    """
+    Returns the longest segment whose transcoded size stays under the backend's per-file limit.
+    """
+    bitrate = int(transcoder.TARGET_BITRATE.rstrip("k")) * 1000
+    # Leave room for the container overhead.
+    return max_bytes * 8 * 0.9 / bitrate
+
+
+async def transcribe_chunked(path, encoding, recognize, max_bytes=None, duration=None,
+                             concurrency=SEGMENT_CONCURRENCY, on_ready=None):
+    """
+    Cuts the recording on silence, recognises the parts concurrently and returns the transcript in order.
+
+    :param path: The audio file.
+    :param encoding: The ASR encoding of the file, used when it is short enough to be sent whole.
+    :param recognize: A coroutine function (part_path, encoding, seconds) -> list of transcript.Segment.
+    :param max_bytes: The backend's per-file size limit, if it has one.
+    :param duration: The duration from the media metadata, saves probing the file when known.
+    :param concurrency: How many parts may be recognised at the same time.
+    :param on_ready: A coroutine function called with the next segments of the transcript, in order,
+        whenever the parts at the start of the recording are recognised.
+    :return: The list of transcript.Segment, times in seconds from the start of the recording.
+    """
+    if not duration:
+        duration = await probe_duration(path)
+    maximum = SEGMENT_MAX_SECONDS
+    if max_bytes:
+        maximum = min(maximum, max_segment_seconds(max_bytes))
+    target = min(SEGMENT_SECONDS, maximum)
+
+    if duration <= maximum:
+        # Metadata durations are rounded, so a recording at the limit is simply sent whole.
+        return await recognize(path, encoding, duration)
+
+    segments = plan_segments(duration, await detect_silences(path), target, maximum)
+    logger.info(f"Split {duration:.0f}s recording into {len(segments)} segments")
+    semaphore = asyncio.Semaphore(concurrency)
+    results = [None] * len(segments)
+    reported = 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        async def recognize_segment(number, start, end):
+            nonlocal reported
+            segment_path = os.path.join(directory, f"segment_{number:04d}{transcoder.TARGET_SUFFIX}")
+            async with semaphore:
+                encoding = await transcoder.transcode(path, segment_path, start=start, duration=end - start)
+                with jobs.part(start):
+                    segments = await recognize(segment_path, encoding, end - start)
+                results[number] = transcript.shift(segments, start)
+            ready = []
+            while reported < len(results) and results[reported] is not None:
+                ready += results[reported]
+                reported += 1
+            if ready and on_ready is not None:
+                await on_ready(ready)
+
+        tasks = [asyncio.ensure_future(recognize_segment(number, start, end))
+                 for number, (start, end) in enumerate(segments)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop the other parts, their recognition and ffmpeg, before the directory is removed.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    return [segment for part in results for segment in part]
@@ -0,0 +1,623 @@
+"""
+Benchmark of the transcription pipeline against local stand-ins of the external services.
+
+Drives process_media_file and handle_text end to end with synthetic audio arriving at a target rate, and reports
+throughput, latency percentiles per pipeline stage, peak RSS and CPU time. The bot reads its settings from the
+environment when its modules are imported, so configurations are compared with --env, e.g.
+
+    python benchmark.py --jobs 40 --rate 1 --durations 20,120,900 --kinds voice,wav --env TRANSCODE_BITRATE=16k
+    python benchmark.py --jobs 40 --rate 1 --env ASR_WORKERS=8 --env OPENAI_API_KEY_WHISPER=fake
+
+Every request the bot makes goes to a local aiohttp server, never to Telegram, Yandex, S3 or Pay Fait.
+Needs ffmpeg, like the bot itself.
+"""
+import argparse
+import array
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import wave
+from collections import Counter, defaultdict
+
+import httpx
+from aiohttp import web
+
+BOT_TOKEN = "123456:benchmark"
+SAMPLE_RATE = 16000
+# Roughly how fast people speak, used to make transcripts of a realistic length.
+WORDS_PER_SECOND = 2.5
+WORDS = ("договорились", "созвон", "в", "понедельник", "отчёт", "клиент", "бюджет", "сроки", "задача", "проект",
+         "нужно", "сделать", "до", "пятницы", "согласовать", "встреча", "вопрос", "решение", "команда", "релиз")
+
+# Telegram media of each kind: the message field, MIME type and ffmpeg arguments that produce it from WAV.
+MEDIA_KINDS = {
+    "voice": ("voice", "audio/ogg", ".ogg", ["-c:a", "libopus", "-b:a", "32k"]),
+    "mp3": ("audio", "audio/mpeg", ".mp3", ["-c:a", "libmp3lame", "-b:a", "64k"]),
+    "wav": ("audio", "audio/x-wav", ".wav", None),
+    "m4a": ("audio", "audio/mp4", ".m4a", ["-c:a", "aac", "-b:a", "64k"]),
+}
+
+
+def synthetic_text(seconds, rng):
+    words = [rng.choice(WORDS) for _ in range(max(1, int(seconds * WORDS_PER_SECOND)))]
+    sentences = [" ".join(words[i:i + 12]).capitalize() + "." for i in range(0, len(words), 12)]
+    return " ".join(sentences)
+
+
+def write_wav(path, seconds):
+    """
+    Writes speech-like mono audio: tone bursts with a pause every few seconds, so silence detection
+    has somewhere to split long recordings.
+    """
+    tone = array.array("h", (int(8000 * math.sin(2 * math.pi * 220 * i / SAMPLE_RATE)) for i in range(SAMPLE_RATE)))
+    silence = array.array("h", bytes(2 * SAMPLE_RATE))
+    with wave.open(path, "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(SAMPLE_RATE)
+        for second in range(int(seconds)):
+            file.writeframes((silence if second % 7 == 6 else tone).tobytes())
+
+
+def make_audio(directory, kind, seconds):
+    wav_path = os.path.join(directory, f"{seconds}.wav")
+    if not os.path.exists(wav_path):
+        write_wav(wav_path, seconds)
+    _, _, suffix, codec_args = MEDIA_KINDS[kind]
+    if codec_args is None:
+        return wav_path
+    path = os.path.join(directory, f"{seconds}{suffix}")
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-i", wav_path, *codec_args, path],
+                   check=True)
+    return path
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+class FakeServices:
+    """
+    One local server standing in for the Telegram Bot API, S3, Yandex SpeechKit and LLM, Whisper and Pay Fait.
+
+    Requests for the real hosts arrive with the host as the first path segment (see RedirectTransport),
+    Bot API requests under /telegram, and anything else is a path-style S3 request.
+    """
+
+    def __init__(self, latency, jitter, stt_rtf, audio_bytes_per_second, llm_chunks, answer_words, bandwidth, seed):
+        """
+        :param latency: Injected latency in seconds per service name.
+        :param jitter: Relative spread of the injected latency, 0.2 meaning ±20%.
+        :param stt_rtf: Seconds of recognition per second of audio.
+        :param audio_bytes_per_second: Used to estimate the duration of the audio sent for recognition.
+        :param bandwidth: Telegram download speed in bytes per second, or 0 for unlimited.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.stt_rtf = stt_rtf
+        self.audio_bytes_per_second = audio_bytes_per_second
+        self.llm_chunks = llm_chunks
+        self.answer_words = answer_words
+        self.bandwidth = bandwidth
+        self.rng = random.Random(seed)
+        self.files = {}
+        self.objects = {}
+        self.uploads = {}
+        self.operations = {}
+        self.requests = Counter()
+        self.message_id = 0
+        self.runner = None
+        self.hosts = {
+            "telegram": ("telegram", self.telegram),
+            "transcribe.api.cloud.yandex.net": ("stt", self.long_running_recognize),
+            "operation.api.cloud.yandex.net": ("operation", self.operation),
+            "stt.api.cloud.yandex.net": ("stt", self.sync_recognize),
+            "llm.api.cloud.yandex.net": ("llm", self.completion),
+            "deep-whisper.openai.azure.com": ("whisper", self.whisper),
+            "pay.fait.gl": ("payfait", self.pay_fait),
+        }
+
+    async def start(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_route("*", "/{tail:.*}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def delay(self, service, extra=0.0):
+        seconds = self.latency.get(service, 0.0) * self.rng.uniform(1 - self.jitter, 1 + self.jitter) + extra
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+
+    def audio_seconds(self, size):
+        return size / self.audio_bytes_per_second
+
+    async def handle(self, request):
+        first, _, rest = request.path.lstrip("/").partition("/")
+        service, handler = self.hosts.get(first, ("s3", None))
+        self.requests[service] += 1
+        await self.delay(service)
+        if handler is None:
+            return await self.s3(request)
+        return await handler(request, rest)
+
+    def _message(self, chat_id, text=None):
+        self.message_id += 1
+        return {"message_id": self.message_id, "date": int(time.time()),
+                "chat": {"id": int(chat_id or 0), "type": "private"}, "text": text}
+
+    async def telegram(self, request, rest):
+        if rest.startswith("file/"):
+            return await self._send_file(request, self.files[rest.split("/", 2)[2]])
+        method = rest.split("/", 1)[1]
+        form = await request.post()
+        if method == "getFile":
+            file_id = form["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.files[file_id]),
+                      "file_path": file_id}
+        elif method in ("sendMessage", "sendDocument", "editMessageText"):
+            result = self._message(form.get("chat_id"), form.get("text"))
+        elif method == "sendMediaGroup":
+            result = [self._message(form.get("chat_id")) for _ in json.loads(form["media"])]
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _send_file(self, request, content):
+        response = web.StreamResponse(headers={"Content-Length": str(len(content))})
+        await response.prepare(request)
+        chunk_size = 64 * 1024
+        for offset in range(0, len(content), chunk_size):
+            await response.write(content[offset:offset + chunk_size])
+            if self.bandwidth:
+                await asyncio.sleep(chunk_size / self.bandwidth)
+        await response.write_eof()
+        return response
+
+    async def s3(self, request):
+        _, _, key = request.path.lstrip("/").partition("/")
+        query = request.query
+        etag_of = lambda body: f'"{hashlib.md5(body).hexdigest()}"'
+        if request.method == "HEAD":
+            content = self.objects.get(key)
+            if content is None:
+                return web.Response(status=404)
+            return web.Response(headers={"Content-Length": str(len(content)), "ETag": etag_of(content)})
+        if request.method == "GET":
+            content = self.objects.get(key)
+            if content is None:
+                return web.Response(status=404, text="<Error><Code>NoSuchKey</Code></Error>")
+            return web.Response(body=content)
+        if request.method == "PUT":
+            body = await request.read()
+            if "partNumber" in query:
+                self.uploads[query["uploadId"]][int(query["partNumber"])] = body
+            else:
+                self.objects[key] = body
+            return web.Response(headers={"ETag": etag_of(body)})
+        if request.method == "POST" and "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.uploads[upload_id] = {}
+            return web.Response(content_type="application/xml", text=(
+                f"<InitiateMultipartUploadResult><Bucket>bucket</Bucket><Key>{key}</Key>"
+                f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"))
+        if request.method == "POST" and "uploadId" in query:
+            await request.read()
+            parts = self.uploads.pop(query["uploadId"])
+            self.objects[key] = b"".join(parts[number] for number in sorted(parts))
+            return web.Response(content_type="application/xml", text=(
+                f"<CompleteMultipartUploadResult><Key>{key}</Key>"
+                f"<ETag>{etag_of(self.objects[key])}</ETag></CompleteMultipartUploadResult>"))
+        if request.method == "DELETE":
+            if "uploadId" in query:
+                self.uploads.pop(query["uploadId"], None)
+            else:
+                self.objects.pop(key, None)
+            return web.Response(status=204)
+        return web.Response(status=400)
+
+    async def long_running_recognize(self, request, rest):
+        body = await request.json()
+        key = body["audio"]["uri"].split("/", 4)[4]
+        content = self.objects.get(key)
+        if content is None:
+            return web.json_response({"code": 3, "message": f"No object {key}"}, status=400)
+        seconds = self.audio_seconds(len(content))
+        operation_id = uuid.uuid4().hex
+        self.operations[operation_id] = (time.monotonic() + seconds * self.stt_rtf, synthetic_text(seconds, self.rng))
+        return web.json_response({"id": operation_id, "done": False})
+
+    async def operation(self, request, rest):
+        operation_id = rest.rsplit("/", 1)[-1]
+        done_at, text = self.operations[operation_id]
+        if time.monotonic() < done_at:
+            return web.json_response({"id": operation_id, "done": False})
+        del self.operations[operation_id]
+        return web.json_response({"id": operation_id, "done": True, "response": {
+            "chunks": [{"alternatives": [{"text": text}], "channelTag": "1"}]}})
+
+    async def sync_recognize(self, request, rest):
+        seconds = self.audio_seconds(len(await request.read()))
+        await asyncio.sleep(seconds * self.stt_rtf)
+        return web.json_response({"result": synthetic_text(seconds, self.rng)})
+
+    async def whisper(self, request, rest):
+        seconds = self.audio_seconds(len(await request.read()))
+        await asyncio.sleep(seconds * self.stt_rtf)
+        return web.json_response({"text": synthetic_text(seconds, self.rng)})
+
+    async def completion(self, request, rest):
+        body = await request.json()
+        answer = synthetic_text(self.answer_words / WORDS_PER_SECOND, self.rng)
+        payload = lambda text: {"result": {"alternatives": [{"message": {"role": "assistant", "text": text}}]}}
+        if not body.get("stream"):
+            await self.delay("llm_generation")
+            return web.json_response(payload(answer))
+
+        # The streaming API sends one JSON object per line, each with the whole text so far.
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        for step in range(1, self.llm_chunks + 1):
+            await asyncio.sleep(self.latency.get("llm_generation", 0.0) / self.llm_chunks)
+            text = answer[:len(answer) * step // self.llm_chunks]
+            await response.write((json.dumps(payload(text), ensure_ascii=False) + "\n").encode())
+        await response.write_eof()
+        return response
+
+    async def pay_fait(self, request, rest):
+        if rest.lstrip("/").startswith("auth/"):
+            return web.json_response({"token": "benchmark"})
+        return web.json_response({"data": {"goods": [{"name": "Подписка 1000000 минут в день"}]}})
+
+
+class RedirectTransport(httpx.AsyncBaseTransport):
+    """
+    Sends every request of the shared HTTP client to the fakes, with the original host as the first path segment.
+    """
+
+    def __init__(self, base_url):
+        self._base = httpx.URL(base_url)
+        self._transport = httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        url = request.url
+        request.url = url.copy_with(scheme=self._base.scheme, host=self._base.host, port=self._base.port,
+                                    path=f"/{url.host}{url.path}")
+        request.headers["Host"] = f"{self._base.host}:{self._base.port}"
+        return await self._transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class Benchmark:
+    def __init__(self, args, fakes, workdir):
+        self.args = args
+        self.fakes = fakes
+        self.workdir = workdir
+        self.rng = random.Random(args.seed)
+        self.results = []
+        self.samples = defaultdict(list)
+        self.sent_files = []
+
+    def record_stage_samples(self, metrics):
+        """
+        Keeps every observation of the bot's histograms, so exact percentiles can be reported.
+        """
+        observe = metrics.Histogram.observe
+        samples = self.samples
+
+        def recording_observe(histogram, value, **labels):
+            samples[(histogram.name, tuple(labels.get(name, "") for name in histogram.labelnames))].append(value)
+            observe(histogram, value, **labels)
+
+        metrics.Histogram.observe = recording_observe
+
+    def prepare_media(self):
+        """
+        Encodes one file per kind and duration; arrivals of the same kind and duration share its content.
+        """
+        variants = []
+        for kind in self.args.kinds:
+            for seconds in self.args.durations:
+                with open(make_audio(self.workdir, kind, seconds), "rb") as file:
+                    variants.append((kind, seconds, file.read()))
+        return variants
+
+    def media_message(self, user_id, kind, seconds, content):
+        if self.sent_files and self.rng.random() < self.args.repeat:
+            file_id = self.rng.choice(self.sent_files)
+        else:
+            file_id = f"{kind}-{seconds}-{uuid.uuid4().hex}"
+            self.sent_files.append(file_id)
+            self.fakes.files[file_id] = content
+        field, mime_type, _, _ = MEDIA_KINDS[kind]
+        return self._message(user_id, **{field: {
+            "file_id": file_id, "file_unique_id": file_id, "duration": seconds, "mime_type": mime_type,
+            "file_size": len(self.fakes.files[file_id])}})
+
+    def _message(self, user_id, **fields):
+        from aiogram.types import Message
+
+        import main as bot_main
+        self.fakes.message_id += 1
+        data = {"message_id": self.fakes.message_id, "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Benchmark"}, **fields}
+        return Message.model_validate(data, context={"bot": bot_main.bot})
+
+    async def run_media(self, user_id, kind, seconds, content):
+        import file_utils
+        import main as bot_main
+        import metrics
+        from custom_exceptions import QueueFullException
+
+        message = self.media_message(user_id, kind, seconds, content)
+        media = await bot_main.get_media_from_message(message)
+        finished = asyncio.get_running_loop().create_future()
+
+        async def job():
+            metrics.new_trace()
+            try:
+                await file_utils.process_media_file(bot_main.bot, message, media)
+                finished.set_result("ok")
+            except Exception as e:
+                finished.set_result(f"error: {type(e).__name__}: {e}")
+
+        queued = time.monotonic()
+        try:
+            bot_main.media_queue.submit(user_id, job)
+        except QueueFullException:
+            outcome = "rejected"
+        else:
+            outcome = await finished
+        self.results.append({"type": "media", "kind": kind, "seconds": seconds, "outcome": outcome,
+                             "latency": time.monotonic() - queued})
+
+    async def run_question(self, user_id):
+        from aiogram.fsm.context import FSMContext
+        from aiogram.fsm.storage.base import StorageKey
+
+        import main as bot_main
+        context = synthetic_text(self.args.context_chars / 12, self.rng)[:self.args.context_chars]
+        question = self.rng.choice(["О чем шла речь?", "О чем договорились по срокам?", "Какой бюджет у проекта?",
+                                    "Кратко перескажи разговор", "Кто отвечает за отчёт клиенту?"])
+        transcript = self._message(user_id, text=context)
+        message = self._message(user_id, text=question, reply_to_message=transcript.model_dump(by_alias=True,
+                                                                                              exclude_none=True))
+        state = FSMContext(storage=bot_main.dp.storage, key=StorageKey(bot_main.bot.id, user_id, user_id))
+        started = time.monotonic()
+        try:
+            await bot_main.handle_text(message, state)
+            outcome = "ok"
+        except Exception as e:
+            outcome = f"error: {type(e).__name__}: {e}"
+        self.results.append({"type": "question", "outcome": outcome, "latency": time.monotonic() - started})
+
+    async def run(self):
+        import db
+        import main as bot_main
+
+        await db.run(db.create_database)
+        users = [100000 + number for number in range(self.args.users)]
+        for user_id in users:
+            await db.async_add_user(user_id, f"user{user_id}@example.com")
+            await db.async_add_user_password(user_id, "benchmark")
+            await db.async_update_minutes(user_id, max_minutes=10 ** 9)
+
+        variants = self.prepare_media()
+        arrivals = ["media"] * self.args.jobs + ["question"] * self.args.questions
+        self.rng.shuffle(arrivals)
+
+        bot_main.media_queue.start()
+        usage_before = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+        started = time.monotonic()
+        tasks = []
+        at = 0.0
+        for number, arrival in enumerate(arrivals):
+            at += self.rng.expovariate(self.args.rate)
+            await asyncio.sleep(max(0.0, started + at - time.monotonic()))
+            user_id = users[number % len(users)]
+            if arrival == "media":
+                tasks.append(asyncio.create_task(self.run_media(user_id, *self.rng.choice(variants))))
+            else:
+                tasks.append(asyncio.create_task(self.run_question(user_id)))
+        await asyncio.gather(*tasks)
+        wall = time.monotonic() - started
+        usage_after = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+        await bot_main.media_queue.stop()
+        return self.report(wall, usage_before, usage_after)
+
+    def report(self, wall, usage_before, usage_after):
+        cpu = [after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime
+               for before, after in zip(usage_before, usage_after)]
+        media = [result for result in self.results if result["type"] == "media"]
+        audio_seconds = sum(result["seconds"] for result in media if result["outcome"] == "ok")
+        latencies = {
+            "media end-to-end": [result["latency"] for result in media if result["outcome"] == "ok"],
+            "question end-to-end": [result["latency"] for result in self.results
+                                    if result["type"] == "question" and result["outcome"] == "ok"],
+        }
+        for (name, labels), values in sorted(self.samples.items()):
+            latencies[" ".join([name.replace("_seconds", ""), *labels]).strip()] = values
+
+        return {
+            "settings": vars(self.args),
+            "wall_seconds": wall,
+            "outcomes": dict(Counter(f"{result['type']} {result['outcome']}" for result in self.results)),
+            "jobs_per_second": len(media) / wall if wall else 0.0,
+            "audio_minutes_per_minute": audio_seconds / wall if wall else 0.0,
+            "cpu_seconds": {"bot": cpu[0], "children": cpu[1]},
+            "cpu_utilisation": sum(cpu) / wall if wall else 0.0,
+            # ru_maxrss is in kilobytes on Linux.
+            "peak_rss_mb": {"bot": usage_after[0].ru_maxrss / 1024, "largest_child": usage_after[1].ru_maxrss / 1024},
+            "fake_requests": dict(self.fakes.requests),
+            "latency": {name: {"count": len(values), "p50": percentile(values, 0.5), "p90": percentile(values, 0.9),
+                               "p95": percentile(values, 0.95), "p99": percentile(values, 0.99), "max": max(values)}
+                        for name, values in latencies.items() if values},
+        }
+
+
+def print_report(report):
+    print(f"Wall time: {report['wall_seconds']:.1f} s")
+    for outcome, count in sorted(report["outcomes"].items()):
+        print(f"  {count:5d}  {outcome}")
+    print(f"Throughput: {report['jobs_per_second']:.2f} media jobs/s, "
+          f"{report['audio_minutes_per_minute']:.1f} audio minutes per minute")
+    print(f"CPU: {report['cpu_seconds']['bot']:.1f} s bot, {report['cpu_seconds']['children']:.1f} s ffmpeg/ffprobe, "
+          f"{report['cpu_utilisation']:.0%} of one core")
+    print(f"Peak RSS: {report['peak_rss_mb']['bot']:.0f} MB bot, {report['peak_rss_mb']['largest_child']:.0f} MB "
+          f"largest child")
+    print(f"Requests to fakes: {', '.join(f'{name} {count}' for name, count in sorted(report['fake_requests'].items()))}")
+    print(f"\n{'latency, s':42} {'count':>6} {'p50':>8} {'p90':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for name, row in report["latency"].items():
+        print(f"{name:42} {row['count']:6d} " + " ".join(f"{row[key]:8.3f}" for key in ("p50", "p90", "p95", "p99", "max")))
+
+
+def parse_latency(value):
+    latency = {}
+    for item in filter(None, value.split(",")):
+        name, _, seconds = item.partition("=")
+        latency[name.strip()] = float(seconds)
+    return latency
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=20, help="media messages to send")
+    parser.add_argument("--questions", type=int, default=0, help="questions about transcripts to ask")
+    parser.add_argument("--rate", type=float, default=1.0, help="mean arrivals per second (Poisson)")
+    parser.add_argument("--users", type=int, default=5, help="distinct users the arrivals come from")
+    parser.add_argument("--durations", type=lambda value: [int(item) for item in value.split(",")],
+                        default=[15, 60, 300], help="audio lengths in seconds, comma-separated")
+    parser.add_argument("--kinds", type=lambda value: value.split(","), default=["voice"],
+                        help=f"media kinds, comma-separated: {', '.join(MEDIA_KINDS)}")
+    parser.add_argument("--repeat", type=float, default=0.0, help="share of arrivals that resend an earlier file")
+    parser.add_argument("--cache", action="store_true", help="keep the transcript and completion caches enabled")
+    parser.add_argument("--context-chars", type=int, default=30000, help="transcript length for questions")
+    parser.add_argument("--latency", type=parse_latency,
+                        default=parse_latency("telegram=0.05,s3=0.02,stt=0.3,operation=0.05,llm=0.3,"
+                                              "llm_generation=2,whisper=0.5,payfait=0.1"),
+                        help="injected latency per fake service in seconds, e.g. s3=0.05,stt=0.5")
+    parser.add_argument("--jitter", type=float, default=0.2, help="relative spread of the injected latency")
+    parser.add_argument("--stt-rtf", type=float, default=0.1, help="recognition seconds per second of audio")
+    parser.add_argument("--bandwidth", type=float, default=0, help="Telegram download speed in MB/s, 0 for unlimited")
+    parser.add_argument("--llm-chunks", type=int, default=20, help="lines in a streamed completion")
+    parser.add_argument("--answer-words", type=int, default=150, help="words in an LLM answer")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="bot setting to apply before its modules are imported; repeatable")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory with databases and audio")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args):
+    for item in args.env:
+        name, _, value = item.partition("=")
+        os.environ[name] = value
+    defaults = {
+        "TELEGRAM_TOKEN": BOT_TOKEN,
+        "ERRORS_CHAT_ID": "1",
+        "YANDEX_API_KEY": "benchmark",
+        "YANDEX_API_KEY_STT": "benchmark",
+        "aws_access_key_id": "benchmark",
+        "aws_secret_access_key": "benchmark",
+        "METRICS_PORT": "0",
+        # Newer botocore signs uploads with streamed checksums the S3 fake does not parse.
+        "AWS_REQUEST_CHECKSUM_CALCULATION": "when_required",
+        "AWS_RESPONSE_CHECKSUM_VALIDATION": "when_required",
+    }
+    if not args.cache:
+        defaults.update({"TRANSCRIPT_CACHE_TTL": "0", "COMPLETION_CACHE_TTL": "0"})
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+
+async def run_benchmark(args, workdir):
+    import boto3
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from botocore.config import Config
+    from aiogram.client.telegram import TelegramAPIServer
+
+    import cache_db
+    import db
+    import http_client
+    import main as bot_main
+    import metrics
+    import object_storage
+    from operation_poller import poller
+    from transcoder import TARGET_BITRATE
+
+    bitrate = float(TARGET_BITRATE.rstrip("k")) * 1000 if TARGET_BITRATE.endswith("k") else float(TARGET_BITRATE)
+    fakes = FakeServices(args.latency, args.jitter, args.stt_rtf, bitrate / 8, args.llm_chunks, args.answer_words,
+                         args.bandwidth * 1024 * 1024, args.seed)
+    base_url = await fakes.start()
+    http_client.start(RedirectTransport(base_url))
+    object_storage._client = boto3.session.Session().client(
+        service_name="s3", endpoint_url=base_url, region_name="us-east-1",
+        aws_access_key_id="benchmark", aws_secret_access_key="benchmark",
+        config=Config(s3={"addressing_style": "path"}))
+    bot_main.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(f"{base_url}/telegram"))
+    bot_main.dp.include_router(bot_main.router)
+
+    benchmark = Benchmark(args, fakes, workdir)
+    benchmark.record_stage_samples(metrics)
+    try:
+        return await benchmark.run()
+    finally:
+        await poller.stop()
+        await http_client.close()
+        await bot_main.bot.session.close()
+        await db.run(db.close_connection)
+        await cache_db.run(cache_db.close_connection)
+        await fakes.stop()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    unknown = set(args.kinds) - set(MEDIA_KINDS)
+    if unknown:
+        sys.exit(f"Unknown media kinds: {', '.join(sorted(unknown))}")
+    if not shutil.which("ffmpeg"):
+        sys.exit("ffmpeg is required")
+    configure_environment(args)
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    # The bot keeps its databases in the working directory.
+    workdir = tempfile.mkdtemp(prefix="transcription-benchmark-")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    try:
+        report = asyncio.run(run_benchmark(args, workdir))
+    finally:
+        if args.keep:
+            print(f"Working directory: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import asyncio
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+# transcripts.db holds what can be rebuilt: transcripts, their indexes, answers and sent documents.
+# It is kept apart from users.db so that cache traffic never waits on the users and job tables.
+cache_db_name = os.path.join(os.path.dirname(db.db_name), "transcripts.db")
+cache_lock = threading.Lock()
+
+_connection = None
+# As with users.db, async access goes through one thread, so the event loop never waits on sqlite.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache_db")
+
+
+def get_connection():
+    """
+    Returns the long-lived connection, opening it in WAL mode and creating the tables on first use.
+    Callers must hold cache_lock.
+    """
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(cache_db_name, check_same_thread=False, cached_statements=128)
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute("PRAGMA synchronous=NORMAL")
+        _connection.execute("PRAGMA busy_timeout=5000")
+        create_tables(_connection)
+    return _connection
+
+
+def close_connection():
+    global _connection
+    with cache_lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+
+
+async def run(func, *args):
+    """
+    Runs a blocking cache function on the cache database thread.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+
+def create_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS transcripts (
+            id INTEGER PRIMARY KEY,
+            file_unique_id TEXT UNIQUE,
+            content_hash TEXT,
+            text TEXT,
+            segments TEXT,
+            size INTEGER,
+            created_at REAL,
+            accessed_at REAL
+        )
+    """)
+    if "segments" not in {row[1] for row in conn.execute("PRAGMA table_info(transcripts)")}:
+        conn.execute("ALTER TABLE transcripts ADD COLUMN segments TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS transcripts_content_hash ON transcripts (content_hash)")
+    conn.execute("CREATE INDEX IF NOT EXISTS transcripts_accessed_at ON transcripts (accessed_at)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS completions (
+            cache_key TEXT PRIMARY KEY,
+            answer TEXT,
+            created_at REAL,
+            accessed_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS completions_accessed_at ON completions (accessed_at)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS transcript_indexes (
+            transcript_hash TEXT PRIMARY KEY,
+            data TEXT,
+            created_at REAL
+        )
+    """)
+    # Transcripts the bot sent as documents, by chat and message id, see transcript_store.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sent_documents (
+            chat_id INTEGER,
+            message_id INTEGER,
+            text TEXT,
+            size INTEGER,
+            created_at REAL,
+            PRIMARY KEY (chat_id, message_id)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS sent_documents_created_at ON sent_documents (created_at)")
+    conn.commit()
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import re
+import time
+
+import cache_db
+import metrics
+
+CACHE_TTL = int(os.getenv("COMPLETION_CACHE_TTL", str(7 * 24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.getenv("COMPLETION_CACHE_MAX_ENTRIES", "5000"))
+
+# A question starting with one of these skips the cache and replaces the stored answer.
+REGENERATE_PREFIXES = ("/regen", "!regen", "заново")
+
+stats = {"hit": 0, "miss": 0, "bypass": 0}
+
+_punctuation_re = re.compile(r"[^\w\s]+", re.UNICODE)
+_space_re = re.compile(r"\s+")
+
+
+def normalize_question(question):
+    question = (question or "").lower().replace("ё", "е")
+    question = _punctuation_re.sub(" ", question)
+    return _space_re.sub(" ", question).strip()
+
+
+def split_regenerate(question):
+    """
+    Returns the question without a regenerate marker, and whether the marker was there.
+    """
+    stripped = (question or "").lstrip()
+    for prefix in REGENERATE_PREFIXES:
+        if stripped.lower().startswith(prefix):
+            return stripped[len(prefix):].lstrip(" :,"), True
+    return question, False
+
+
+def make_key(transcript_hash, question, options):
+    """
+    :param transcript_hash: The hash of the context the question is about.
+    :param question: The question as the user wrote it.
+    :param options: The model and completion options that affect the answer.
+    """
+    payload = json.dumps([transcript_hash, normalize_question(question), options], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def get_answer(cache_key):
+    now = time.time()
+    with cache_db.cache_lock, cache_db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT answer FROM completions WHERE cache_key = ? AND created_at > ?",
+                       (cache_key, now - CACHE_TTL))
+        row = cursor.fetchone()
+        if row:
+            cursor.execute("UPDATE completions SET accessed_at = ? WHERE cache_key = ?", (now, cache_key))
+            conn.commit()
+
+    _count("hit" if row else "miss")
+    return row[0] if row else None
+
+
+def put_answer(cache_key, answer):
+    now = time.time()
+    with cache_db.cache_lock, cache_db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT OR REPLACE INTO completions (cache_key, answer, created_at, accessed_at) "
+                       "VALUES (?, ?, ?, ?)", (cache_key, answer, now, now))
+        cursor.execute("DELETE FROM completions WHERE created_at <= ?", (now - CACHE_TTL,))
+        # Least recently used entries beyond the limit.
+        cursor.execute("DELETE FROM completions WHERE cache_key IN ("
+                       "SELECT cache_key FROM completions ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                       (CACHE_MAX_ENTRIES,))
+        conn.commit()
+
+
+def count_bypass():
+    """
+    Counts a question that skipped the cache to regenerate its answer.
+    """
+    _count("bypass")
+
+
+def _count(result):
+    stats[result] += 1
+    metrics.completion_cache_lookups_total.inc(result=result)
+
+
+def hit_rate():
+    lookups = stats["hit"] + stats["miss"]
+    return stats["hit"] / lookups if lookups else 0.0
+
+
+async def async_get_answer(cache_key):
+    return await cache_db.run(get_answer, cache_key)
+
+
+async def async_put_answer(cache_key, answer):
+    await cache_db.run(put_answer, cache_key, answer)
@@ -2,4 +2,26 @@ class ASRException(Exception):
     """ Custom exception for ASR-related errors. """
     def __init__(self, message, status_code=None):
         super().__init__(message)
-        self.status_code = status_code
\ No newline at end of file
+        self.status_code = status_code
+
+
+class QueueFullException(Exception):
+    """ Raised when the transcription queue cannot accept another job. """
+    def __init__(self, message, position=None):
+        super().__init__(message)
+        self.position = position
+
+
+class MediaRejectedException(Exception):
+    """ Raised when media is refused before it is downloaded, because it is "too_big" or "too_long". """
+    def __init__(self, message, reason, limit=None):
+        super().__init__(message)
+        self.reason = reason
+        self.limit = limit
+
+
+class QuotaExceededException(Exception):
+    """ Raised when a job needs more minutes than are left in the user's daily allowance. """
+    def __init__(self, message, minutes=None):
+        super().__init__(message)
+        self.minutes = minutes
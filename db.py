@@ -1,16 +1,56 @@
 import asyncio
 import sqlite3
 import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from custom_exceptions import QueueFullException
 
 user_cache = {}
 db_lock = threading.Lock()
 db_name = "users.db"
 
+UserProfile = namedtuple("UserProfile", ["email", "password", "token", "max_minutes", "used_minutes"])
+
+_connection = None
+# All async access goes through one thread, so the event loop never waits on sqlite and writes never contend.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+
+def get_connection():
+    """
+    Returns the long-lived connection, opening it in WAL mode on first use.
+    Callers must hold db_lock.
+    """
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(db_name, check_same_thread=False, cached_statements=128)
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute("PRAGMA synchronous=NORMAL")
+        _connection.execute("PRAGMA busy_timeout=5000")
+    return _connection
+
+
+def close_connection():
+    global _connection
+    with db_lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+
+
+async def run(func, *args):
+    """
+    Runs a blocking storage function on the database thread.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+
 def create_database():
     with db_lock:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        cursor.execute("""
+        conn = get_connection()
+        conn.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 id INTEGER PRIMARY KEY,
                 user_id INTEGER UNIQUE,
@@ -18,21 +58,98 @@ def create_database():
                 max_minutes INTEGER DEFAULT 0,
                 used_minutes INTEGER DEFAULT 0,
                 userPassword TEXT,
-                auth_token TEXT
+                auth_token TEXT,
+                reserved_minutes INTEGER DEFAULT 0,
+                usage_day TEXT
+            )
+        """)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+        if "reserved_minutes" not in columns:
+            conn.execute("ALTER TABLE users ADD COLUMN reserved_minutes INTEGER DEFAULT 0")
+        if "usage_day" not in columns:
+            conn.execute("ALTER TABLE users ADD COLUMN usage_day TEXT")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS media_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                payload TEXT,
+                status TEXT DEFAULT 'pending',
+                worker TEXT,
+                created_at REAL,
+                claimed_at REAL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS media_jobs_status ON media_jobs (status, user_id)")
+        # One row per media message, keyed by chat and message id, so a job resumed after a restart
+        # finds the minutes it reserved and whether its reply went out.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS transcription_jobs (
+                job_key TEXT PRIMARY KEY,
+                user_id INTEGER,
+                payload TEXT,
+                state TEXT,
+                reserved_minutes INTEGER,
+                reservation_day TEXT,
+                charge TEXT,
+                delivered_segments INTEGER DEFAULT 0,
+                created_at REAL,
+                updated_at REAL
+            )
+        """)
+        if "delivered_segments" not in {row[1] for row in conn.execute("PRAGMA table_info(transcription_jobs)")}:
+            conn.execute("ALTER TABLE transcription_jobs ADD COLUMN delivered_segments INTEGER DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS transcription_jobs_state ON transcription_jobs (state)")
+        # The recognition operation and result of each part of a job's recording, by its start in seconds.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_parts (
+                job_key TEXT,
+                part_start REAL,
+                operation_id TEXT,
+                segments TEXT,
+                PRIMARY KEY (job_key, part_start)
+            )
+        """)
+        # Holds on storage objects by the jobs of every process, so no process deletes an object
+        # another one still needs; the objects are content-addressed and shared between jobs.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS object_leases (
+                key TEXT PRIMARY KEY,
+                holders INTEGER,
+                deleting INTEGER DEFAULT 0,
+                updated_at REAL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                storage_key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT
             )
         """)
         conn.commit()
-        conn.close()
+
+
+def get_user_profile(user_id):
+    """
+    Returns everything a message handler needs about the user in one query, or None for unknown users.
+    """
+    with db_lock:
+        row = get_connection().execute(
+            "SELECT email, userPassword, auth_token, max_minutes, used_minutes FROM users WHERE user_id = ?",
+            (user_id,)).fetchone()
+
+    if row is None:
+        return None
+    user_cache[user_id] = row[0]
+    return UserProfile(*row)
 
 
 def get_user_email(user_id):
     if user_id in user_cache:
         return user_cache[user_id]
 
-    with db_lock, sqlite3.connect(db_name) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT email FROM users WHERE user_id = ?", (user_id,))
-        email = cursor.fetchone()
+    with db_lock:
+        email = get_connection().execute("SELECT email FROM users WHERE user_id = ?", (user_id,)).fetchone()
 
     if email:
         user_cache[user_id] = email[0]
@@ -41,89 +158,570 @@ def get_user_email(user_id):
 
 
 def add_user(user_id, email):
-    with db_lock, sqlite3.connect(db_name) as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO users (user_id, email) VALUES (?, ?)", (user_id, email))
+    with db_lock:
+        conn = get_connection()
+        conn.execute("INSERT INTO users (user_id, email) VALUES (?, ?)", (user_id, email))
         conn.commit()
 
     user_cache[user_id] = email
 
 
 def check_user_in_db(user_id):
-    with db_lock, sqlite3.connect(db_name) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        user = cursor.fetchone()
+    with db_lock:
+        user = get_connection().execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone()
 
     return user is not None
 
 
-async def async_add_user(user_id, email):
-    await asyncio.to_thread(add_user, user_id, email)
-
-
-async def async_get_user_email(user_id):
-    return await asyncio.to_thread(get_user_email, user_id)
-
-
 def update_minutes(user_id, max_minutes=None, used_minutes=None):
-    with db_lock, sqlite3.connect(db_name) as conn:
-        cursor = conn.cursor()
+    with db_lock:
+        conn = get_connection()
         if max_minutes is not None:
-            cursor.execute("UPDATE users SET max_minutes = ? WHERE user_id = ?", (max_minutes, user_id))
+            conn.execute("UPDATE users SET max_minutes = ? WHERE user_id = ?", (max_minutes, user_id))
         if used_minutes is not None:
-            cursor.execute("UPDATE users SET used_minutes = ? WHERE user_id = ?", (used_minutes, user_id))
+            conn.execute("UPDATE users SET used_minutes = ? WHERE user_id = ?", (used_minutes, user_id))
         conn.commit()
 
 
-def get_user_minutes(user_id):
-    with db_lock, sqlite3.connect(db_name) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT max_minutes, used_minutes FROM users WHERE user_id = ?", (user_id,))
-        data = cursor.fetchone()
+def get_user_minutes(user_id, day=None):
+    """
+    Returns the user's allowance and used minutes. With `day`, minutes used on another day count as zero.
+    """
+    with db_lock:
+        data = get_connection().execute(
+            "SELECT max_minutes, CASE WHEN ? IS NULL OR usage_day = ? THEN used_minutes ELSE 0 END "
+            "FROM users WHERE user_id = ?", (day, day, user_id)).fetchone()
 
     return data if data else (0, 0)
 
 
-async def async_update_minutes(user_id, max_minutes=None, used_minutes=None):
-    await asyncio.to_thread(update_minutes, user_id, max_minutes, used_minutes)
+def reserve_minutes(user_id, minutes, day):
+    """
+    Reserves minutes of the user's daily allowance in one guarded UPDATE, so concurrent jobs cannot overdraw it.
+    Counters left from an earlier day count as zero and are reset by the first reservation of the day,
+    which needs no scan over all users.
+
+    :return: True if the minutes were reserved, False if the allowance does not cover them.
+    """
+    with db_lock:
+        conn = get_connection()
+        reserved = _reserve(conn, user_id, minutes, day)
+        conn.commit()
+
+    return reserved
+
+
+def _reserve(conn, user_id, minutes, day):
+    cursor = conn.execute("""
+        UPDATE users SET
+            used_minutes = CASE WHEN usage_day = :day THEN used_minutes ELSE 0 END,
+            reserved_minutes = CASE WHEN usage_day = :day THEN reserved_minutes ELSE 0 END + :minutes,
+            usage_day = :day
+        WHERE user_id = :user_id
+          AND CASE WHEN usage_day = :day THEN used_minutes + reserved_minutes ELSE 0 END + :minutes <= max_minutes
+    """, {"user_id": user_id, "minutes": minutes, "day": day})
+    return cursor.rowcount == 1
+
+
+def commit_minutes(user_id, minutes, day):
+    """
+    Turns reserved minutes into used ones. Reservations from a day that has been reset are dropped.
+    """
+    with db_lock:
+        conn = get_connection()
+        _commit(conn, user_id, minutes, day)
+        conn.commit()
 
 
-async def async_get_user_minutes(user_id):
-    return await asyncio.to_thread(get_user_minutes, user_id)
+def _commit(conn, user_id, minutes, day):
+    conn.execute("UPDATE users SET reserved_minutes = MAX(reserved_minutes - ?, 0), "
+                 "used_minutes = used_minutes + ? WHERE user_id = ? AND usage_day = ?", (minutes, minutes, user_id, day))
+
+
+def refund_minutes(user_id, minutes, day):
+    with db_lock:
+        conn = get_connection()
+        _refund(conn, user_id, minutes, day)
+        conn.commit()
+
+
+def _refund(conn, user_id, minutes, day):
+    conn.execute("UPDATE users SET reserved_minutes = MAX(reserved_minutes - ?, 0) "
+                 "WHERE user_id = ? AND usage_day = ?", (minutes, user_id, day))
+
+
+def create_job(job_key, user_id, payload, state):
+    """
+    Records a media job unless it is already known, and returns its state and how many segments
+    of its transcript were sent to the chat.
+    """
+    now = time.time()
+    with db_lock:
+        conn = get_connection()
+        conn.execute("INSERT OR IGNORE INTO transcription_jobs (job_key, user_id, payload, state, created_at, updated_at) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", (job_key, user_id, payload, state, now, now))
+        row = conn.execute("SELECT state, delivered_segments FROM transcription_jobs WHERE job_key = ?",
+                           (job_key,)).fetchone()
+        conn.commit()
+    return row
+
+
+def set_job_state(job_key, state):
+    with db_lock:
+        conn = get_connection()
+        conn.execute("UPDATE transcription_jobs SET state = ?, updated_at = ? WHERE job_key = ?",
+                     (state, time.time(), job_key))
+        conn.commit()
+
+
+def set_job_delivered(job_key, segments):
+    with db_lock:
+        conn = get_connection()
+        conn.execute("UPDATE transcription_jobs SET delivered_segments = ?, updated_at = ? WHERE job_key = ?",
+                     (segments, time.time(), job_key))
+        conn.commit()
+
+
+def finish_job(job_key, state, retention):
+    """
+    Sets the final state of a job and forgets its parts, and jobs that finished more than `retention` seconds ago.
+    """
+    now = time.time()
+    with db_lock:
+        conn = get_connection()
+        conn.execute("UPDATE transcription_jobs SET state = ?, updated_at = ? WHERE job_key = ?", (state, now, job_key))
+        conn.execute("DELETE FROM job_parts WHERE job_key = ?", (job_key,))
+        conn.execute("DELETE FROM transcription_jobs WHERE state IN ('delivered', 'failed') AND updated_at < ?",
+                     (now - retention,))
+        conn.commit()
+
+
+def get_unfinished_jobs():
+    """
+    Returns the key, user id and payload of every job that has neither been delivered nor failed, oldest first.
+    """
+    with db_lock:
+        return get_connection().execute(
+            "SELECT job_key, user_id, payload FROM transcription_jobs WHERE state NOT IN ('delivered', 'failed') "
+            "ORDER BY created_at").fetchall()
+
+
+def reserve_job_minutes(job_key, user_id, minutes, day):
+    """
+    Reserves the minutes of a job once: a job that already holds or has spent its reservation keeps it.
+
+    :return: True if the job holds the minutes, False if the allowance does not cover them.
+    """
+    with db_lock:
+        conn = get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            charge = conn.execute("SELECT charge FROM transcription_jobs WHERE job_key = ?", (job_key,)).fetchone()
+            reserved = bool(charge) and charge[0] in ("reserved", "committed")
+            if not reserved and _reserve(conn, user_id, minutes, day):
+                conn.execute("UPDATE transcription_jobs SET charge = 'reserved', reserved_minutes = ?, "
+                             "reservation_day = ? WHERE job_key = ?", (minutes, day, job_key))
+                reserved = True
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return reserved
+
+
+def settle_job_minutes(job_key, charge):
+    """
+    Commits or refunds the job's reservation, in the same transaction that marks it settled,
+    so a job that runs again is never charged or refunded twice.
+
+    :param charge: 'committed' or 'refunded'.
+    """
+    with db_lock:
+        conn = get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT user_id, reserved_minutes, reservation_day FROM transcription_jobs "
+                               "WHERE job_key = ? AND charge = 'reserved'", (job_key,)).fetchone()
+            if row is not None:
+                (_commit if charge == "committed" else _refund)(conn, *row)
+                conn.execute("UPDATE transcription_jobs SET charge = ? WHERE job_key = ?", (charge, job_key))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+def get_job_part(job_key, part_start):
+    with db_lock:
+        row = get_connection().execute("SELECT operation_id, segments FROM job_parts WHERE job_key = ? AND part_start = ?",
+                                       (job_key, part_start)).fetchone()
+    return row if row else (None, None)
+
+
+def set_job_part(job_key, part_start, operation_id=None, segments=None):
+    with db_lock:
+        conn = get_connection()
+        conn.execute("INSERT INTO job_parts (job_key, part_start, operation_id, segments) VALUES (?, ?, ?, ?) "
+                     "ON CONFLICT (job_key, part_start) DO UPDATE SET "
+                     "operation_id = COALESCE(excluded.operation_id, operation_id), "
+                     "segments = COALESCE(excluded.segments, segments)",
+                     (job_key, part_start, operation_id, segments))
+        conn.commit()
 
 
 def check_token_in_db(user_id):
-    with db_lock, sqlite3.connect(db_name) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT auth_token FROM users WHERE user_id = ?", (user_id,))
-        token = cursor.fetchone()
+    with db_lock:
+        token = get_connection().execute("SELECT auth_token FROM users WHERE user_id = ?", (user_id,)).fetchone()
 
     return token[0] if token else None
 
 
 def write_token_to_db(user_id, token):
-    with db_lock, sqlite3.connect(db_name) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET auth_token = ? WHERE user_id = ?", (token, user_id))
+    with db_lock:
+        conn = get_connection()
+        conn.execute("UPDATE users SET auth_token = ? WHERE user_id = ?", (token, user_id))
         conn.commit()
 
 
 def add_user_password(user_id, password):
-    with db_lock, sqlite3.connect(db_name) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET userPassword = ? WHERE user_id = ?", (password, user_id))
+    with db_lock:
+        conn = get_connection()
+        conn.execute("UPDATE users SET userPassword = ? WHERE user_id = ?", (password, user_id))
         conn.commit()
 
 
 def get_user_password(user_id):
-    with db_lock, sqlite3.connect(db_name) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT userPassword FROM users WHERE user_id = ?", (user_id,))
-        password = cursor.fetchone()
+    with db_lock:
+        password = get_connection().execute(
+            "SELECT userPassword FROM users WHERE user_id = ?", (user_id,)).fetchone()
 
     return password[0] if password else None
 
 
+def enqueue_media_job(user_id, payload, max_size, max_per_user):
+    """
+    Adds a job to the queue shared by the worker processes.
+
+    :param user_id: The owner of the job, used for fair scheduling.
+    :param payload: The serialised message the job is about.
+    :return: The 1-based position of the job among the queued and running jobs.
+    :raises QueueFullException: If the queue or the user's share of it is full.
+    """
+    with db_lock:
+        conn = get_connection()
+        # Take the write lock up front so the size check and the insert are atomic across processes.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            waiting, user_waiting = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(user_id = ?), 0) FROM media_jobs WHERE status = 'pending'",
+                (user_id,)).fetchone()
+            if waiting >= max_size:
+                raise QueueFullException("Queue is full", position=waiting)
+            if user_waiting >= max_per_user:
+                raise QueueFullException("Too many jobs for user", position=user_waiting)
+            job_id = conn.execute("INSERT INTO media_jobs (user_id, payload, created_at) VALUES (?, ?, ?)",
+                                  (user_id, payload, time.time())).lastrowid
+            position = conn.execute("SELECT COUNT(*) FROM media_jobs WHERE id <= ?", (job_id,)).fetchone()[0]
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return position
+
+
+def claim_media_job(worker, stale_after):
+    """
+    Marks the next job as running by the worker and returns its id, payload and creation time,
+    or None if the queue is empty.
+    Users with fewer running jobs go first, so one user sending many files cannot starve everyone else.
+
+    :param stale_after: Running jobs whose worker has not renewed its claim for this many seconds
+        are taken over, so the jobs of a worker that died are not lost.
+    """
+    with db_lock:
+        conn = get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            job = conn.execute("""
+                SELECT id, payload, created_at FROM media_jobs AS job
+                WHERE status = 'pending' OR (status = 'running' AND claimed_at < :stale)
+                ORDER BY (SELECT COUNT(*) FROM media_jobs AS running
+                          WHERE running.status = 'running' AND running.user_id = job.user_id), id
+                LIMIT 1
+            """, {"stale": time.time() - stale_after}).fetchone()
+            if job is not None:
+                conn.execute("UPDATE media_jobs SET status = 'running', worker = ?, claimed_at = ? WHERE id = ?",
+                             (worker, time.time(), job[0]))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return job
+
+
+def renew_media_job(job_id, worker):
+    """
+    Tells the other workers that the job is still being worked on.
+    """
+    with db_lock:
+        conn = get_connection()
+        conn.execute("UPDATE media_jobs SET claimed_at = ? WHERE id = ? AND worker = ?", (time.time(), job_id, worker))
+        conn.commit()
+
+
+def finish_media_job(job_id, worker):
+    """
+    Removes a job the worker has finished, unless another worker took it over after the claim went stale.
+    """
+    with db_lock:
+        conn = get_connection()
+        conn.execute("DELETE FROM media_jobs WHERE id = ? AND worker = ?", (job_id, worker))
+        conn.commit()
+
+
+def release_media_job(job_id, worker):
+    """
+    Puts a job that a stopping worker did not finish back into the queue, unless another worker took it over.
+    """
+    with db_lock:
+        conn = get_connection()
+        conn.execute("UPDATE media_jobs SET status = 'pending', worker = NULL, claimed_at = NULL "
+                     "WHERE id = ? AND worker = ?", (job_id, worker))
+        conn.commit()
+
+
+def acquire_object(key):
+    """
+    Takes a hold on a storage object.
+
+    :return: True if the last holder is deleting the object right now, see `forget_object`.
+    """
+    with db_lock:
+        conn = get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT INTO object_leases (key, holders, updated_at) VALUES (?, 1, ?) "
+                         "ON CONFLICT (key) DO UPDATE SET holders = holders + 1, updated_at = excluded.updated_at",
+                         (key, time.time()))
+            deleting = conn.execute("SELECT deleting FROM object_leases WHERE key = ?", (key,)).fetchone()[0]
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return bool(deleting)
+
+
+def release_object(key):
+    """
+    Drops a hold on a storage object.
+
+    :return: True if it was the last one: the caller deletes the object, then calls `forget_object`.
+    """
+    with db_lock:
+        conn = get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("UPDATE object_leases SET holders = MAX(holders - 1, 0), updated_at = ? WHERE key = ?",
+                         (time.time(), key))
+            row = conn.execute("SELECT holders FROM object_leases WHERE key = ?", (key,)).fetchone()
+            last = row is None or row[0] == 0
+            if last:
+                conn.execute("UPDATE object_leases SET deleting = 1 WHERE key = ?", (key,))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return last
+
+
+def forget_object(key):
+    """
+    Ends the deletion of a storage object. A job that took a hold on it meanwhile keeps its lease
+    and uploads the object again.
+    """
+    with db_lock:
+        conn = get_connection()
+        conn.execute("DELETE FROM object_leases WHERE key = ? AND holders = 0", (key,))
+        conn.execute("UPDATE object_leases SET deleting = 0 WHERE key = ?", (key,))
+        conn.commit()
+
+
+def is_object_deleting(key):
+    with db_lock:
+        row = get_connection().execute("SELECT deleting FROM object_leases WHERE key = ?", (key,)).fetchone()
+    return bool(row and row[0])
+
+
+def get_leased_objects(since):
+    """
+    Returns the keys of the storage objects held by a job, leaving out holds not renewed since `since`,
+    which belonged to a process that died.
+    """
+    with db_lock:
+        rows = get_connection().execute("SELECT key FROM object_leases WHERE holders > 0 AND updated_at > ?",
+                                        (since,)).fetchall()
+    return {row[0] for row in rows}
+
+
+def get_fsm_record(storage_key):
+    with db_lock:
+        row = get_connection().execute(
+            "SELECT state, data FROM fsm_states WHERE storage_key = ?", (storage_key,)).fetchone()
+
+    return row if row else (None, None)
+
+
+def set_fsm_state(storage_key, state):
+    with db_lock:
+        conn = get_connection()
+        conn.execute("INSERT INTO fsm_states (storage_key, state) VALUES (?, ?) "
+                     "ON CONFLICT(storage_key) DO UPDATE SET state = excluded.state", (storage_key, state))
+        conn.commit()
+
+
+def set_fsm_data(storage_key, data):
+    with db_lock:
+        conn = get_connection()
+        conn.execute("INSERT INTO fsm_states (storage_key, data) VALUES (?, ?) "
+                     "ON CONFLICT(storage_key) DO UPDATE SET data = excluded.data", (storage_key, data))
+        conn.commit()
+
+
+async def async_get_user_profile(user_id):
+    return await run(get_user_profile, user_id)
+
+
+async def async_add_user(user_id, email):
+    await run(add_user, user_id, email)
+
+
+async def async_get_user_email(user_id):
+    return await run(get_user_email, user_id)
+
+
+async def async_check_user_in_db(user_id):
+    return await run(check_user_in_db, user_id)
+
+
+async def async_update_minutes(user_id, max_minutes=None, used_minutes=None):
+    await run(update_minutes, user_id, max_minutes, used_minutes)
+
+
+async def async_get_user_minutes(user_id, day=None):
+    return await run(get_user_minutes, user_id, day)
+
+
+async def async_reserve_minutes(user_id, minutes, day):
+    return await run(reserve_minutes, user_id, minutes, day)
+
+
+async def async_commit_minutes(user_id, minutes, day):
+    await run(commit_minutes, user_id, minutes, day)
+
+
+async def async_refund_minutes(user_id, minutes, day):
+    await run(refund_minutes, user_id, minutes, day)
+
+
+async def async_create_job(job_key, user_id, payload, state):
+    return await run(create_job, job_key, user_id, payload, state)
+
+
+async def async_set_job_state(job_key, state):
+    await run(set_job_state, job_key, state)
+
+
+async def async_set_job_delivered(job_key, segments):
+    await run(set_job_delivered, job_key, segments)
+
+
+async def async_finish_job(job_key, state, retention):
+    await run(finish_job, job_key, state, retention)
+
+
+async def async_get_unfinished_jobs():
+    return await run(get_unfinished_jobs)
+
+
+async def async_reserve_job_minutes(job_key, user_id, minutes, day):
+    return await run(reserve_job_minutes, job_key, user_id, minutes, day)
+
+
+async def async_settle_job_minutes(job_key, charge):
+    await run(settle_job_minutes, job_key, charge)
+
+
+async def async_get_job_part(job_key, part_start):
+    return await run(get_job_part, job_key, part_start)
+
+
+async def async_set_job_part(job_key, part_start, operation_id=None, segments=None):
+    await run(set_job_part, job_key, part_start, operation_id, segments)
+
+
+async def async_check_token_in_db(user_id):
+    return await run(check_token_in_db, user_id)
+
+
+async def async_write_token_to_db(user_id, token):
+    await run(write_token_to_db, user_id, token)
+
+
+async def async_add_user_password(user_id, password):
+    await run(add_user_password, user_id, password)
+
+
+async def async_get_user_password(user_id):
+    return await run(get_user_password, user_id)
+
+
+async def async_enqueue_media_job(user_id, payload, max_size, max_per_user):
+    return await run(enqueue_media_job, user_id, payload, max_size, max_per_user)
+
+
+async def async_claim_media_job(worker, stale_after):
+    return await run(claim_media_job, worker, stale_after)
+
+
+async def async_renew_media_job(job_id, worker):
+    await run(renew_media_job, job_id, worker)
+
+
+async def async_finish_media_job(job_id, worker):
+    await run(finish_media_job, job_id, worker)
+
+
+async def async_release_media_job(job_id, worker):
+    await run(release_media_job, job_id, worker)
+
+
+async def async_acquire_object(key):
+    return await run(acquire_object, key)
+
+
+async def async_release_object(key):
+    return await run(release_object, key)
+
+
+async def async_forget_object(key):
+    await run(forget_object, key)
+
+
+async def async_is_object_deleting(key):
+    return await run(is_object_deleting, key)
+
+
+async def async_get_fsm_record(storage_key):
+    return await run(get_fsm_record, storage_key)
+
+
+async def async_set_fsm_state(storage_key, state):
+    await run(set_fsm_state, storage_key, state)
+
+
+async def async_set_fsm_data(storage_key, data):
+    await run(set_fsm_data, storage_key, data)
+
+
 if __name__ == '__main__':
     create_database()
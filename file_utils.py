@@ -5,73 +5,433 @@ import time
 from contextlib import asynccontextmanager
 
 import aiofiles
-from aiogram.types import BufferedInputFile
-from moviepy.audio.io.AudioFileClip import AudioFileClip
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import BufferedInputFile, InputMediaDocument
 
+import admission
+import jobs
+import media_pipeline
+import metering
+import metrics
+import object_storage
+import telegram_sender
+import transcript
+import transcript_cache
+import transcript_index
+import transcript_store
+import transcoder
+import yandex_requests
+from asr_router import AudioSource, router
+from audio_splitter import SEGMENT_MAX_SECONDS, transcribe_chunked
 from custom_exceptions import ASRException
+from job_queue import stage
+from single_flight import SingleFlight
 
 import logging
 
-from openai_requests import send_request
-from yandex_requests import get_text_from_audio
 logger = logging.getLogger(__name__)
 
+# Telegram throttles edits of the same message; groups get a stricter budget than private chats.
+EDIT_INTERVAL = float(os.getenv("EDIT_INTERVAL", "1.5"))
+GROUP_EDIT_INTERVAL = float(os.getenv("GROUP_EDIT_INTERVAL", "3"))
+
+# Transcriptions running now, by Telegram file_unique_id, so a file forwarded to several chats is transcribed once.
+transcriptions = SingleFlight("media")
+
 
 async def send_or_split_message(message, text):
+    """
+    Replies with the text and attaches it as a file. Text short enough for a caption goes with the file
+    in one message.
+    """
     text_file = BufferedInputFile(bytes(text, 'utf-8'), filename="file.txt")
-    if len(text) > 4096:
-        for i in range(0, len(text), 4096):
-            text_chunk = text[i:i + 4096]
-            await message.answer(text_chunk, reply_to_message_id=message.message_id)
+    if fits_caption(text):
+        await message.answer_document(text_file, caption=text, parse_mode=None, reply_to_message_id=message.message_id)
+        return
+    await send_chunks(message, transcript.split_message(text))
+    await message.answer_document(text_file, reply_to_message_id=message.message_id)
+
+
+def fits_caption(text):
+    return 0 < transcript.telegram_length(text.strip()) <= transcript.TELEGRAM_CAPTION_LIMIT
+
+
+async def send_chunks(message, chunks):
+    """
+    Sends the chunks as plain-text replies, so that characters like < in a transcript are not read as markup.
+    """
+    for chunk in chunks:
+        await message.answer(chunk, reply_to_message_id=message.message_id, parse_mode=None)
+
+
+async def send_transcript_files(message, segments, caption=None):
+    """
+    Attaches the transcript as .txt and, when the backend reported times, as .srt subtitles in one album.
+
+    :param caption: Text to show under the .txt file.
+    """
+    text = transcript.to_text(segments)
+    text_file = BufferedInputFile(text.encode('utf-8'), filename="transcript.txt")
+    subtitles = transcript.to_srt(segments)
+    if not subtitles:
+        sent = [await message.answer_document(text_file, caption=caption, parse_mode=None,
+                                              reply_to_message_id=message.message_id)]
     else:
-        await message.answer(text, reply_to_message_id=message.message_id)
+        subtitles_file = BufferedInputFile(subtitles.encode('utf-8'), filename="transcript.srt")
+        sent = await message.answer_media_group([InputMediaDocument(media=text_file, caption=caption, parse_mode=None),
+                                                 InputMediaDocument(media=subtitles_file)],
+                                                reply_to_message_id=message.message_id)
+    # Questions asked in reply to either file are about the transcript.
+    await transcript_store.async_put_documents(message.chat.id, [document.message_id for document in sent], text)
+    return sent
+
+
+class TranscriptDelivery:
+    """
+    Sends a transcript to the chat as it is recognised. Segments are batched until they fill a message
+    and go out in order, cut on sentence boundaries; `finish` sends the rest and the attachments.
+
+    How many segments were sent is recorded for the job, so a job resumed after a restart,
+    which gets its stored parts again, does not send them to the chat a second time.
+    """
+
+    def __init__(self, message, job_key=None, delivered=0):
+        """
+        :param job_key: The job to record the progress for.
+        :param delivered: How many segments of the transcript the job sent before it was resumed.
+        """
+        self.message = message
+        self.job_key = job_key
+        self.delivered = delivered
+        self.received = 0
+        self.pending = []
+        self.lock = asyncio.Lock()
+
+    async def add(self, segments):
+        async with self.lock:
+            skip = min(len(segments), max(0, self.delivered - self.received))
+            self.received += len(segments)
+            self.pending += segments[skip:]
+            # Only long recordings arrive in parts, so their messages always carry timestamps.
+            text = transcript.to_text(self.pending, timestamps=True)
+            if transcript.telegram_length(text) < transcript.TELEGRAM_MESSAGE_LIMIT:
+                return
+            await send_chunks(self.message, transcript.split_message(text))
+            self.pending = []
+            await self._record(self.received)
+
+    async def finish(self, segments):
+        """
+        :param segments: The whole transcript.
+        :return: The messages with the attachments.
+        """
+        async with self.lock:
+            if not self.delivered:
+                text = transcript.to_text(segments)
+            else:
+                text = transcript.to_text(segments[self.delivered:], timestamps=True)
+            self.pending = []
+            if fits_caption(text):
+                # One message instead of two.
+                return await send_transcript_files(self.message, segments, caption=text)
+            await send_chunks(self.message, transcript.split_message(text))
+            await self._record(len(segments))
+            return await send_transcript_files(self.message, segments)
+
+    async def _record(self, delivered):
+        self.delivered = delivered
+        if self.job_key is not None:
+            await jobs.record_delivery(self.job_key, delivered)
+
+
+async def stream_answer(message, texts):
+    """
+    Shows an answer while it is being generated by editing one reply as the text grows,
+    then finishes it the way send_or_split_message does.
+
+    :param message: The message to answer.
+    :param texts: An async iterator yielding the whole text generated so far.
+    :return: The final text.
+    """
+    interval = GROUP_EDIT_INTERVAL if message.chat.id < 0 else EDIT_INTERVAL
+    reply = None
+    shown = ""
+    last_edit = 0.0
+    text = ""
+    async for text in texts:
+        if not text.strip() or (reply is not None and time.monotonic() - last_edit < interval):
+            continue
+        preview = text
+        if transcript.telegram_length(text) > transcript.TELEGRAM_MESSAGE_LIMIT:
+            preview = transcript.split_message(text, transcript.TELEGRAM_MESSAGE_LIMIT - 1)[0] + "…"
+        if reply is None:
+            reply = await message.answer(preview, reply_to_message_id=message.message_id, parse_mode=None)
+        else:
+            await _edit_text(reply, preview)
+        shown = preview
+        last_edit = time.monotonic()
+
+    if reply is None:
+        await send_or_split_message(message, text)
+        return text
+
+    chunks = transcript.split_message(text)
+    if chunks[0] != shown:
+        await _edit_text(reply, chunks[0], final=True)
+    await send_chunks(message, chunks[1:])
+    text_file = BufferedInputFile(bytes(text, 'utf-8'), filename="file.txt")
     await message.answer_document(text_file, reply_to_message_id=message.message_id)
+    return text
+
+
+async def _edit_text(reply, text, final=False):
+    try:
+        with telegram_sender.priority(telegram_sender.REPLY if final else telegram_sender.PREVIEW):
+            await reply.edit_text(text, parse_mode=None)
+    except TelegramRetryAfter:
+        if final:
+            raise
+        # Skip this frame, a later edit will catch up.
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
 
 
 @asynccontextmanager
-async def temporary_audio_file(source_path: str, target_format: str = '.mp3'):
-    with tempfile.NamedTemporaryFile(suffix=target_format, delete=False) as tmp:
-        try:
-            await asyncio.to_thread(write_audio_file, source_path, tmp.name)
-            yield tmp.name
-        finally:
-            tmp.close()
-            time.sleep(1)
-            if not os.path.isfile(tmp.name) or not is_file_locked(tmp.name):
-                os.remove(tmp.name)
+async def temporary_file(suffix=''):
+    """
+    Yields the path of a new temporary file and always removes it afterwards.
+    """
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        yield path
+    finally:
+        remove_file(path)
 
 
-def write_audio_file(source_path, target_path):
-    audio = AudioFileClip(source_path)
-    audio.write_audiofile(target_path, codec="libmp3lame", bitrate="192k")
-    audio.close()
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
 
-def is_file_locked(filepath):
-    locked = False
-    if os.path.exists(filepath):
-        try:
-            os.rename(filepath, filepath)
-        except OSError:
-            locked = True
-    return locked
+@asynccontextmanager
+async def temporary_audio_file(source_path: str, media=None):
+    """
+    Yields the path and ASR encoding of an audio file made from the source.
+
+    Sources the ASR already accepts are passed through untouched, everything else is converted by the transcoder.
+    """
+    encoding = transcoder.native_encoding(media)
+    if encoding:
+        yield source_path, encoding
+        return
+
+    async with temporary_file(transcoder.TARGET_SUFFIX) as target_path:
+        encoding = await transcoder.transcode(source_path, target_path, media)
+        yield target_path, encoding
 
 
-async def process_media_file(bot, message, media):
+def can_stream(media):
     """
-    Downloads a media file, processes it (including conversion if necessary), and sends the result.
+    Tells whether the media can go from the Telegram download straight to the ASR without touching the disk.
+
+    Recordings that need splitting, have no known duration, or whose container cannot be read from a pipe
+    take the temporary file path instead.
+    """
+    duration = getattr(media, "duration", None)
+    if not duration or transcoder.needs_seekable_input(media):
+        return False
+    return duration <= SEGMENT_MAX_SECONDS
+
+
+async def process_media_file(bot, message, media, seconds=None):
+    """
+    Downloads a media file, processes it (including conversion if necessary), and sends the transcript
+    as it is recognised, then as .txt and .srt files. The minutes of the recording are reserved before any work starts and charged once the transcript is ready,
+    or refunded when the same audio was transcribed before.
+    When the same file is already being transcribed for another message, this waits for that transcript
+    instead of doing the work again; every requester is still charged, as with separate jobs.
+
+    Each stage of the job is recorded under jobs.job_key(message). A job stopped by a shutdown keeps its
+    reservation and is resumed on the next start; a job that was already answered is not answered again.
 
     :param bot: The bot instance for downloading the file.
     :param message: The message instance from which to respond.
     :param media: The media to download.
+    :param seconds: The duration found at admission, saves probing the media again.
+    """
+    job_key = jobs.job_key(message)
+    state, delivered = await jobs.create(message)
+    if state == jobs.DELIVERED:
+        logger.info(f"Job {job_key} was already delivered")
+        return
+    delivery = TranscriptDelivery(message, job_key, delivered)
+    with jobs.running(job_key):
+        try:
+            segments = await deliver_media_file(bot, message, media, seconds, delivery)
+        except Exception:
+            await jobs.finish(job_key, jobs.FAILED)
+            raise
+    if segments is not None:
+        # Index now so the first question about a long transcript does not pay for it.
+        await transcript_index.async_index_transcript(transcript.to_text(segments))
+
+
+async def deliver_media_file(bot, message, media, seconds, delivery):
+    """
+    :return: The transcript, None when it came from the cache.
+    """
+    file_unique_id = getattr(media, "file_unique_id", None)
+    job_key = delivery.job_key
+    segments = await transcript_cache.async_get_transcript(file_unique_id=file_unique_id)
+    if segments is not None:
+        logger.info(f"Transcript cache hit for file {file_unique_id}")
+        # A job resumed after its transcript was stored still pays the minutes it reserved.
+        await metering.commit_job(job_key)
+        with metrics.stage_seconds.time(stage="reply"):
+            await delivery.finish(segments)
+        await jobs.finish(job_key, jobs.DELIVERED)
+        return None
+
+    if seconds is None:
+        seconds = await metering.probe_seconds(bot, media)
+    reservation = await metering.reserve(message.from_user.id, seconds, job_key)
+    started = time.monotonic()
+    try:
+        # Messages that join a running transcription get the whole transcript once it is done.
+        segments, cached = await transcriptions.run(file_unique_id, transcribe_media_file, bot, media, delivery.add)
+    except Exception:
+        # A cancelled job keeps its reservation to be resumed with.
+        await metering.refund(reservation)
+        raise
+    if cached:
+        # The same audio was transcribed before, under another file id; it is not charged again.
+        await metering.refund(reservation)
+    else:
+        await metering.commit(reservation)
+        admission.history.record(seconds, time.monotonic() - started)
+    await jobs.advance(jobs.DONE)
+    with metrics.stage_seconds.time(stage="reply"):
+        await delivery.finish(segments)
+    await jobs.finish(job_key, jobs.DELIVERED)
+    return segments
+
+
+async def transcribe_media_file(bot, media, on_ready=None):
+    """
+    :param on_ready: Called with the next segments of the transcript as parts of a long recording are recognised.
+    :return: The list of transcript.Segment, and whether it came from the transcript cache.
+    """
+    metrics.bytes_processed.inc(getattr(media, "file_size", None) or 0, direction="download")
+    if can_stream(media):
+        return await stream_media_file(bot, media)
+    return await download_media_file(bot, media, on_ready)
+
+
+async def stream_media_file(bot, media):
+    """
+    Pipes the Telegram download through the transcoder into object storage, or into memory when the
+    backend the router prefers takes the audio in the request body. Uploads hold at most a few parts
+    in memory whatever the file size.
     """
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-        await bot.download(media, destination=temp_file.name)
+    file_unique_id = getattr(media, "file_unique_id", None)
+    encoding = transcoder.native_encoding(media)
+    profile = "source"
+    chunks = media_pipeline.stream_media(bot, media)
+    if encoding is None:
+        chunks = transcoder.transcode_stream(chunks)
+        encoding = transcoder.TARGET_ENCODING
+        profile = transcoder.TARGET_PROFILE
+    suffix = transcoder.ENCODING_SUFFIXES[encoding]
+    audio = media_pipeline.HashingStream(chunks)
+    backend = router.choose(encoding, media.duration)[0]
+
+    async with stage("download"):
+        if backend.needs_object:
+            key = await object_storage.upload_stream(audio, object_storage.source_key(file_unique_id, profile, suffix))
+            source = AudioSource(encoding, media.duration, key=key, size=audio.size)
+        else:
+            content = await media_pipeline.collect(audio, backend.max_bytes)
+            source = AudioSource(encoding, media.duration, content=content)
+    await jobs.advance(jobs.UPLOADED if backend.needs_object else jobs.DOWNLOADED)
+
+    try:
+        content_hash = audio.hexdigest()
+        segments = await transcript_cache.async_get_transcript(content_hash=content_hash)
+        cached = segments is not None
+        if cached:
+            logger.info(f"Transcript cache hit for audio {content_hash}")
+        else:
+            async with stage("asr"):
+                segments = await recognize_source(source)
+    finally:
+        await source.release()
+    await transcript_cache.async_put_transcript(file_unique_id, content_hash, segments)
+    return segments, cached
+
+
+async def download_media_file(bot, media, on_ready=None):
+    """
+    Fallback for media that cannot be streamed: downloads it to a temporary file that is always removed.
+    """
+    file_unique_id = getattr(media, "file_unique_id", None)
+    async with temporary_file() as source_path:
+        async with stage("download"):
+            await bot.download(media, destination=source_path)
+        await jobs.advance(jobs.DOWNLOADED)
+
+        async with temporary_audio_file(source_path, media) as (audio_path, encoding):
+            content_hash = await transcript_cache.async_file_sha256(audio_path)
+            segments = await transcript_cache.async_get_transcript(content_hash=content_hash)
+            cached = segments is not None
+            if cached:
+                logger.info(f"Transcript cache hit for audio {content_hash}")
+            else:
+                async with stage("asr"):
+                    segments = await recognize_audio(audio_path, encoding, getattr(media, "duration", None), on_ready)
+    await transcript_cache.async_put_transcript(file_unique_id, content_hash, segments)
+    return segments, cached
+
 
-        # Process the downloaded file
-        async with temporary_audio_file(temp_file.name) as temp_audio_path:
-            text = await get_text_from_audio(temp_audio_path)
-            await send_or_split_message(message, text)
+async def recognize_audio(path, encoding, duration=None, on_ready=None):
+    """
+    Recognises the audio, splitting long recordings into segments that are recognised in parallel.
+    The router picks the backend for each segment separately, so short tails can take the fast path.
+    """
+    async def recognize_segment(segment_path, segment_encoding, seconds):
+        source = AudioSource(segment_encoding, seconds, path=segment_path)
+        try:
+            return await recognize_source(source)
+        finally:
+            await source.release()
+
+    return await transcribe_chunked(path, encoding, recognize_segment, max_bytes=router.segment_max_bytes(),
+                                    duration=duration, on_ready=on_ready)
+
+
+async def recognize_source(source):
+    """
+    Recognises the source with the backend the router picks. A resumed job reuses what it stored for this part
+    of the recording before it stopped: the transcript, or the recognition operation it was waiting for,
+    so the same audio is not paid for twice.
+    """
+    operation_id, segments = await jobs.stored_part()
+    if segments is not None:
+        logger.info("Reused the transcript of a part recognised before the restart")
+        return segments
+    if operation_id is not None:
+        try:
+            segments = await yandex_requests.wait_operation(operation_id, source.seconds)
+            logger.info(f"Resumed recognition operation {operation_id}")
+        except ASRException as e:
+            logger.warning(f"Could not resume recognition operation {operation_id}: {e}")
+    if segments is None:
+        segments = await router.recognize(source)
+    await jobs.save_part(segments)
+    return segments
 
 
 async def read_file_content(file_path):
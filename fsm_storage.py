@@ -0,0 +1,34 @@
+import json
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+import db
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage kept in users.db, so the state of a conversation survives restarts
+    and every process serving the bot sees the same state for a user.
+    """
+
+    @staticmethod
+    def _key(key):
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    async def set_state(self, key, state=None):
+        await db.async_set_fsm_state(self._key(key), state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key):
+        state, _ = await db.async_get_fsm_record(self._key(key))
+        return state
+
+    async def set_data(self, key, data):
+        await db.async_set_fsm_data(self._key(key), json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key):
+        _, data = await db.async_get_fsm_record(self._key(key))
+        return json.loads(data) if data else {}
+
+    async def close(self):
+        pass
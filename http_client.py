@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import os
+import random
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Per-service timeouts: (connect, read). Long-running ASR uploads need a long read timeout, API calls do not.
+SERVICE_TIMEOUTS = {
+    "yandex_llm": httpx.Timeout(60.0, connect=5.0),
+    "yandex_stt": httpx.Timeout(30.0, connect=5.0),
+    "yandex_stt_sync": httpx.Timeout(30.0, connect=5.0),
+    "yandex_operation": httpx.Timeout(15.0, connect=5.0),
+    "yandex_storage": httpx.Timeout(60.0, connect=5.0),
+    "openai_whisper": httpx.Timeout(float(os.getenv("WHISPER_TIMEOUT", "300")), connect=5.0),
+    "pay_fait": httpx.Timeout(15.0, connect=5.0),
+}
+DEFAULT_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+# A request that failed with these never reached the server, and a 429 was refused before it was acted on.
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+UNSENT_STATUS_CODES = {429}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 10.0
+
+_client = None
+_stats = defaultdict(lambda: {"requests": 0, "connections": 0, "tls_handshakes": 0, "retries": 0})
+
+
+def start(transport=None):
+    """
+    Creates the shared client. Called once by main() before the bot starts handling updates.
+
+    :param transport: An httpx transport to send the requests through instead of the network,
+        e.g. the local service fakes of the benchmark.
+    """
+    global _client
+    if _client is not None:
+        return _client
+    _client = httpx.AsyncClient(
+        http2=True,
+        timeout=DEFAULT_TIMEOUT,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+        transport=transport,
+    )
+    return _client
+
+
+async def close():
+    global _client
+    if _client is None:
+        return
+    await _client.aclose()
+    _client = None
+    log_stats()
+
+
+def get_client():
+    if _client is None:
+        raise RuntimeError("HTTP client is not started, call http_client.start() first")
+    return _client
+
+
+def get_stats():
+    """
+    Returns request and connection counters per host. `reused` is the number of requests that
+    went over an already open connection and so skipped the TCP and TLS handshakes.
+    """
+    return {
+        host: {**counters, "reused": max(counters["requests"] - counters["connections"], 0)}
+        for host, counters in _stats.items()
+    }
+
+
+def log_stats():
+    for host, counters in get_stats().items():
+        logger.info(f"HTTP {host}: {counters['requests']} requests, {counters['connections']} connections, "
+                    f"{counters['reused']} reused, {counters['retries']} retries")
+
+
+def _tracer(host):
+    async def trace(event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            _stats[host]["connections"] += 1
+        elif event_name == "connection.start_tls.complete":
+            _stats[host]["tls_handshakes"] += 1
+    return trace
+
+
+def backoff_delay(attempt, response=None):
+    """
+    Returns how long to wait before the next attempt: the server's Retry-After if it sent one,
+    otherwise exponential backoff with full jitter.
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), BACKOFF_CAP)
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def retry_policy(method, idempotent=None):
+    """
+    Returns the exceptions and response statuses a request is retried on.
+
+    Idempotent requests are retried on 429/5xx responses and broken connections. Others, such as the POST
+    that starts a billed recognition, only when the server cannot have acted on them: the connection
+    was never made or the server answered 429. A 502 may come after the server accepted the request.
+
+    :param idempotent: Whether the request may be sent twice; by default, whether its method is idempotent.
+    """
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    if idempotent:
+        return RETRY_ERRORS, RETRY_STATUS_CODES
+    return UNSENT_ERRORS, UNSENT_STATUS_CODES
+
+
+async def request(service, method, url, idempotent=None, **kwargs):
+    """
+    Sends a request through the shared client, retrying failures as `retry_policy` allows.
+
+    :param service: The service name, selects the timeout from SERVICE_TIMEOUTS.
+    :param method: The HTTP method.
+    :param url: The request URL.
+    :param idempotent: Set for a POST that is safe to send twice, e.g. one that only reads.
+    :return: The last response; the caller decides whether its status is an error.
+    """
+    client = get_client()
+    host = httpx.URL(url).host
+    kwargs.setdefault("timeout", SERVICE_TIMEOUTS.get(service, DEFAULT_TIMEOUT))
+    kwargs["extensions"] = {**kwargs.get("extensions", {}), "trace": _tracer(host)}
+    retry_errors, retry_statuses = retry_policy(method, idempotent)
+
+    attempt = 0
+    while True:
+        _stats[host]["requests"] += 1
+        try:
+            response = await client.request(method, url, **kwargs)
+        except retry_errors as exc:
+            if attempt >= MAX_RETRIES:
+                raise
+            logger.warning(f"{service}: {exc!r}, retrying")
+            delay = backoff_delay(attempt)
+        else:
+            if response.status_code not in retry_statuses or attempt >= MAX_RETRIES:
+                return response
+            logger.warning(f"{service}: HTTP {response.status_code}, retrying")
+            delay = backoff_delay(attempt, response)
+
+        attempt += 1
+        _stats[host]["retries"] += 1
+        await asyncio.sleep(delay)
+
+
+@asynccontextmanager
+async def stream(service, method, url, idempotent=None, **kwargs):
+    """
+    Like `request`, but yields a response whose body has not been read yet.
+
+    Retries happen only before the body is handed to the caller, so nothing is ever delivered twice.
+    """
+    client = get_client()
+    host = httpx.URL(url).host
+    kwargs.setdefault("timeout", SERVICE_TIMEOUTS.get(service, DEFAULT_TIMEOUT))
+    kwargs["extensions"] = {**kwargs.get("extensions", {}), "trace": _tracer(host)}
+    retry_errors, retry_statuses = retry_policy(method, idempotent)
+
+    attempt = 0
+    while True:
+        _stats[host]["requests"] += 1
+        try:
+            response = await client.send(client.build_request(method, url, **kwargs), stream=True)
+        except retry_errors as exc:
+            if attempt >= MAX_RETRIES:
+                raise
+            logger.warning(f"{service}: {exc!r}, retrying")
+            delay = backoff_delay(attempt)
+        else:
+            if response.status_code not in retry_statuses or attempt >= MAX_RETRIES:
+                break
+            await response.aclose()
+            logger.warning(f"{service}: HTTP {response.status_code}, retrying")
+            delay = backoff_delay(attempt, response)
+
+        attempt += 1
+        _stats[host]["retries"] += 1
+        await asyncio.sleep(delay)
+
+    try:
+        yield response
+    finally:
+        await response.aclose()
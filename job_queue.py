@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+import metrics
+from custom_exceptions import QueueFullException
+
+logger = logging.getLogger(__name__)
+
+QUEUE_MAX_SIZE = int(os.getenv("QUEUE_MAX_SIZE", "100"))
+QUEUE_MAX_PER_USER = int(os.getenv("QUEUE_MAX_PER_USER", "10"))
+QUEUE_WORKERS = int(os.getenv("QUEUE_WORKERS", "4"))
+
+# How many jobs may be inside each pipeline stage at the same time.
+STAGE_WORKERS = {
+    "download": int(os.getenv("DOWNLOAD_WORKERS", "4")),
+    "transcode": int(os.getenv("TRANSCODE_WORKERS", str(os.cpu_count() or 1))),
+    "asr": int(os.getenv("ASR_WORKERS", "4")),
+}
+
+_stage_semaphores = {}
+
+
+@asynccontextmanager
+async def stage(name):
+    """
+    Limits the number of jobs running the given pipeline stage concurrently.
+
+    :param name: The stage name, one of the keys of STAGE_WORKERS.
+    """
+    semaphore = _stage_semaphores.get(name)
+    if semaphore is None:
+        semaphore = _stage_semaphores[name] = asyncio.Semaphore(STAGE_WORKERS[name])
+    started = time.monotonic()
+    async with semaphore:
+        metrics.stage_wait_seconds.observe(time.monotonic() - started, stage=name)
+        with metrics.stage_seconds.time(stage=name):
+            yield
+
+
+class JobQueue:
+    """
+    Bounded job queue served by a fixed pool of workers.
+
+    Every user has their own FIFO; workers take jobs from the users in round-robin order,
+    so one user sending many files cannot starve everyone else.
+    """
+
+    def __init__(self, max_size=QUEUE_MAX_SIZE, max_per_user=QUEUE_MAX_PER_USER, workers=QUEUE_WORKERS):
+        self.max_size = max_size
+        self.max_per_user = max_per_user
+        self.workers = workers
+        self._queues = OrderedDict()
+        self._size = 0
+        self._busy = 0
+        self._available = None
+        self._tasks = []
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def idle_workers(self):
+        return len(self._tasks) - self._busy
+
+    def start(self):
+        self._available = asyncio.Semaphore(self._size)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Started job queue with {self.workers} workers")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, user_id, job):
+        """
+        Puts a job into the queue.
+
+        :param user_id: The owner of the job, used for fair scheduling.
+        :param job: A coroutine function without arguments.
+        :return: The 1-based position of the job among the waiting jobs.
+        :raises QueueFullException: If the queue or the user's share of it is full.
+        """
+        user_queue = self._queues.get(user_id)
+        if self._size >= self.max_size:
+            raise QueueFullException("Queue is full", position=self._size)
+        if user_queue is not None and len(user_queue) >= self.max_per_user:
+            raise QueueFullException("Too many jobs for user", position=len(user_queue))
+
+        if user_queue is None:
+            user_queue = self._queues[user_id] = deque()
+        user_queue.append((job, time.monotonic()))
+        self._size += 1
+        metrics.queue_depth.set(self._size)
+        position = self.position(user_id, len(user_queue) - 1)
+        if self._available is not None:
+            self._available.release()
+        return position
+
+    def position(self, user_id, index):
+        """
+        Returns how many jobs will be dispatched before the user's job at `index`, plus one.
+        """
+        position = 1
+        before = True
+        for other_id, other_queue in self._queues.items():
+            if other_id == user_id:
+                before = False
+                position += index
+                continue
+            position += min(len(other_queue), index + 1 if before else index)
+        return position
+
+    def _pop(self):
+        user_id, user_queue = next(iter(self._queues.items()))
+        job, queued_at = user_queue.popleft()
+        if user_queue:
+            self._queues.move_to_end(user_id)
+        else:
+            del self._queues[user_id]
+        self._size -= 1
+        metrics.queue_depth.set(self._size)
+        metrics.queue_wait_seconds.observe(time.monotonic() - queued_at)
+        return job
+
+    async def _worker(self, number):
+        while True:
+            await self._available.acquire()
+            job = self._pop()
+            self._busy += 1
+            try:
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job failed in worker {number}: {e}")
+            finally:
+                self._busy -= 1
@@ -0,0 +1,116 @@
+import contextvars
+import os
+from contextlib import contextmanager
+
+import db
+import transcript
+
+# Finished jobs are kept this long, so a message Telegram delivers again is not transcribed twice.
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+
+# The stages of a media job, in order; jobs in any but the last two are resumed on the next start.
+QUEUED = "queued"
+DOWNLOADED = "downloaded"
+UPLOADED = "uploaded"
+RECOGNIZING = "recognizing"
+DONE = "done"
+DELIVERED = "delivered"
+FAILED = "failed"
+
+# The job the current task works on, and the start in seconds of the part of its recording being recognised.
+_current = contextvars.ContextVar("media_job", default=None)
+_part = contextvars.ContextVar("media_job_part", default=0.0)
+
+
+def job_key(message):
+    """
+    Returns the idempotency key of the job for a media message: a message is transcribed, charged
+    and answered once, however many times it is queued.
+    """
+    return f"{message.chat.id}:{message.message_id}"
+
+
+async def create(message):
+    """
+    Records the job for the message unless it is already known.
+
+    :return: The state of the job and how many segments of its transcript are in the chat already.
+    """
+    return await db.async_create_job(job_key(message), message.from_user.id,
+                                     message.model_dump_json(exclude_none=True, by_alias=True), QUEUED)
+
+
+async def unfinished():
+    """
+    :return: A list of (job key, user id, message JSON) of the jobs that were queued or running when the bot stopped.
+    """
+    return await db.async_get_unfinished_jobs()
+
+
+@contextmanager
+def running(key):
+    """
+    Makes the job the one the stages and recognition operations in the block are recorded for.
+    """
+    token = _current.set(key)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def part(start):
+    """
+    Records the recognition in the block for the part of the recording starting at `start` seconds.
+    """
+    token = _part.set(start)
+    try:
+        yield
+    finally:
+        _part.reset(token)
+
+
+async def advance(state):
+    key = _current.get()
+    if key is not None:
+        await db.async_set_job_state(key, state)
+
+
+async def record_delivery(key, segments):
+    """
+    Records that the first `segments` segments of the job's transcript were sent, so a resumed job skips them.
+    """
+    await db.async_set_job_delivered(key, segments)
+
+
+async def finish(key, state):
+    await db.async_finish_job(key, state, JOB_RETENTION_SECONDS)
+
+
+async def record_operation(operation_id):
+    """
+    Stores the id of the long-running recognition started for the current part, to wait for it
+    instead of starting another one when the job is resumed.
+    """
+    key = _current.get()
+    if key is not None:
+        await db.async_set_job_part(key, _part.get(), operation_id=operation_id)
+        await db.async_set_job_state(key, RECOGNIZING)
+
+
+async def stored_part():
+    """
+    :return: The (operation id, list of transcript.Segment) stored for the current part, either of them None.
+    """
+    key = _current.get()
+    if key is None:
+        return None, None
+    operation_id, segments = await db.async_get_job_part(key, _part.get())
+    return operation_id, None if segments is None else transcript.loads(segments)
+
+
+async def save_part(segments):
+    key = _current.get()
+    if key is not None:
+        await db.async_set_job_part(key, _part.get(), segments=transcript.dumps(segments))
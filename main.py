@@ -1,12 +1,17 @@
+import time
+
+# Taken before the other imports, so the startup profile includes them.
+PROCESS_STARTED = time.perf_counter()
+
 import asyncio
 import logging
+import math
+import multiprocessing
 import os
+import signal
 import sys
-import tempfile
 from typing import Any
 
-import aiofiles
-import openai
 from aiogram import Bot, Dispatcher, Router
 from aiogram.enums import ParseMode
 from aiogram.filters import Command
@@ -17,22 +22,61 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from dotenv import load_dotenv
 
 import Filters as ContentTypesFilter
+import admission
+import cache_db
+import completion_cache
 import db
+import http_client
+import jobs
+import metering
+import metrics
+import object_storage
 import openai_requests
+import telegram_sender
+import transcript_index
+import transcript_store
 import yandex_requests
-from Pay_Fait import auth_and_check_goods
-from file_utils import process_media_file, send_or_split_message
+from Pay_Fait import auth_and_check_goods, goods_of
+from custom_exceptions import MediaRejectedException, QueueFullException, QuotaExceededException
+from file_utils import process_media_file, send_or_split_message, stream_answer
+from fsm_storage import SQLiteStorage
+from job_queue import QUEUE_WORKERS, JobQueue
+from operation_poller import poller
 
 load_dotenv()
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s',
+                    force=True)
+for handler in logging.getLogger().handlers:
+    handler.addFilter(metrics.TraceIdFilter())
 logger = logging.getLogger(__name__)
 logging.getLogger("httpx").setLevel(logging.WARNING)
-openai.api_type = "azure"
-openai.api_key = os.getenv('OPENAI_API_KEY')
-openai.api_base = "https://deep-azure.openai.azure.com/"
-openai.api_version = "2023-06-01-preview"
 
-BIG_FILE_LOG = "file is too big"
+MEDIA_TOO_BIG_LOG = "Файл слишком большой: бот может скачать файлы до {limit} МБ."
+MEDIA_TOO_LONG_LOG = "Запись слишком длинная: бот расшифровывает записи до {limit} мин."
+QUEUED_LOG = "Файл добавлен в очередь, место в очереди: {position}"
+ETA_LOG = "Примерное время обработки: {eta}"
+# Shorter jobs are not announced, their transcript arrives about as fast as the notice would.
+ETA_NOTICE_SECONDS = float(os.getenv("ETA_NOTICE_SECONDS", "30"))
+QUEUE_FULL_LOG = "Очередь переполнена, попробуйте отправить файл позже."
+NOT_ENTITLED_LOG = "Не удалось проверить подписку. Проверьте email и пароль или оформите тариф: /buy"
+QUOTA_EXCEEDED_LOG = "Недостаточно минут на сегодня: для этого файла нужно {minutes} мин. Посмотреть остаток: /balance, тарифы: /buy"
+LLM_BACKEND = os.getenv("LLM_BACKEND", "yandex")
+
+# "polling" or "webhook"; the webhook is served by an aiohttp server on WEBAPP_HOST:WEBAPP_PORT.
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+# With worker processes, media jobs go through the queue table in users.db instead of the in-process queue,
+# and this process only takes updates in.
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "0"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+# Workers renew their claim on a running job this often; a job whose claim is older than JOB_STALE_SECONDS
+# belonged to a worker that died and is taken over by another one.
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "30"))
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", str(4 * JOB_HEARTBEAT_INTERVAL)))
 
 
 class Form(StatesGroup):
@@ -41,14 +85,26 @@ class Form(StatesGroup):
     feedback = State()
 
 
-dp = Dispatcher()
+dp = Dispatcher(storage=SQLiteStorage())
 
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 # Initialize Bot instance with a default parse mode which will be passed to all API calls
 bot = Bot(TOKEN, parse_mode=ParseMode.HTML)
+# Every message the bot sends waits for the flood limits, which the processes sending for it share.
+bot.session.middleware(telegram_sender.ThrottlingMiddleware(telegram_sender.scheduler))
+if WORKER_PROCESSES:
+    telegram_sender.scheduler.share(WORKER_PROCESSES + 1)
 
 router = Router(name=__name__)
 
+IMPORTS_SECONDS = time.perf_counter() - PROCESS_STARTED
+metrics.startup_seconds.set(IMPORTS_SECONDS, phase="import")
+
+media_queue = JobQueue()
+background_tasks = []
+worker_processes = []
+metrics_runners = []
+
 
 @router.message(Command("help"))
 async def handle_help(message: Message) -> Any:
@@ -89,24 +145,27 @@ async def handle_buy_command(message: Message) -> Any:
 @router.message(Command("balance"))
 async def handle_balance_command(message: Message) -> Any:
     user_id = message.from_user.id
-    max_minutes, used_minutes = await db.async_get_user_minutes(user_id)
+    max_minutes, used_minutes = await db.async_get_user_minutes(user_id, metering.today())
     await message.answer(f"Максимум минут: {max_minutes}\nИспользовано минут: {used_minutes}")
 
 
 @router.message(Command("sub"))
 async def handle_sub_command(message: Message) -> Any:
     user_id = message.from_user.id
-    user_email = await db.async_get_user_email(user_id)
-    user_password = db.get_user_password(user_id)
-    response = await auth_and_check_goods(user_id, user_email, user_password)
-    goods = response["data"]["goods"]
-    your_goods = ""
-    for good in goods:
-        your_goods += f"{good['name']}\n"
+    profile = await db.async_get_user_profile(user_id)
+    if profile is None:
+        await message.answer("Please provide your email.")
+        return
+    response = await auth_and_check_goods(user_id, profile.email, profile.password)
+    goods = goods_of(response)
     if goods is None:
+        logger.warning(f"No goods for user {user_id} from Pay Fait: {response}")
+        await message.answer(NOT_ENTITLED_LOG)
         return False
-    else:
-        await message.answer(f"Ваши подписки:\n{your_goods}")
+    your_goods = ""
+    for good in goods:
+        your_goods += f"{good.get('name')}\n"
+    await message.answer(f"Ваши подписки:\n{your_goods}")
 
 
 @router.callback_query()
@@ -132,19 +191,45 @@ async def get_media_from_message(message: Message) -> Any:
     return media
 
 
-async def process_media_message(bot, message: Message, media: Any) -> None:
+def rejection_text(e: MediaRejectedException) -> str:
+    if e.reason == "too_long":
+        return MEDIA_TOO_LONG_LOG.format(limit=round(e.limit / 60))
+    return MEDIA_TOO_BIG_LOG.format(limit=round((e.limit or admission.CLOUD_MAX_DOWNLOAD_BYTES) / 1024 / 1024))
+
+
+def format_eta(seconds: float) -> str:
+    if seconds < 60:
+        return f"~{max(5, round(seconds, -1)):.0f} с"
+    return f"~{math.ceil(seconds / 60)} мин"
+
+
+async def process_media_message(bot, message: Message, media: Any, seconds: float = None) -> None:
     """
-    Processes the given media message.
+    Processes the given media message under a new trace id.
+
+    :param seconds: The duration found at admission, if the message went through it in this process.
     """
-    try:
-        await process_media_file(bot, message, media)
-    except Exception as e:
-        if BIG_FILE_LOG in str(e):
-            await message.answer(BIG_FILE_LOG, reply_to_message_id=message.message_id)
+    trace_id = metrics.new_trace()
+    logger.info(f"Processing media message {message.message_id} from user {message.from_user.id}")
+    started = time.monotonic()
+    outcome = "ok"
+    with metrics.jobs_in_flight.track():
+        try:
+            await process_media_file(bot, message, media, seconds)
+        except QuotaExceededException as e:
+            outcome = "quota"
+            logger.info(e)
+            await message.answer(QUOTA_EXCEEDED_LOG.format(minutes=e.minutes), reply_to_message_id=message.message_id)
+        except MediaRejectedException as e:
+            outcome = "rejected"
+            logger.info(e)
+            await message.answer(rejection_text(e), reply_to_message_id=message.message_id)
+        except Exception as e:
+            outcome = "error"
             logger.error(e)
-        else:
-            logger.error(e)
-        await bot.send_message(chat_id=os.getenv("ERRORS_CHAT_ID"), text=f"Failed to process media message {e}")
+            await telegram_sender.errors.report(f"Failed to process media message {e}", trace_id)
+    metrics.jobs_total.inc(outcome=outcome)
+    metrics.job_seconds.observe(time.monotonic() - started, outcome=outcome)
 
 
 @router.message(ContentTypesFilter.Media())
@@ -155,7 +240,43 @@ async def handle_media(message: Message, state: FSMContext) -> Any:
     if await have_valid_email_and_auth(message, state):
         media = await get_media_from_message(message)
         if media:
-            await process_media_message(bot, message, media)
+            await enqueue_media_message(bot, message, media)
+
+
+async def enqueue_media_message(bot, message: Message, media: Any) -> None:
+    """
+    Checks the media against the limits from its metadata, puts it into the transcription queue and tells
+    the user their place in it and how long it should take.
+    """
+    try:
+        accepted = await admission.admit(bot, media)
+    except MediaRejectedException as e:
+        logger.info(f"Rejected media from user {message.from_user.id}: {e}")
+        await message.answer(rejection_text(e), reply_to_message_id=message.message_id)
+        return
+    try:
+        if WORKER_PROCESSES:
+            payload = message.model_dump_json(exclude_none=True, by_alias=True)
+            position = await db.async_enqueue_media_job(message.from_user.id, payload, media_queue.max_size,
+                                                        media_queue.max_per_user)
+            free_workers = WORKER_PROCESSES * QUEUE_WORKERS
+        else:
+            position = media_queue.submit(message.from_user.id,
+                                          lambda: process_media_message(bot, message, media, accepted.seconds))
+            free_workers = media_queue.idle_workers
+    except QueueFullException as e:
+        logger.warning(f"Rejected media from user {message.from_user.id}: {e}")
+        await message.answer(QUEUE_FULL_LOG, reply_to_message_id=message.message_id)
+        return
+    # Recorded so the job survives a restart of the bot while it waits in the queue.
+    await jobs.create(message)
+    workers = WORKER_PROCESSES * QUEUE_WORKERS if WORKER_PROCESSES else media_queue.workers
+    wait = admission.queue_seconds(position, free_workers, workers)
+    lines = [QUEUED_LOG.format(position=position)] if position > free_workers else []
+    if accepted.eta is not None and wait is not None and accepted.eta + wait >= ETA_NOTICE_SECONDS:
+        lines.append(ETA_LOG.format(eta=format_eta(accepted.eta + wait)))
+    if lines:
+        await message.answer("\n".join(lines), reply_to_message_id=message.message_id)
 
 
 @router.message(Form.email)
@@ -185,7 +306,7 @@ async def process_password(message: Message, state: FSMContext) -> Any:
     user_id = message.from_user.id
 
     try:
-        db.add_user_password(user_id, password)
+        await db.async_add_user_password(user_id, password)
         await message.answer("Your password has been saved.")
     except Exception as e:
         logger.error(f"Error processing password: {e}")
@@ -197,51 +318,250 @@ async def process_password(message: Message, state: FSMContext) -> Any:
 
 async def have_valid_email_and_auth(message, state):
     user_id = message.from_user.id
-    user_email = await db.async_get_user_email(user_id)
-    user_password = db.get_user_password(user_id)
-    if user_email is None:
+    profile = await db.async_get_user_profile(user_id)
+    if profile is None or profile.email is None:
         await state.set_state(Form.email)
         logger.info(f"State set to 'email' for user {user_id}")
         await message.answer("Please provide your email.")
         return False
-    response = await auth_and_check_goods(user_id, user_email, user_password)
+    response = await auth_and_check_goods(user_id, profile.email, profile.password)
     if response is None:
         return False
+    goods = goods_of(response)
+    if goods is None:
+        logger.warning(f"No goods for user {user_id} from Pay Fait: {response}")
+        await message.answer(NOT_ENTITLED_LOG)
+        return False
+    await metering.sync_plan(user_id, profile, goods)
     return True
 
 
 @router.message(ContentTypesFilter.Text())
 async def handle_text(message: Message, state: FSMContext) -> Any:
+    trace_id = metrics.new_trace()
     if await have_valid_email_and_auth(message, state):
         if message.reply_to_message:
             try:
                 context = await extract_context(message)
-                prompt = f"Context: \n{context}\nPrompt:\n{message.text}"
-                answer = await yandex_requests.get_completion(prompt)
-                await send_or_split_message(message, answer)
+                await answer_question(message, context)
             except Exception as e:
                 logger.error(f"Failed to get Yandex completion: {e}")
                 await message.answer("Произошла ошибка при обработке запроса.")
-                await bot.send_message(chat_id=os.getenv("ERRORS_CHAT_ID"), text=f"Failed to process text message {e}")
+                await telegram_sender.errors.report(f"Failed to process text message {e}", trace_id)
+
+
+async def answer_question(message: Message, context: str) -> None:
+    """
+    Answers the message's question about the context, reusing a cached answer unless the user asks to regenerate.
+    """
+    question, regenerate = completion_cache.split_regenerate(message.text)
+    llm = openai_requests if LLM_BACKEND == "openai" else yandex_requests
+    cache_key = completion_cache.make_key(transcript_index.transcript_hash(context), question, llm.model_options())
+
+    if regenerate:
+        completion_cache.count_bypass()
+    else:
+        answer = await completion_cache.async_get_answer(cache_key)
+        if answer is not None:
+            logger.info(f"Completion cache hit, hit rate {completion_cache.hit_rate():.0%}")
+            await send_or_split_message(message, answer)
+            return
+
+    if LLM_BACKEND == "openai":
+        prompt = await transcript_index.build_prompt(context, question, openai_requests.get_openai_completion)
+        answer_stream = openai_requests.stream_openai_completion(prompt)
+    else:
+        prompt = await transcript_index.build_prompt(context, question, yandex_requests.get_completion)
+        answer_stream = yandex_requests.stream_completion(prompt)
+    answer = await stream_answer(message, answer_stream)
+    await completion_cache.async_put_answer(cache_key, answer)
 
 
 async def extract_context(message: Message) -> str:
-    if message.reply_to_message.document:
-        with tempfile.NamedTemporaryFile(delete=True) as temp_file:
-            await bot.download(message.reply_to_message.document, temp_file.name)
-            async with aiofiles.open(temp_file.name, 'r', encoding='utf-8') as file:
-                return await file.read()
-    return message.reply_to_message.text
+    """
+    Returns the text the question is about. Transcripts the bot sent come from the transcript store;
+    other documents are downloaded into memory once and then kept there too.
+    """
+    reply = message.reply_to_message
+    if not reply.document:
+        return reply.text
+    context = await transcript_store.async_get_document(reply.chat.id, reply.message_id)
+    if context is None:
+        logger.info(f"Downloading document {reply.message_id} for a question about it")
+        context = (await bot.download(reply.document)).read().decode('utf-8')
+        await transcript_store.async_put_documents(reply.chat.id, [reply.message_id], context)
+    return context
+
+
+async def start_services() -> None:
+    await db.run(db.create_database)
+    http_client.start()
+    telegram_sender.errors.start(bot)
+
+
+async def stop_services() -> None:
+    # Sends what is left of the error digest, so it goes before the scheduler.
+    await telegram_sender.errors.stop()
+    await telegram_sender.scheduler.stop()
+    await poller.stop()
+    await http_client.close()
+    await db.run(db.close_connection)
+    await cache_db.run(cache_db.close_connection)
+
+
+async def on_startup() -> None:
+    await start_services()
+    metrics_runners.append(await metrics.start_server())
+    if WORKER_PROCESSES:
+        start_worker_processes()
+    else:
+        media_queue.start()
+        await resume_media_jobs()
+    # The S3 client is slow to create; make it while the first updates are already being handled.
+    background_tasks.append(asyncio.create_task(object_storage.warm_up()))
+    background_tasks.append(asyncio.create_task(object_storage.run_sweeper()))
+    if RUN_MODE == "webhook":
+        await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+    ready = time.perf_counter() - PROCESS_STARTED
+    metrics.startup_seconds.set(ready, phase="ready")
+    logger.info(f"Ready to take updates {ready * 1000:.0f} ms after start "
+                f"({IMPORTS_SECONDS * 1000:.0f} ms of it importing)")
+
+
+async def resume_media_jobs() -> None:
+    """
+    Puts the media jobs that were queued or running when the bot stopped back into the queue.
+    """
+    unfinished = await jobs.unfinished()
+    if unfinished:
+        logger.info(f"Resuming {len(unfinished)} media jobs")
+    for job_key, user_id, payload in unfinished:
+        message = Message.model_validate_json(payload, context={"bot": bot})
+        media = await get_media_from_message(message)
+        try:
+            media_queue.submit(user_id, lambda message=message, media=media: process_media_message(bot, message, media))
+        except QueueFullException as e:
+            logger.warning(f"Could not resume media job {job_key}: {e}")
+            await metering.refund_job(job_key)
+            await jobs.finish(job_key, jobs.FAILED)
+
+
+async def on_shutdown() -> None:
+    for task in background_tasks:
+        task.cancel()
+    await media_queue.stop()
+    await asyncio.to_thread(stop_worker_processes)
+    await stop_services()
+    for runner in metrics_runners:
+        if runner is not None:
+            await runner.cleanup()
+
+
+def start_worker_processes() -> None:
+    context = multiprocessing.get_context("spawn")
+    for number in range(WORKER_PROCESSES):
+        # Each worker serves its own metrics on the ports after the intake process's one.
+        metrics_port = metrics.METRICS_PORT and metrics.METRICS_PORT + 1 + number
+        process = context.Process(target=worker_process, args=(metrics_port,), name=f"media-worker-{number}",
+                                  daemon=True)
+        process.start()
+        worker_processes.append(process)
+    logger.info(f"Started {WORKER_PROCESSES} worker processes")
+
+
+def stop_worker_processes() -> None:
+    for process in worker_processes:
+        process.terminate()
+    for process in worker_processes:
+        process.join()
+    worker_processes.clear()
+
+
+def worker_process(metrics_port: int) -> None:
+    asyncio.run(run_worker(metrics_port))
+
+
+async def run_worker(metrics_port: int = metrics.METRICS_PORT) -> None:
+    """
+    Runs a worker process: QUEUE_WORKERS loops taking media jobs from the shared queue until SIGTERM.
+    """
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    await start_services()
+    metrics_runner = await metrics.start_server(metrics_port)
+    loops = [asyncio.create_task(serve_media_jobs(f"{os.getpid()}-{number}")) for number in range(QUEUE_WORKERS)]
+    try:
+        await asyncio.gather(*loops)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        for task in loops:
+            task.cancel()
+        await asyncio.gather(*loops, return_exceptions=True)
+        await stop_services()
+        await bot.session.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+
+async def serve_media_jobs(worker: str) -> None:
+    while True:
+        job = await db.async_claim_media_job(worker, JOB_STALE_SECONDS)
+        if job is None:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+        job_id, payload, created_at = job
+        metrics.queue_wait_seconds.observe(time.time() - created_at)
+        heartbeat = asyncio.create_task(renew_media_job(job_id, worker))
+        try:
+            message = Message.model_validate_json(payload, context={"bot": bot})
+            await process_media_message(bot, message, await get_media_from_message(message))
+        except asyncio.CancelledError:
+            await db.async_release_media_job(job_id, worker)
+            raise
+        except Exception as e:
+            logger.error(f"Media job {job_id} failed in worker {worker}: {e}")
+        finally:
+            heartbeat.cancel()
+        await db.async_finish_media_job(job_id, worker)
+
+
+async def renew_media_job(job_id: int, worker: str) -> None:
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+        await db.async_renew_media_job(job_id, worker)
+
+
+def setup_dispatcher() -> None:
+    dp.include_router(router)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
 
 
 async def main() -> None:
-    dp.include_router(router)
+    setup_dispatcher()
     await dp.start_polling(bot)
 
 
+def run_webhook() -> None:
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+    from aiohttp import web
+
+    setup_dispatcher()
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT)
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG, stream=sys.stdout)
     httpx_logger = logging.getLogger("httpx")
     httpx_logger.setLevel(logging.ERROR)
     httpx_logger.propagate = True
-    asyncio.run(main())
+    if sys.argv[1:] == ["worker"]:
+        # A standalone worker for the shared queue, e.g. in its own container next to the intake process.
+        asyncio.run(run_worker())
+    elif RUN_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(main())
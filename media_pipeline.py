@@ -0,0 +1,103 @@
+import hashlib
+import os
+import re
+
+import aiofiles
+from aiohttp import ClientError
+from aiogram.exceptions import TelegramBadRequest
+
+from custom_exceptions import ASRException, MediaRejectedException
+
+CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "300"))
+
+# Telegram download URLs carry the bot token in their path.
+_bot_token_re = re.compile(r"/bot\d+:[\w-]+/")
+
+
+def redact(text):
+    """
+    Hides the bot token in Telegram file URLs, for messages that may quote one.
+    """
+    return _bot_token_re.sub("/bot<token>/", text)
+
+
+async def stream_media(bot, media, chunk_size=CHUNK_SIZE):
+    """
+    Yields the content of a Telegram file chunk by chunk without writing it to disk.
+
+    :param bot: The bot instance for downloading the file.
+    :param media: The media to download.
+    """
+    location = await media_location(bot, media)
+    if bot.session.api.is_local:
+        async for chunk in read_chunks(location, chunk_size):
+            yield chunk
+        return
+
+    try:
+        async for chunk in bot.session.stream_content(url=location, timeout=DOWNLOAD_TIMEOUT, chunk_size=chunk_size,
+                                                      raise_for_status=True):
+            yield chunk
+    except ClientError as e:
+        # aiohttp errors quote the URL.
+        raise ASRException(f"Could not download file {media.file_unique_id}: {redact(str(e))}") from e
+
+
+async def media_location(bot, media):
+    """
+    Returns where the Telegram file can be read from: a local path when a local Bot API server keeps
+    the file on our disk already, otherwise its download URL.
+    """
+    try:
+        file = await bot.get_file(media.file_id)
+    except TelegramBadRequest as e:
+        # Files without a size in their metadata only turn out to be too big here.
+        if "file is too big" in str(e):
+            raise MediaRejectedException(str(e), "too_big") from e
+        raise
+    api = bot.session.api
+    if api.is_local:
+        return str(api.wrap_local_file.to_local(file.file_path))
+    return api.file_url(bot.token, file.file_path)
+
+
+async def read_chunks(path, chunk_size=CHUNK_SIZE):
+    async with aiofiles.open(path, 'rb') as file:
+        while chunk := await file.read(chunk_size):
+            yield chunk
+
+
+class HashingStream:
+    """
+    Passes chunks through while computing their SHA-256 and total size.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._digest = hashlib.sha256()
+        self.size = 0
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        async for chunk in self._chunks:
+            self._digest.update(chunk)
+            self.size += len(chunk)
+            yield chunk
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+
+async def collect(chunks, max_bytes):
+    """
+    Reads the whole stream into memory, refusing to hold more than `max_bytes`.
+    """
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        if len(buffer) > max_bytes:
+            raise ASRException(f"Audio is larger than {max_bytes} bytes")
+    return bytes(buffer)
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import math
+import os
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+import Pay_Fait
+import db
+import media_pipeline
+from audio_splitter import probe_duration
+from custom_exceptions import ASRException, QuotaExceededException
+
+logger = logging.getLogger(__name__)
+
+# Daily allowances reset at midnight in this UTC offset (Moscow time by default).
+DAY_RESET_UTC_OFFSET = float(os.getenv("DAY_RESET_UTC_OFFSET", "3"))
+# Allowance of users whose goods name no "N минут" plan: none, unless a free tier is configured.
+DEFAULT_DAILY_MINUTES = int(os.getenv("DEFAULT_DAILY_MINUTES", "0"))
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", "15"))
+# Used to estimate the duration from the file size when neither Telegram nor the container header has it.
+ESTIMATE_BITRATE = 128000
+
+# job_key is the idempotency key of the media job the minutes are reserved for, if any.
+Reservation = namedtuple("Reservation", ["user_id", "minutes", "day", "job_key"], defaults=(None,))
+
+_plan_minutes_re = re.compile(r"(\d+)\s*минут", re.IGNORECASE)
+
+
+def today():
+    return (datetime.now(timezone.utc) + timedelta(hours=DAY_RESET_UTC_OFFSET)).date().isoformat()
+
+
+def billable_minutes(seconds):
+    return max(1, math.ceil((seconds or 0) / 60))
+
+
+def plan_minutes(goods):
+    """
+    Returns the daily allowance of the best plan among the user's goods, e.g. 60 for "Подписка 60 минут в день".
+    """
+    minutes = [int(match.group(1)) for good in goods or []
+               if (match := _plan_minutes_re.search(good.get("name") or ""))]
+    return max(minutes, default=DEFAULT_DAILY_MINUTES)
+
+
+async def sync_plan(user_id, profile, goods):
+    """
+    Stores the allowance of the user's current plan when it differs from the one in the database.
+
+    The goods may come from this process's entitlement cache, older than a purchase another process
+    has already stored, so a change is confirmed with fresh goods from Pay Fait before it is written.
+    """
+    minutes = plan_minutes(goods)
+    if profile.max_minutes == minutes:
+        return
+    Pay_Fait.invalidate_entitlement(user_id)
+    response = await Pay_Fait.auth_and_check_goods(user_id, profile.email, profile.password)
+    goods = Pay_Fait.goods_of(response)
+    if goods is None:
+        logger.warning(f"Could not confirm the plan of user {user_id}, keeping {profile.max_minutes} minutes")
+        return
+    minutes = plan_minutes(goods)
+    if profile.max_minutes != minutes:
+        await db.async_update_minutes(user_id, max_minutes=minutes)
+
+
+async def probe_seconds(bot, media):
+    """
+    Returns the duration of the media without downloading it: from the Telegram metadata when it is there,
+    otherwise from the container header read by ffprobe, otherwise estimated from the file size.
+    """
+    duration = getattr(media, "duration", None)
+    if duration:
+        return duration
+    try:
+        return await asyncio.wait_for(probe_duration(await media_pipeline.media_location(bot, media)), PROBE_TIMEOUT)
+    except (ASRException, asyncio.TimeoutError) as e:
+        logger.warning(f"Could not probe the duration of file {media.file_unique_id}: {e}")
+    return (getattr(media, "file_size", None) or 0) * 8 / ESTIMATE_BITRATE
+
+
+async def reserve(user_id, seconds, job_key=None):
+    """
+    Reserves the minutes a job needs, before any work is spent on it. A media job that is resumed
+    keeps the reservation it made before, so it is never charged twice.
+
+    :param job_key: The idempotency key of the media job, see jobs.job_key.
+    :return: The Reservation to `commit` when the job succeeds or `refund` when it fails.
+    :raises QuotaExceededException: If the user's daily allowance does not cover the job.
+    """
+    reservation = Reservation(user_id, billable_minutes(seconds), today(), job_key)
+    if job_key is None:
+        reserved = await db.async_reserve_minutes(user_id, reservation.minutes, reservation.day)
+    else:
+        reserved = await db.async_reserve_job_minutes(job_key, user_id, reservation.minutes, reservation.day)
+    if not reserved:
+        raise QuotaExceededException(f"Not enough minutes left for user {user_id}", minutes=reservation.minutes)
+    return reservation
+
+
+async def commit(reservation):
+    if reservation.job_key is None:
+        await db.async_commit_minutes(reservation.user_id, reservation.minutes, reservation.day)
+    else:
+        await commit_job(reservation.job_key)
+
+
+async def refund(reservation):
+    if reservation.job_key is None:
+        await db.async_refund_minutes(reservation.user_id, reservation.minutes, reservation.day)
+    else:
+        await refund_job(reservation.job_key)
+
+
+async def commit_job(job_key):
+    """
+    Charges the minutes the media job reserved, if it holds a reservation that is not settled yet.
+    """
+    await db.async_settle_job_minutes(job_key, "committed")
+
+
+async def refund_job(job_key):
+    await db.async_settle_job_minutes(job_key, "refunded")
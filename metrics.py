@@ -0,0 +1,200 @@
+import asyncio
+import contextvars
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# 0 disables the endpoint. Worker processes serve theirs on the following ports.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+trace_id = contextvars.ContextVar("trace_id", default="-")
+
+_registry = []
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key)) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{self._format_labels(key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """
+        Counts the block as in progress while it runs.
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # Per-bucket counts, sum and count.
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][index] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes how long the block took, also when it raises.
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, (counts, total, count) in sorted(self._values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{self._format_labels(key, ('le', str(bound)))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{self._format_labels(key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+
+stage_seconds = Histogram("pipeline_stage_seconds", "Time spent in each stage of a media job.", ["stage"])
+stage_wait_seconds = Histogram("pipeline_stage_wait_seconds",
+                               "Time a job waited for a free slot of a pipeline stage.", ["stage"])
+queue_wait_seconds = Histogram("media_queue_wait_seconds", "Time between a media job being queued and started.")
+job_seconds = Histogram("media_job_seconds", "End-to-end latency of a media job, from start to reply.", ["outcome"])
+asr_seconds = Histogram("asr_request_seconds", "Latency of a recognition request per ASR backend.",
+                        ["backend", "outcome"])
+bytes_processed = Counter("media_bytes_total", "Bytes of media downloaded from Telegram and uploaded to storage.", ["direction"])
+audio_seconds_processed = Counter("audio_seconds_total", "Seconds of audio recognised.")
+jobs_total = Counter("media_jobs_total", "Media jobs by outcome.", ["outcome"])
+jobs_in_flight = Gauge("media_jobs_in_flight", "Media jobs being processed right now.")
+queue_depth = Gauge("media_queue_depth", "Media jobs waiting in the in-process queue.")
+operations_in_flight = Gauge("asr_operations_in_flight", "Long-running recognition operations being polled.")
+telegram_send_wait_seconds = Histogram("telegram_send_wait_seconds",
+                                       "Time a Telegram request waited for the flood limits.", ["priority"])
+telegram_retry_after_total = Counter("telegram_retry_after_total", "Telegram requests answered with retry_after.",
+                                     ["method"])
+admissions_total = Counter("media_admissions_total", "Admission decisions on incoming media.", ["decision"])
+completion_cache_lookups_total = Counter("completion_cache_lookups_total",
+                                         "Completion cache lookups by result: hit, miss or bypass.", ["result"])
+coalesced_total = Counter("coalesced_calls_total", "Calls that joined an identical call already running.", ["group"])
+startup_seconds = Gauge("bot_startup_seconds", "Time from process start to the end of each startup phase.", ["phase"])
+
+
+def new_trace():
+    """
+    Starts a new trace id for the current job; it is added to every log line the job writes.
+    """
+    value = uuid.uuid4().hex[:12]
+    trace_id.set(value)
+    return value
+
+
+def start_untraced(coro):
+    """
+    Starts a background task that serves many jobs outside of the trace of the job that happens to start it.
+    """
+    # create_task copies the current context, so it is called from an empty one.
+    return contextvars.Context().run(asyncio.create_task, coro)
+
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = trace_id.get()
+        return True
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_metrics(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_server(port=METRICS_PORT):
+    """
+    Serves GET /metrics in the Prometheus text format on METRICS_HOST.
+
+    :return: The runner to clean up on shutdown, or None if the endpoint is disabled.
+    """
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logger.info(f"Serving metrics on http://{METRICS_HOST}:{port}/metrics")
+    return runner
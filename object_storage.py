@@ -0,0 +1,260 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import db
+import metrics
+from transcript_cache import async_file_sha256
+
+logger = logging.getLogger(__name__)
+
+BUCKET = os.getenv('S3_BUCKET', 'sonnyroot')
+PREFIX = 'audio/'
+# S3 multipart parts must be at least 5 MiB, except the last one.
+UPLOAD_PART_SIZE = int(os.getenv('S3_PART_SIZE', str(5 * 1024 * 1024)))
+UPLOAD_PART_CONCURRENCY = int(os.getenv('S3_PART_CONCURRENCY', '4'))
+# Objects older than this are considered orphaned by the sweeper.
+ORPHAN_TTL = int(os.getenv('S3_ORPHAN_TTL', str(6 * 3600)))
+SWEEP_INTERVAL = int(os.getenv('S3_SWEEP_INTERVAL', '3600'))
+# How long a job waits for another process to finish deleting an object before it uploads the object again.
+DELETE_WAIT_SECONDS = float(os.getenv('S3_DELETE_WAIT_SECONDS', '30'))
+DELETE_WAIT_INTERVAL = 0.2
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the S3 client, importing boto3 and creating the client on first use. Both are slow,
+    so startup only begins this in the background (see `warm_up`) instead of waiting for it.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            import boto3
+            session = boto3.session.Session()
+            _client = session.client(
+                service_name='s3',
+                endpoint_url=os.getenv('endpoint_url'),
+                aws_access_key_id=os.getenv('aws_access_key_id'),
+                aws_secret_access_key=os.getenv('aws_secret_access_key')
+            )
+    return _client
+
+
+async def warm_up():
+    await asyncio.to_thread(get_client)
+
+
+def content_key(digest, suffix=''):
+    """
+    Returns the key of an object addressed by the SHA-256 of its content.
+    """
+    return f"{PREFIX}{digest}{suffix}"
+
+
+def source_key(file_unique_id, profile, suffix=''):
+    """
+    Returns the key of an object derived from a Telegram file, for streams whose hash is not known up front.
+    Telegram gives the same file the same file_unique_id, so equal sources still share one key.
+    """
+    return content_key(hashlib.sha256(f"{file_unique_id}:{profile}".encode()).hexdigest(), suffix)
+
+
+def public_url(key):
+    return f"https://storage.yandexcloud.net/{BUCKET}/{key}"
+
+
+async def exists(key):
+    try:
+        await asyncio.to_thread(get_client().head_object, Bucket=BUCKET, Key=key)
+        return True
+    except get_client().exceptions.ClientError:
+        return False
+
+
+async def _hold(key):
+    """
+    Takes this job's hold on the object. Holds are kept in users.db, so they count across worker processes,
+    and the object is deleted when the last job in any process releases it. If that is happening right now,
+    waits until the object is gone, so the upload that follows puts it back.
+    """
+    if not await db.async_acquire_object(key):
+        return
+    deadline = time.monotonic() + DELETE_WAIT_SECONDS
+    while await db.async_is_object_deleting(key) and time.monotonic() < deadline:
+        await asyncio.sleep(DELETE_WAIT_INTERVAL)
+
+
+async def upload_file(path, suffix=''):
+    """
+    Uploads a local file under its content-addressed key, skipping the upload when the object exists.
+    Large files go up as a multipart upload with UPLOAD_PART_CONCURRENCY parts in flight.
+
+    :return: The object key. Release it with `release` once it is no longer needed.
+    """
+    key = content_key(await async_file_sha256(path), suffix)
+    await _hold(key)
+    try:
+        if not await exists(key):
+            from boto3.s3.transfer import TransferConfig
+            config = TransferConfig(multipart_threshold=UPLOAD_PART_SIZE, multipart_chunksize=UPLOAD_PART_SIZE,
+                                    max_concurrency=UPLOAD_PART_CONCURRENCY)
+            with metrics.stage_seconds.time(stage="upload"):
+                await asyncio.to_thread(get_client().upload_file, path, BUCKET, key, Config=config)
+            metrics.bytes_processed.inc(os.path.getsize(path), direction="upload")
+    except BaseException:
+        await release(key)
+        raise
+    return key
+
+
+async def upload_bytes(content, suffix=''):
+    """
+    Uploads audio held in memory under its content-addressed key.
+
+    :return: The object key. Release it with `release` once it is no longer needed.
+    """
+    key = content_key(hashlib.sha256(content).hexdigest(), suffix)
+    await _hold(key)
+    try:
+        if not await exists(key):
+            with metrics.stage_seconds.time(stage="upload"):
+                await asyncio.to_thread(get_client().put_object, Bucket=BUCKET, Key=key, Body=content)
+            metrics.bytes_processed.inc(len(content), direction="upload")
+    except BaseException:
+        await release(key)
+        raise
+    return key
+
+
+async def download(key):
+    response = await asyncio.to_thread(get_client().get_object, Bucket=BUCKET, Key=key)
+    return await asyncio.to_thread(response['Body'].read)
+
+
+async def upload_stream(chunks, key):
+    """
+    Uploads a stream of chunks, holding at most UPLOAD_PART_CONCURRENCY parts in memory.
+
+    Streams shorter than one part are stored with a single PUT, longer ones with a multipart upload
+    whose parts are sent concurrently. A failed multipart upload is aborted.
+
+    :param chunks: An async iterator of bytes.
+    :param key: The object key.
+    :return: The object key. Release it with `release` once it is no longer needed.
+    """
+    with metrics.stage_seconds.time(stage="upload"):
+        return await _upload_stream(chunks, key)
+
+
+async def _upload_stream(chunks, key):
+    client = get_client()
+    await _hold(key)
+    buffer = bytearray()
+    upload_id = None
+    pending = set()
+    parts = []
+    number = 0
+    try:
+        async for chunk in chunks:
+            metrics.bytes_processed.inc(len(chunk), direction="upload")
+            buffer += chunk
+            if len(buffer) < UPLOAD_PART_SIZE:
+                continue
+            if upload_id is None:
+                upload = await asyncio.to_thread(client.create_multipart_upload, Bucket=BUCKET, Key=key)
+                upload_id = upload['UploadId']
+            if len(pending) >= UPLOAD_PART_CONCURRENCY:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                parts += [task.result() for task in done]
+            number += 1
+            pending.add(asyncio.ensure_future(_upload_part(key, upload_id, number, bytes(buffer))))
+            buffer.clear()
+
+        if upload_id is None:
+            await asyncio.to_thread(client.put_object, Bucket=BUCKET, Key=key, Body=bytes(buffer))
+            return key
+
+        if buffer:
+            number += 1
+            pending.add(asyncio.ensure_future(_upload_part(key, upload_id, number, bytes(buffer))))
+        parts += await asyncio.gather(*pending)
+        pending = set()
+        parts.sort(key=lambda part: part['PartNumber'])
+        await asyncio.to_thread(client.complete_multipart_upload, Bucket=BUCKET, Key=key, UploadId=upload_id,
+                                MultipartUpload={'Parts': parts})
+        return key
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if upload_id is not None:
+            await asyncio.to_thread(client.abort_multipart_upload, Bucket=BUCKET, Key=key, UploadId=upload_id)
+        await release(key)
+        raise
+
+
+async def _upload_part(key, upload_id, number, body):
+    response = await asyncio.to_thread(get_client().upload_part, Bucket=BUCKET, Key=key, UploadId=upload_id,
+                                       PartNumber=number, Body=body)
+    return {'ETag': response['ETag'], 'PartNumber': number}
+
+
+async def release(key):
+    """
+    Drops this job's hold on the object and deletes it when no other job in any process still needs it.
+    """
+    if not await db.async_release_object(key):
+        return
+    try:
+        await delete(key)
+    except Exception as e:
+        # The sweeper removes it later.
+        logger.warning(f"Failed to delete object {key}: {e}")
+    finally:
+        await db.async_forget_object(key)
+
+
+async def delete(key):
+    await asyncio.to_thread(get_client().delete_object, Bucket=BUCKET, Key=key)
+
+
+def sweep_orphans(now=None):
+    """
+    Deletes objects under PREFIX that are older than ORPHAN_TTL and not held by a job in any process,
+    e.g. left behind by a crash.
+
+    :return: The number of deleted objects.
+    """
+    client = get_client()
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(seconds=ORPHAN_TTL)
+    held = db.get_leased_objects(cutoff.timestamp())
+    deleted = 0
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=BUCKET, Prefix=PREFIX):
+        stale = [{'Key': item['Key']} for item in page.get('Contents', [])
+                 if item['LastModified'] < cutoff and item['Key'] not in held]
+        if stale:
+            client.delete_objects(Bucket=BUCKET, Delete={'Objects': stale, 'Quiet': True})
+            deleted += len(stale)
+    return deleted
+
+
+async def run_sweeper():
+    """
+    Periodically removes orphaned objects. Runs until cancelled.
+    """
+    while True:
+        try:
+            deleted = await asyncio.to_thread(sweep_orphans)
+            if deleted:
+                logger.info(f"Removed {deleted} orphaned objects from {BUCKET}")
+        except Exception as e:
+            logger.error(f"Object sweep failed: {e}")
+        await asyncio.sleep(SWEEP_INTERVAL)
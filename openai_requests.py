@@ -1,25 +1,68 @@
 import logging
+import math
 import os
 
 import httpx
-import openai
 
+import http_client
+import transcript
 from custom_exceptions import ASRException
+from single_flight import SingleFlight
+from transcript import Segment
 
 logger = logging.getLogger(__name__)
 
+COMPLETION_MODEL = {
+    "deployment_id": "deep-new",
+    "model": "gpt-4",
+}
+
+# Whisper rejects files larger than this.
+WHISPER_MAX_BYTES = 25 * 1024 * 1024
+
+_openai = None
+
+completions = SingleFlight("openai_completion")
+
+
+def get_openai():
+    """
+    Returns the openai module configured for Azure. It takes a noticeable part of a second to import
+    and is only needed with LLM_BACKEND=openai, so it is imported on first use rather than at startup.
+    """
+    global _openai
+    if _openai is None:
+        import openai
+        openai.api_type = "azure"
+        openai.api_key = os.getenv('OPENAI_API_KEY')
+        openai.api_base = "https://deep-azure.openai.azure.com/"
+        openai.api_version = "2023-06-01-preview"
+        _openai = openai
+    return _openai
+
+
+def model_options():
+    """
+    Returns everything besides the prompt that affects the completion, for cache keys.
+    """
+    return {"backend": "openai", **COMPLETION_MODEL}
+
 
 async def get_openai_completion(prompt: str) -> str:
     """
-    Gets the completion from OpenAI based on the given prompt.
+    Gets the completion from OpenAI based on the given prompt. Identical prompts asked at the same time
+    share one request.
 
     :param prompt: The prompt to send to OpenAI.
     :return: The text completion.
     """
+    return await completions.run(prompt, _request_completion, prompt)
+
+
+async def _request_completion(prompt: str) -> str:
     try:
-        chat_completion = await openai.ChatCompletion.acreate(
-            deployment_id="deep-new",
-            model="gpt-4",
+        chat_completion = await get_openai().ChatCompletion.acreate(
+            **COMPLETION_MODEL,
             messages=[{"role": 'user', "content": prompt}]
         )
         return chat_completion["choices"][0]["message"]["content"]
@@ -28,8 +71,50 @@ async def get_openai_completion(prompt: str) -> str:
         raise
 
 
+async def stream_openai_completion(prompt: str):
+    """
+    Streams the completion from OpenAI. Every item is the whole text generated so far.
+    Identical prompts asked at the same time share one generation.
+
+    :param prompt: The prompt to send to OpenAI.
+    """
+    async for text in completions.stream(prompt, _stream_completion, prompt):
+        yield text
+
+
+async def _stream_completion(prompt: str):
+    text = ""
+    try:
+        chunks = await get_openai().ChatCompletion.acreate(
+            **COMPLETION_MODEL,
+            messages=[{"role": 'user', "content": prompt}],
+            stream=True
+        )
+        async for chunk in chunks:
+            if not chunk["choices"]:
+                continue
+            delta = chunk["choices"][0]["delta"].get("content")
+            if delta:
+                text += delta
+                yield text
+    except Exception as e:
+        logger.error(f"OpenAI completion error: {e}")
+        raise
+
+
 async def send_request(path):
     from file_utils import read_file_content
+
+    # Read the audio file content
+    file_content = await read_file_content(path)
+    segments = await transcribe_content(file_content, 'audio_file' + (os.path.splitext(path)[1] or '.mp3'))
+    return transcript.to_text(segments)
+
+
+async def transcribe_content(file_content, filename, audio_seconds=None):
+    """
+    Sends audio that is already in memory to Whisper and returns its transcript segments.
+    """
     url = "https://deep-whisper.openai.azure.com/openai/deployments/whisper/audio/transcriptions?api-version=2023-05-20-preview"
     api_key = os.getenv('OPENAI_API_KEY_WHISPER',
                         'default_api_key')  # You can provide a default API key if that's acceptable
@@ -39,24 +124,34 @@ async def send_request(path):
     headers = {
         'api-key': api_key,
     }
-
-    # Read the audio file content
-    file_content = await read_file_content(path)
     files = {
-        'file': ('audio_file.mp3', file_content)
-        # Ensure that the filename is set correctly, possibly based on the path
+        'file': (filename, file_content)
+    }
+    data = {
+        'response_format': 'verbose_json',
     }
 
     # Send the request and handle the response
     try:
-        async with httpx.AsyncClient(timeout=None) as client:
-            response = await client.post(url, headers=headers, files=files)
+        response = await http_client.request("openai_whisper", "POST", url, headers=headers, files=files, data=data)
         response.raise_for_status()
         logger.info("Successfully received response from ASR service.")
-        return response.json()["text"]
+        return parse_whisper_result(response.json(), audio_seconds)
     except httpx.HTTPStatusError as exc:
         logger.error(f"Error response {exc.response.status_code} while sending request to ASR.")
         raise ASRException(f"Error response {exc.response.status_code}", status_code=exc.response.status_code) from exc
     except httpx.RequestError as exc:
         logger.error(f"An error occurred while requesting {exc.request.url!r}.")
         raise ASRException("Network-related error occurred") from exc
+
+
+def parse_whisper_result(result, audio_seconds=None):
+    """
+    Turns a verbose_json response into segments, with the probability of the average token as the confidence.
+    A response without segments becomes one segment spanning the recording.
+    """
+    if not result.get("segments"):
+        return [Segment(0.0, audio_seconds, result["text"])]
+    return [Segment(segment["start"], segment["end"], segment["text"].strip(),
+                    confidence=math.exp(segment["avg_logprob"]) if "avg_logprob" in segment else None)
+            for segment in result["segments"]]
@@ -0,0 +1,162 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+
+import http_client
+import metrics
+
+logger = logging.getLogger(__name__)
+
+OPERATION_URL = "https://operation.api.cloud.yandex.net/operations/{}"
+
+# Yandex long-running recognition takes roughly 10 seconds per minute of single-channel audio.
+PROCESSING_RATIO = float(os.getenv("STT_PROCESSING_RATIO", "0.17"))
+MIN_FIRST_POLL = 1.0
+BACKOFF_FACTOR = 1.5
+MAX_INTERVAL = 15.0
+# The operation is abandoned after DEADLINE_FACTOR times the predicted time plus DEADLINE_SLACK seconds.
+DEADLINE_FACTOR = float(os.getenv("STT_DEADLINE_FACTOR", "4"))
+DEADLINE_SLACK = float(os.getenv("STT_DEADLINE_SLACK", "120"))
+DEFAULT_AUDIO_SECONDS = 60.0
+
+
+class _Operation:
+    def __init__(self, operation_id, future, audio_seconds):
+        now = time.monotonic()
+        expected = audio_seconds * PROCESSING_RATIO
+        self.operation_id = operation_id
+        self.future = future
+        # The polls of an operation are logged under the trace of the job waiting for it.
+        self.trace_id = metrics.trace_id.get()
+        self.next_poll = now + max(MIN_FIRST_POLL, expected * 0.8)
+        self.interval = max(MIN_FIRST_POLL, expected * 0.1)
+        self.deadline = now + expected * DEADLINE_FACTOR + DEADLINE_SLACK
+        self.attempts = 0
+        self.waiters = 0
+
+
+class OperationPoller:
+    """
+    Waits for Yandex long-running operations.
+
+    A single background task schedules the polls of every registered operation when they are due, so many
+    concurrent jobs cost one scheduler. Each poll runs in its own task, so a slow request holds up only
+    its own operation. The first poll is timed from the predicted processing time of the audio,
+    later polls back off exponentially until the operation's deadline.
+    """
+
+    def __init__(self):
+        self._operations = {}
+        # The polls in flight, by operation id.
+        self._polling = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._operations)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = metrics.start_untraced(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for task in self._polling.values():
+            task.cancel()
+        await asyncio.gather(*self._polling.values(), return_exceptions=True)
+        self._polling.clear()
+        for operation in self._operations.values():
+            operation.future.cancel()
+        self._operations.clear()
+        metrics.operations_in_flight.set(0)
+
+    async def wait(self, operation_id, audio_seconds=None):
+        """
+        Returns the finished operation's JSON. Waiting for an operation that is already waited for
+        joins the first wait.
+
+        :param operation_id: The id returned by longRunningRecognize.
+        :param audio_seconds: The duration of the recognised audio, used to predict when it is done.
+        :raises TimeoutError: If the operation is not done by its deadline.
+        """
+        self.start()
+        operation = self._operations.get(operation_id)
+        if operation is None:
+            future = asyncio.get_running_loop().create_future()
+            operation = _Operation(operation_id, future, audio_seconds or DEFAULT_AUDIO_SECONDS)
+            self._operations[operation_id] = operation
+            metrics.operations_in_flight.set(len(self._operations))
+            self._wakeup.set()
+        operation.waiters += 1
+        try:
+            with metrics.stage_seconds.time(stage="poll"):
+                # Shielded, so a waiter that is cancelled does not cancel the operation for the others.
+                return await asyncio.shield(operation.future)
+        finally:
+            operation.waiters -= 1
+            if not operation.waiters and self._operations.get(operation_id) is operation:
+                del self._operations[operation_id]
+                metrics.operations_in_flight.set(len(self._operations))
+                operation.future.cancel()
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            waiting = [operation for operation in self._operations.values()
+                       if operation.operation_id not in self._polling]
+            for operation in waiting:
+                if operation.next_poll <= now:
+                    task = asyncio.ensure_future(self._poll(operation))
+                    self._polling[operation.operation_id] = task
+                    task.add_done_callback(functools.partial(self._polled, operation.operation_id))
+
+            self._wakeup.clear()
+            timeout = min((operation.next_poll for operation in waiting if operation.next_poll > now), default=None)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), None if timeout is None else max(timeout - now, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    def _polled(self, operation_id, task):
+        self._polling.pop(operation_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Polling operation {operation_id} failed: {task.exception()}")
+        # The operation is due again at its new next_poll.
+        self._wakeup.set()
+
+    async def _poll(self, operation):
+        headers = {
+            "Authorization": f"Api-Key {os.getenv('YANDEX_API_KEY_STT')}",
+        }
+        # Each poll runs in its own task, see _run, so this does not leak into the others.
+        metrics.trace_id.set(operation.trace_id)
+        operation.attempts += 1
+        try:
+            response = await http_client.request("yandex_operation", "GET",
+                                                 OPERATION_URL.format(operation.operation_id), headers=headers)
+            result = response.json()
+        except Exception as e:
+            logger.warning(f"Polling operation {operation.operation_id} failed: {e}")
+            result = None
+
+        if operation.future.done():
+            return
+        if result is not None and result.get('done'):
+            logger.info(f"Operation {operation.operation_id} done after {operation.attempts} polls")
+            operation.future.set_result(result)
+            return
+
+        now = time.monotonic()
+        if now >= operation.deadline:
+            operation.future.set_exception(TimeoutError("Превышено максимальное количество попыток опроса API."))
+            return
+        operation.next_poll = min(now + operation.interval, operation.deadline)
+        operation.interval = min(operation.interval * BACKOFF_FACTOR, MAX_INTERVAL)
+
+
+poller = OperationPoller()
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time: callers that ask for a key while its call is running wait for
+    that call and get its result or exception instead of starting their own. Calls are only shared within
+    a process, so with WORKER_PROCESSES each worker coalesces its own jobs.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._streams = {}
+
+    async def run(self, key, func, *args, **kwargs):
+        """
+        :param key: What makes two calls identical; None runs the call without sharing it.
+        :param func: The coroutine function to call when no call for the key is running.
+        :return: The result of the running call.
+        """
+        if key is None:
+            return await func(*args, **kwargs)
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            logger.info(f"Joined the running {self.name} call")
+            metrics.coalesced_total.inc(group=self.name)
+        # A caller that is cancelled leaves the call running for the others.
+        return await asyncio.shield(task)
+
+    async def stream(self, key, func, *args, **kwargs):
+        """
+        Like `run`, for async generators whose every item replaces the previous one, such as the text of
+        a completion so far: one generator runs per key, and each caller gets its latest item whenever it is
+        ready for the next one. Callers that join late start from the latest item, none of them misses the last.
+
+        :param func: The async generator function to call when no stream for the key is running.
+        """
+        if key is None:
+            async for item in func(*args, **kwargs):
+                yield item
+            return
+        stream = self._streams.get(key)
+        if stream is None:
+            stream = _SharedStream(func(*args, **kwargs))
+            self._streams[key] = stream
+            stream.task.add_done_callback(lambda done: self._finish_stream(key, stream))
+        else:
+            logger.info(f"Joined the running {self.name} stream")
+            metrics.coalesced_total.inc(group=self.name)
+        async for item in stream.follow():
+            yield item
+
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Marks the exception as retrieved when every caller was cancelled before the call failed.
+            task.exception()
+
+    def _finish_stream(self, key, stream):
+        if self._streams.get(key) is stream:
+            del self._streams[key]
+        if not stream.task.cancelled():
+            stream.task.exception()
+
+
+class _SharedStream:
+    """
+    Reads an async generator in a task of its own and keeps its latest item for any number of followers.
+    """
+
+    def __init__(self, items):
+        self.latest = None
+        self.version = 0
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(items))
+
+    async def _pump(self, items):
+        try:
+            async for item in items:
+                self.latest = item
+                self.version += 1
+                self._notify()
+        finally:
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self):
+        seen = 0
+        while True:
+            changed = self._changed
+            if self.version > seen:
+                seen = self.version
+                yield self.latest
+                continue
+            if self.task.done():
+                # Raises what the generator raised.
+                self.task.result()
+                return
+            await changed.wait()
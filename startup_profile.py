@@ -0,0 +1,100 @@
+"""
+Import-time profile of the bot, to keep its cold start in check.
+
+Runs `python -X importtime -c "import main"` in a fresh interpreter and reports the total import time and the
+modules that take the longest, counting everything they import in turn. With --budget-ms it exits with status 1
+when the total is over the budget, so it can run next to the tests, e.g.
+
+    python startup_profile.py --top 15
+    python startup_profile.py --budget-ms 3500 --json startup.json
+
+Importing main only reads the environment, so no tokens or network are needed.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+def profile(module="main", repeat=3):
+    """
+    Imports the module in a new interpreter `repeat` times and keeps the fastest run, since the first one
+    also pays for compiling the bytecode.
+
+    :return: A list of (module, self microseconds, cumulative microseconds, depth) in the order the imports
+        finished, ending with the profiled module itself.
+    """
+    env = dict(os.environ, TELEGRAM_TOKEN=os.getenv("TELEGRAM_TOKEN", "123456:profile"), METRICS_PORT="0")
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                capture_output=True, text=True, env=env,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        if result.returncode:
+            raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+        rows = []
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "self [us]" in line:
+                continue
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            depth = (len(name) - len(name.lstrip(" "))) // 2
+            rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+        rows = own_imports(rows, module)
+        if best is None or rows[-1][2] < best[-1][2]:
+            best = rows
+    return best
+
+
+def own_imports(rows, module):
+    """
+    Drops what the interpreter imports on its own at startup. The output lists a module after everything it imports,
+    so the profiled module is the last row and its imports are the rows since the previous top-level one.
+    """
+    end = max(index for index, row in enumerate(rows) if row[0] == module and row[3] == 0)
+    start = max((index + 1 for index, row in enumerate(rows[:end]) if row[3] == 0), default=0)
+    return rows[start:end + 1]
+
+
+def report(rows, top=10):
+    direct = [row for row in rows if row[3] == 1]
+    return {
+        "total_ms": round(rows[-1][2] / 1000, 1),
+        "modules": len(rows),
+        "slowest": [{"module": name, "cumulative_ms": round(cumulative / 1000, 1), "self_ms": round(self_us / 1000, 1)}
+                    for name, self_us, cumulative, _ in sorted(direct, key=lambda row: -row[2])[:top]],
+    }
+
+
+def print_report(result):
+    print(f"Import: {result['total_ms']:.0f} ms, {result['modules']} modules")
+    print(f"{'module':<40} {'cumulative ms':>14} {'self ms':>8}")
+    for row in result["slowest"]:
+        print(f"{row['module']:<40} {row['cumulative_ms']:>14.1f} {row['self_ms']:>8.1f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="main", help="Module to profile.")
+    parser.add_argument("--top", type=int, default=10, help="How many of the slowest imports to list.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs to take the fastest of.")
+    parser.add_argument("--budget-ms", type=float, help="Exit with status 1 when the import takes longer.")
+    parser.add_argument("--json", help="Also write the report to this file.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = report(profile(args.module, args.repeat), args.top)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.budget_ms is not None and result["total_ms"] > args.budget_ms:
+        print(f"Over the budget of {args.budget_ms:.0f} ms", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
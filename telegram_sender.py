@@ -0,0 +1,265 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages a second overall, one a second in a private chat and 20 a minute in a group.
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+GLOBAL_BURST = float(os.getenv("TELEGRAM_GLOBAL_BURST", "30"))
+CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", str(20 / 60)))
+GROUP_BURST = float(os.getenv("TELEGRAM_GROUP_BURST", "3"))
+# How many times a request is sent again after Telegram answers it with retry_after.
+MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+ERROR_DIGEST_INTERVAL = float(os.getenv("ERROR_DIGEST_INTERVAL", "300"))
+
+# Methods that post or change messages, the ones flood control counts.
+THROTTLED_PREFIXES = ("send", "edit", "copy", "forward")
+
+# Lower goes first when the global budget is short.
+REPLY = 0
+PREVIEW = 1
+REPORT = 2
+
+_priority = contextvars.ContextVar("telegram_priority", default=REPLY)
+_volatile_re = re.compile(r"\b[0-9a-f]{12}\b|\d+")
+
+
+@contextmanager
+def priority(value):
+    """
+    Sends the Telegram requests made in the block with the given priority.
+    """
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """
+        Returns how many seconds until a token is available.
+        """
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def idle(self, now):
+        return self.delay(now) == 0 and self.tokens >= self.burst
+
+
+class SendScheduler:
+    """
+    Hands out permission to send to Telegram from a global token bucket and one bucket per chat.
+
+    Waiters are served by priority, then in order of arrival. A waiter whose chat has no tokens left
+    does not hold up waiters for other chats, and a retry_after pauses the bucket it applies to.
+    """
+
+    def __init__(self):
+        self.bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.chat_buckets = {}
+        self._waiters = []
+        self._order = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def share(self, processes):
+        """
+        Splits the global rate between the processes that send for the bot.
+        """
+        self.bucket = TokenBucket(GLOBAL_RATE / processes, max(1.0, GLOBAL_BURST / processes))
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            group = str(chat_id).startswith("-")
+            bucket = self.chat_buckets[chat_id] = TokenBucket(GROUP_RATE if group else CHAT_RATE,
+                                                              GROUP_BURST if group else CHAT_BURST)
+        return bucket
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = metrics.start_untraced(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for _, _, _, future in self._waiters:
+            future.cancel()
+        self._waiters.clear()
+
+    async def acquire(self, chat_id, priority=REPLY):
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((priority, next(self._order), chat_id, future))
+        self._wakeup.set()
+        with metrics.telegram_send_wait_seconds.time(priority=str(priority)):
+            await future
+
+    def pause(self, chat_id, seconds):
+        (self.bucket if chat_id is None else self.chat_bucket(chat_id)).pause(seconds)
+        self._wakeup.set()
+
+    def _grant(self):
+        """
+        Lets through every waiter that can go now and returns how long until the next one can.
+        """
+        now = time.monotonic()
+        delay = None
+        waiting = []
+        for waiter in sorted(self._waiters):
+            _, _, chat_id, future = waiter
+            if future.done():
+                continue
+            chat_delay = 0.0 if chat_id is None else self.chat_bucket(chat_id).delay(now)
+            global_delay = self.bucket.delay(now)
+            if global_delay > 0 or chat_delay > 0:
+                waiting.append(waiter)
+                wait = max(global_delay, chat_delay)
+                delay = wait if delay is None else min(delay, wait)
+                continue
+            self.bucket.take()
+            if chat_id is not None:
+                self.chat_bucket(chat_id).take()
+            future.set_result(None)
+        self._waiters = waiting
+        # Buckets that are full again behave like new ones.
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items() if bucket.idle(now)]:
+            del self.chat_buckets[chat_id]
+        return delay
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._grant()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+class ThrottlingMiddleware(BaseRequestMiddleware):
+    """
+    Passes every request that posts or edits a message through the scheduler, and sends it again,
+    at most MAX_RETRIES times, when Telegram answers with retry_after. Previews are not sent again,
+    a later edit replaces them anyway.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot, method):
+        if not method.__api_method__.startswith(THROTTLED_PREFIXES):
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        value = _priority.get()
+        for attempt in itertools.count():
+            await self.scheduler.acquire(chat_id, value)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                metrics.telegram_retry_after_total.inc(method=method.__api_method__)
+                logger.warning(f"Flood control on {method.__api_method__} in chat {chat_id}, "
+                               f"retry in {e.retry_after} s")
+                self.scheduler.pause(chat_id, e.retry_after)
+                if value == PREVIEW or attempt >= MAX_RETRIES:
+                    raise
+
+
+class ErrorDigest:
+    """
+    Reports errors to ERRORS_CHAT_ID with low priority. The first error of a kind goes out at once,
+    repeats of it are counted and sent as one digest every ERROR_DIGEST_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.bot = None
+        self._seen = set()
+        self._repeats = {}
+        self._task = None
+
+    def start(self, bot):
+        self.bot = bot
+        if self._task is None or self._task.done():
+            self._task = metrics.start_untraced(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def report(self, text, trace_id=None):
+        # Errors that only differ in ids and numbers are the same kind.
+        kind = _volatile_re.sub("#", text)
+        if kind not in self._seen:
+            self._seen.add(kind)
+            await self._send(text if trace_id is None else f"{text} (trace {trace_id})")
+            return
+        count, _, traces = self._repeats.get(kind, (0, text, []))
+        self._repeats[kind] = (count + 1, text, (traces + [trace_id])[-3:] if trace_id else traces)
+
+    async def flush(self):
+        repeats, self._repeats = self._repeats, {}
+        self._seen.clear()
+        if not repeats:
+            return
+        lines = [f"{count}× {text}" + (f" (last traces {', '.join(traces)})" if traces else "")
+                 for count, text, traces in sorted(repeats.values(), key=lambda item: -item[0])]
+        await self._send(f"Repeated errors in the last {ERROR_DIGEST_INTERVAL / 60:.0f} min:\n" + "\n".join(lines))
+
+    async def _send(self, text):
+        chat_id = os.getenv("ERRORS_CHAT_ID")
+        if self.bot is None or not chat_id:
+            logger.error(f"Not reported: {text}")
+            return
+        try:
+            with priority(REPORT):
+                await self.bot.send_message(chat_id=chat_id, text=text[:4096], parse_mode=None)
+        except Exception as e:
+            logger.error(f"Could not report an error to the errors chat: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(ERROR_DIGEST_INTERVAL)
+            await self.flush()
+
+
+scheduler = SendScheduler()
+errors = ErrorDigest()
@@ -0,0 +1,50 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+# The bot's modules live at the top of the repository, not in a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import transcoder  # noqa: E402
+from benchmark import write_wav  # noqa: E402
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which(transcoder.FFMPEG_BINARY) is None, reason="ffmpeg is not installed")
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """
+    Points db at a fresh users.db in a temporary directory.
+    """
+    db.close_connection()
+    monkeypatch.setattr(db, "db_name", str(tmp_path / "users.db"))
+    db.user_cache.clear()
+    db.create_database()
+    yield db
+    db.close_connection()
+    db.user_cache.clear()
+
+
+@pytest.fixture
+def cache_database(tmp_path, monkeypatch):
+    """
+    Points cache_db at a fresh transcripts.db in a temporary directory.
+    """
+    import cache_db
+    cache_db.close_connection()
+    monkeypatch.setattr(cache_db, "cache_db_name", str(tmp_path / "transcripts.db"))
+    yield cache_db
+    cache_db.close_connection()
+
+
+@pytest.fixture
+def wav_path(tmp_path):
+    """
+    A few seconds of speech-like audio in a WAV file, which the ASR does not take as is.
+    """
+    path = str(tmp_path / "speech.wav")
+    write_wav(path, 8)
+    return path
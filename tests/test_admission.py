@@ -0,0 +1,64 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import admission
+from admission import ThroughputHistory
+from custom_exceptions import MediaRejectedException
+
+
+@pytest.fixture(autouse=True)
+def history(monkeypatch):
+    history = ThroughputHistory()
+    monkeypatch.setattr(admission, "history", history)
+    return history
+
+
+def make_bot(local=False):
+    return SimpleNamespace(session=SimpleNamespace(api=SimpleNamespace(is_local=local)))
+
+
+def make_media(size, duration):
+    return SimpleNamespace(file_unique_id="file", file_size=size, duration=duration, mime_type="video/mp4")
+
+
+def admit(media, bot=None):
+    return asyncio.run(admission.admit(bot or make_bot(), media))
+
+
+def test_a_file_too_big_for_the_cloud_bot_api_is_rejected():
+    media = make_media(admission.CLOUD_MAX_DOWNLOAD_BYTES + 1, 60)
+    with pytest.raises(MediaRejectedException) as raised:
+        admit(media)
+    assert (raised.value.reason, raised.value.limit) == ("too_big", admission.CLOUD_MAX_DOWNLOAD_BYTES)
+    assert admit(media, make_bot(local=True)).size == media.file_size
+
+
+def test_a_recording_too_long_is_rejected():
+    with pytest.raises(MediaRejectedException) as raised:
+        admit(make_media(1000, admission.MAX_MEDIA_SECONDS + 1))
+    assert raised.value.reason == "too_long"
+
+
+def test_an_admitted_file_gets_an_estimate_from_the_backend_before_there_is_history():
+    admitted = admit(make_media(1000, 20))
+    assert admitted.seconds == 20
+    assert admitted.backend is not None
+    assert admitted.eta == pytest.approx(admitted.backend.prior_latency(20))
+
+
+def test_estimates_follow_the_observed_throughput(history):
+    for _ in range(admission.HISTORY_MIN_JOBS):
+        history.record(60, 30)
+    assert admit(make_media(1000, 600)).eta == pytest.approx(300)
+    # Short jobs take at least as long as the shortest one seen.
+    assert history.processing_seconds(10) == 30
+
+
+def test_queue_seconds(history):
+    assert admission.queue_seconds(1, free_workers=2, workers=2) == 0
+    assert admission.queue_seconds(3, free_workers=0, workers=2) is None
+    for elapsed in (10, 20, 30):
+        history.record(60, elapsed)
+    assert admission.queue_seconds(3, free_workers=0, workers=2) == pytest.approx(30)
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+import asr_router
+import transcoder
+from asr_router import ASRBackend, ASRRouter, AudioSource
+from custom_exceptions import ASRException
+
+
+class FakeBackend(ASRBackend):
+    def __init__(self, name, overhead=1.0, cost_per_minute=0.0, max_seconds=None, fails=False):
+        self.name = name
+        self.overhead = overhead
+        self.cost_per_minute = cost_per_minute
+        self.max_seconds = max_seconds
+        self.fails = fails
+        self.calls = 0
+        super().__init__()
+
+    async def recognize(self, source):
+        self.calls += 1
+        if self.fails:
+            raise RuntimeError(f"{self.name} is down")
+        return [self.name]
+
+
+def test_every_accepted_encoding_has_a_suffix():
+    for backend in asr_router.router.backends:
+        for encoding in backend.encodings or ():
+            assert encoding in transcoder.ENCODING_SUFFIXES
+
+
+def test_the_fastest_backend_that_accepts_the_audio_goes_first():
+    fast, slow, short = FakeBackend("fast", 1.0), FakeBackend("slow", 5.0), FakeBackend("short", 0.1, max_seconds=30)
+    router = ASRRouter([slow, fast, short])
+    assert router.choose("OGG_OPUS", 10) == [short, fast, slow]
+    assert router.choose("OGG_OPUS", 600) == [fast, slow]
+
+
+def test_cost_is_weighed_against_latency():
+    cheap, dear = FakeBackend("cheap", 2.0), FakeBackend("dear", 1.0, cost_per_minute=10.0)
+    assert ASRRouter([dear, cheap]).choose("MP3", 60) == [cheap, dear]
+
+
+def test_no_backend_accepts_the_audio():
+    with pytest.raises(ASRException):
+        ASRRouter([FakeBackend("short", max_seconds=30)]).choose("OGG_OPUS", 60)
+
+
+def test_a_failed_backend_fails_over_to_the_next():
+    down, up = FakeBackend("down", 0.1, fails=True), FakeBackend("up", 10.0)
+    source = AudioSource("OGG_OPUS", seconds=10, content=b"audio")
+    assert asyncio.run(ASRRouter([down, up]).recognize(source)) == ["up"]
+    assert (down.calls, up.calls) == (1, 1)
+
+
+def test_a_backend_that_keeps_failing_goes_last_while_it_cools_down():
+    down, up = FakeBackend("down", 0.01), FakeBackend("up", 1000.0)
+    router = ASRRouter([down, up])
+    for _ in range(asr_router.MAX_CONSECUTIVE_FAILURES - 1):
+        down.stats.record_failure()
+    assert router.choose("OGG_OPUS", 10) == [down, up]
+    down.stats.record_failure()
+    assert router.choose("OGG_OPUS", 10) == [up, down]
+
+
+def test_the_last_error_is_raised_when_every_backend_fails():
+    router = ASRRouter([FakeBackend("first", fails=True), FakeBackend("second", fails=True)])
+    with pytest.raises(RuntimeError, match="is down"):
+        asyncio.run(router.recognize(AudioSource("OGG_OPUS", seconds=10, content=b"audio")))
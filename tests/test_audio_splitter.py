@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+import audio_splitter
+import transcoder
+import transcript
+from benchmark import write_wav
+from conftest import needs_ffmpeg
+
+
+def test_a_cancelled_probe_kills_the_process(monkeypatch):
+    processes = []
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def spawn(*args, **kwargs):
+        process = await create_subprocess_exec(*args, **kwargs)
+        processes.append(process)
+        return process
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", spawn)
+
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(audio_splitter._run("sleep", "30"), 0.2)
+
+    asyncio.run(main())
+    assert processes[0].returncode is not None
+
+
+def test_plan_segments_cuts_in_silences():
+    silences = [(290.0, 291.0), (580.0, 582.0), (700.0, 701.0)]
+    segments = audio_splitter.plan_segments(1000, silences, target=300, maximum=360)
+    assert segments[0] == (0.0, 290.5)
+    assert segments[1] == (290.5, 581.0)
+    assert segments[-1][1] == 1000
+    assert all(end - start <= 360 for start, end in segments)
+    assert all(previous[1] == following[0] for previous, following in zip(segments, segments[1:]))
+
+
+def test_plan_segments_cuts_hard_without_silences():
+    assert audio_splitter.plan_segments(800, [], target=300, maximum=360) == [(0.0, 360), (360, 720), (720, 800)]
+
+
+def test_a_failed_segment_cancels_the_others(tmp_path, monkeypatch):
+    cancelled = []
+    ready = []
+
+    async def detect_silences(path):
+        return []
+
+    async def transcode(source_path, target_path, media=None, start=None, duration=None):
+        return transcoder.TARGET_ENCODING
+
+    async def recognize(path, encoding, seconds):
+        if path.endswith("segment_0001" + transcoder.TARGET_SUFFIX):
+            await asyncio.sleep(0.05)
+            raise RuntimeError("recognition failed")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(path)
+            raise
+        return [transcript.Segment(0.0, seconds, "text")]
+
+    async def on_ready(segments):
+        ready.append(segments)
+
+    monkeypatch.setattr(audio_splitter, "detect_silences", detect_silences)
+    monkeypatch.setattr(transcoder, "transcode", transcode)
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await audio_splitter.transcribe_chunked("audio.ogg", "OGG_OPUS", recognize, duration=1000,
+                                                    concurrency=4, on_ready=on_ready)
+
+    asyncio.run(main())
+    # 1000 seconds make three segments: the two besides the failed one are stopped.
+    assert len(cancelled) == 2
+    assert ready == []
+
+
+@needs_ffmpeg
+def test_a_transcode_closed_early_leaves_no_tasks(tmp_path):
+    path = str(tmp_path / "long.wav")
+    write_wav(path, 120)
+
+    async def main():
+        output = transcoder.transcode_stream(source_path=path)
+        assert await output.__anext__()
+        await output.aclose()
+        return asyncio.all_tasks() - {asyncio.current_task()}
+
+    assert asyncio.run(main()) == set()
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+import completion_cache
+
+OPTIONS = {"model": "gpt-4o-mini", "temperature": 0}
+
+
+@pytest.fixture
+def cache(cache_database, monkeypatch):
+    monkeypatch.setattr(completion_cache, "stats", {"hit": 0, "miss": 0, "bypass": 0})
+    return completion_cache
+
+
+@pytest.mark.parametrize("other", ["о чём был разговор", "  О чём был   разговор?! ", "О чем был разговор"])
+def test_questions_differing_in_case_punctuation_and_spaces_share_a_key(other):
+    assert completion_cache.make_key("t", "О чём был разговор?", OPTIONS) == completion_cache.make_key("t", other, OPTIONS)
+
+
+@pytest.mark.parametrize("transcript_hash, question, options", [
+    ("other", "О чём был разговор?", OPTIONS),
+    ("t", "Кто участвовал в разговоре?", OPTIONS),
+    ("t", "О чём был разговор?", dict(OPTIONS, model="gpt-4o")),
+])
+def test_other_transcripts_questions_or_options_get_other_keys(transcript_hash, question, options):
+    key = completion_cache.make_key("t", "О чём был разговор?", OPTIONS)
+    assert completion_cache.make_key(transcript_hash, question, options) != key
+
+
+@pytest.mark.parametrize("question, stripped, regenerate", [
+    ("/regen О чём был разговор?", "О чём был разговор?", True),
+    ("Заново: о чём был разговор?", "о чём был разговор?", True),
+    ("О чём был разговор?", "О чём был разговор?", False),
+])
+def test_split_regenerate(question, stripped, regenerate):
+    assert completion_cache.split_regenerate(question) == (stripped, regenerate)
+
+
+def test_answers_are_cached_and_counted(cache):
+    assert cache.get_answer("key") is None
+    cache.put_answer("key", "Ответ")
+    assert cache.get_answer("key") == "Ответ"
+    cache.count_bypass()
+    assert cache.stats == {"hit": 1, "miss": 1, "bypass": 1}
+    assert cache.hit_rate() == 0.5
+
+
+def test_answers_expire(cache, monkeypatch):
+    cache.put_answer("key", "Ответ")
+    monkeypatch.setattr(time, "time", lambda now=time.time(): now + cache.CACHE_TTL + 1)
+    assert cache.get_answer("key") is None
+
+
+def test_the_least_recently_used_answers_are_evicted(cache, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_MAX_ENTRIES", 2)
+    clock = iter(range(1_000_000, 2_000_000))
+    monkeypatch.setattr(time, "time", lambda: next(clock))
+    cache.put_answer("first", "1")
+    cache.put_answer("second", "2")
+    cache.get_answer("first")
+    cache.put_answer("third", "3")
+    assert [cache.get_answer(key) for key in ("first", "second", "third")] == ["1", None, "3"]
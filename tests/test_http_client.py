@@ -0,0 +1,89 @@
+import asyncio
+
+import httpx
+import pytest
+
+import http_client
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """
+    Answers requests with the queued responses, or raises the queued exceptions, in order.
+    """
+    replies = []
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        reply = replies.pop(0) if replies else 200
+        if isinstance(reply, Exception):
+            raise reply
+        return httpx.Response(reply)
+
+    monkeypatch.setattr(http_client, "backoff_delay", lambda attempt, response=None: 0)
+    http_client.start(httpx.MockTransport(handler))
+    yield replies, requests
+    asyncio.run(http_client.close())
+
+
+def send(method, **kwargs):
+    return asyncio.run(http_client.request("test", method, "https://example.com/", **kwargs)).status_code
+
+
+@pytest.mark.parametrize("reply", [502, 429, httpx.ConnectError("refused"), httpx.RemoteProtocolError("reset")])
+def test_gets_are_retried(server, reply):
+    replies, requests = server
+    replies.append(reply)
+    assert send("GET") == 200
+    assert len(requests) == 2
+
+
+@pytest.mark.parametrize("reply", [429, httpx.ConnectError("refused")])
+def test_posts_are_retried_when_the_server_did_not_act_on_them(server, reply):
+    replies, requests = server
+    replies.append(reply)
+    assert send("POST") == 200
+    assert len(requests) == 2
+
+
+def test_posts_are_not_retried_after_a_server_error(server):
+    replies, requests = server
+    replies.append(502)
+    assert send("POST") == 502
+    assert len(requests) == 1
+
+
+def test_posts_are_not_retried_after_a_broken_connection(server):
+    replies, requests = server
+    replies.append(httpx.RemoteProtocolError("reset"))
+    with pytest.raises(httpx.RemoteProtocolError):
+        send("POST")
+    assert len(requests) == 1
+
+
+def test_idempotent_posts_are_retried(server):
+    replies, requests = server
+    replies.append(503)
+    assert send("POST", idempotent=True) == 200
+    assert len(requests) == 2
+
+
+def test_retries_are_limited(server, monkeypatch):
+    replies, requests = server
+    monkeypatch.setattr(http_client, "MAX_RETRIES", 2)
+    replies.extend([503] * 5)
+    assert send("GET") == 503
+    assert len(requests) == 3
+
+
+def test_streamed_posts_are_not_retried_after_a_server_error(server):
+    replies, requests = server
+    replies.append(500)
+
+    async def main():
+        async with http_client.stream("test", "POST", "https://example.com/") as response:
+            return response.status_code
+
+    assert asyncio.run(main()) == 500
+    assert len(requests) == 1
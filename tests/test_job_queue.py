@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from custom_exceptions import QueueFullException
+from job_queue import JobQueue
+
+
+def recorder(order, name):
+    async def job():
+        order.append(name)
+    return job
+
+
+def test_positions_follow_round_robin_order():
+    queue = JobQueue(max_size=10, max_per_user=5, workers=1)
+    assert queue.submit("a", recorder([], "a1")) == 1
+    assert queue.submit("a", recorder([], "a2")) == 2
+    assert queue.submit("a", recorder([], "a3")) == 3
+    # b's first job goes right after a's first one.
+    assert queue.submit("b", recorder([], "b1")) == 2
+    assert queue.submit("b", recorder([], "b2")) == 4
+    assert queue.submit("c", recorder([], "c1")) == 3
+    assert len(queue) == 6
+
+
+def test_workers_take_users_in_turn():
+    order = []
+
+    async def main():
+        queue = JobQueue(max_size=10, max_per_user=5, workers=1)
+        for name in ["a1", "a2", "a3"]:
+            queue.submit("a", recorder(order, name))
+        for name in ["b1", "b2"]:
+            queue.submit("b", recorder(order, name))
+        queue.submit("c", recorder(order, "c1"))
+        queue.start()
+        while len(queue) or queue.idle_workers < queue.workers:
+            await asyncio.sleep(0)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert order == ["a1", "b1", "c1", "a2", "b2", "a3"]
+
+
+def test_dispatch_order_matches_the_positions():
+    order = []
+    positions = {}
+
+    async def main():
+        queue = JobQueue(max_size=20, max_per_user=10, workers=1)
+        for user_id, count in [("a", 4), ("b", 1), ("c", 3)]:
+            for number in range(count):
+                queue.submit(user_id, recorder(order, f"{user_id}{number}"))
+        for user_id, count in [("a", 4), ("b", 1), ("c", 3)]:
+            for number in range(count):
+                positions[f"{user_id}{number}"] = queue.position(user_id, number)
+        queue.start()
+        while len(queue) or queue.idle_workers < queue.workers:
+            await asyncio.sleep(0)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert sorted(positions, key=positions.get) == order
+
+
+def test_limits():
+    queue = JobQueue(max_size=3, max_per_user=2, workers=1)
+    queue.submit("a", recorder([], "a1"))
+    queue.submit("a", recorder([], "a2"))
+    with pytest.raises(QueueFullException):
+        queue.submit("a", recorder([], "a3"))
+    queue.submit("b", recorder([], "b1"))
+    with pytest.raises(QueueFullException):
+        queue.submit("c", recorder([], "c1"))
+
+
+def test_a_failed_job_does_not_stop_the_worker():
+    order = []
+
+    async def fail():
+        raise RuntimeError("boom")
+
+    async def main():
+        queue = JobQueue(max_size=10, max_per_user=5, workers=1)
+        queue.submit("a", fail)
+        queue.submit("a", recorder(order, "a2"))
+        queue.start()
+        while len(queue) or queue.idle_workers < queue.workers:
+            await asyncio.sleep(0)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert order == ["a2"]
@@ -0,0 +1,140 @@
+import asyncio
+import re
+from types import SimpleNamespace
+
+import pytest
+
+import jobs
+import transcript
+from file_utils import TranscriptDelivery
+
+JOB_KEY = "100:7"
+USER_ID = 1
+DAY = "2024-05-01"
+
+
+class FakeMessage:
+    """
+    Records what the bot sends in reply to a media message.
+    """
+
+    def __init__(self):
+        self.chat = SimpleNamespace(id=100)
+        self.message_id = 7
+        self.texts = []
+        self.documents = 0
+
+    async def answer(self, text, **kwargs):
+        self.texts.append(text)
+
+    async def answer_document(self, document, caption=None, **kwargs):
+        return [await self._document(caption)]
+
+    async def answer_media_group(self, media, **kwargs):
+        return [await self._document(item.caption) for item in media]
+
+    async def _document(self, caption):
+        if caption:
+            self.texts.append(caption)
+        self.documents += 1
+        return SimpleNamespace(message_id=1000 + self.documents)
+
+
+def make_part(first, count):
+    # Long enough that every part fills more than one message.
+    return [transcript.Segment(number * 10.0, number * 10.0 + 10, f"Фраза {number}. " + "слово " * 15)
+            for number in range(first, first + count)]
+
+
+def sent_phrases(message):
+    return [int(number) for text in message.texts for number in re.findall(r"Фраза (\d+)\.", text)]
+
+
+@pytest.fixture
+def job(database, cache_database):
+    state, delivered = database.create_job(JOB_KEY, USER_ID, "{}", jobs.QUEUED)
+    assert (state, delivered) == (jobs.QUEUED, 0)
+    return JOB_KEY
+
+
+def test_create_is_idempotent(database, job):
+    database.set_job_state(job, jobs.RECOGNIZING)
+    database.set_job_delivered(job, 12)
+    assert database.create_job(job, USER_ID, "{}", jobs.QUEUED) == (jobs.RECOGNIZING, 12)
+
+
+def test_a_resumed_job_sends_every_segment_once(database, job):
+    parts = [make_part(0, 60), make_part(60, 60), make_part(120, 5)]
+    segments = [segment for part in parts for segment in part]
+
+    async def first_run(message):
+        delivery = TranscriptDelivery(message, job)
+        await delivery.add(parts[0])
+        # The bot stops before the rest of the recording is recognised.
+
+    async def second_run(message):
+        _, delivered = await jobs.create(SimpleNamespace(chat=message.chat, message_id=message.message_id,
+                                                         from_user=SimpleNamespace(id=USER_ID),
+                                                         model_dump_json=lambda **kwargs: "{}"))
+        delivery = TranscriptDelivery(message, job, delivered)
+        # Recognised parts come back from job_parts, in order, before the new ones.
+        for part in parts:
+            await delivery.add(part)
+        await delivery.finish(segments)
+
+    before, after = FakeMessage(), FakeMessage()
+    asyncio.run(first_run(before))
+    assert sent_phrases(before) == list(range(60))
+    asyncio.run(second_run(after))
+    assert sent_phrases(before) + sent_phrases(after) == list(range(len(segments)))
+    assert after.documents == 2
+
+
+def test_a_delivered_transcript_is_not_sent_again(database, job):
+    segments = make_part(0, 60)
+
+    async def run(message, delivered):
+        delivery = TranscriptDelivery(message, job, delivered)
+        await delivery.add(segments)
+        await delivery.finish(segments)
+
+    first = FakeMessage()
+    asyncio.run(run(first, 0))
+    assert sent_phrases(first) == list(range(60))
+
+    _, delivered = database.create_job(job, USER_ID, "{}", jobs.QUEUED)
+    assert delivered == len(segments)
+    again = FakeMessage()
+    asyncio.run(run(again, delivered))
+    assert sent_phrases(again) == []
+
+
+def test_a_resumed_job_is_charged_once(database, job):
+    database.add_user(USER_ID, "user@example.com")
+    database.update_minutes(USER_ID, max_minutes=10)
+    for _ in range(3):
+        assert database.reserve_job_minutes(job, USER_ID, 4, DAY)
+    database.settle_job_minutes(job, "committed")
+    assert database.reserve_job_minutes(job, USER_ID, 4, DAY)
+    database.settle_job_minutes(job, "committed")
+    assert database.get_user_minutes(USER_ID, DAY) == (10, 4)
+
+
+def test_stored_parts_are_found_by_their_start(database, job):
+    segments = make_part(0, 2)
+
+    async def main():
+        with jobs.running(job):
+            with jobs.part(300.0):
+                assert await jobs.stored_part() == (None, None)
+                await jobs.record_operation("operation")
+                await jobs.save_part(segments)
+            with jobs.part(0.0):
+                assert await jobs.stored_part() == (None, None)
+            with jobs.part(300.0):
+                return await jobs.stored_part()
+
+    operation_id, stored = asyncio.run(main())
+    assert operation_id == "operation"
+    assert [segment.text for segment in stored] == [segment.text for segment in segments]
+    assert database.create_job(job, USER_ID, "{}", jobs.QUEUED)[0] == jobs.RECOGNIZING
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+from custom_exceptions import QueueFullException
+
+STALE_SECONDS = 60
+
+
+def pending(database):
+    with database.db_lock:
+        return database.get_connection().execute(
+            "SELECT id, status, worker FROM media_jobs ORDER BY id").fetchall()
+
+
+def test_jobs_are_claimed_once(database):
+    assert database.enqueue_media_job(1, "first", 10, 5) == 1
+    assert database.enqueue_media_job(1, "second", 10, 5) == 2
+    first = database.claim_media_job("a", STALE_SECONDS)
+    second = database.claim_media_job("b", STALE_SECONDS)
+    assert (first[1], second[1]) == ("first", "second")
+    assert database.claim_media_job("c", STALE_SECONDS) is None
+
+
+def test_users_with_fewer_running_jobs_go_first(database):
+    database.enqueue_media_job(1, "1a", 10, 5)
+    database.enqueue_media_job(1, "1b", 10, 5)
+    database.enqueue_media_job(2, "2a", 10, 5)
+    assert database.claim_media_job("a", STALE_SECONDS)[1] == "1a"
+    assert database.claim_media_job("b", STALE_SECONDS)[1] == "2a"
+    assert database.claim_media_job("c", STALE_SECONDS)[1] == "1b"
+
+
+def test_queue_limits(database):
+    database.enqueue_media_job(1, "1a", 2, 1)
+    with pytest.raises(QueueFullException):
+        database.enqueue_media_job(1, "1b", 2, 1)
+    database.enqueue_media_job(2, "2a", 2, 1)
+    with pytest.raises(QueueFullException):
+        database.enqueue_media_job(3, "3a", 2, 1)
+
+
+def test_a_stale_job_is_taken_over(database):
+    database.enqueue_media_job(1, "job", 10, 5)
+    job_id = database.claim_media_job("a", STALE_SECONDS)[0]
+    assert database.claim_media_job("b", STALE_SECONDS) is None
+    time.sleep(0.01)
+    assert database.claim_media_job("b", 0)[0] == job_id
+
+    # The first worker comes back: it neither finishes nor releases the job the second one runs.
+    database.finish_media_job(job_id, "a")
+    database.release_media_job(job_id, "a")
+    database.renew_media_job(job_id, "a")
+    assert pending(database) == [(job_id, "running", "b")]
+
+    database.finish_media_job(job_id, "b")
+    assert pending(database) == []
+
+
+def test_a_released_job_is_queued_again(database):
+    database.enqueue_media_job(1, "job", 10, 5)
+    job_id = database.claim_media_job("a", STALE_SECONDS)[0]
+    database.release_media_job(job_id, "a")
+    assert pending(database) == [(job_id, "pending", None)]
+    assert database.claim_media_job("b", STALE_SECONDS)[0] == job_id
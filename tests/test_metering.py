@@ -0,0 +1,117 @@
+import asyncio
+import threading
+
+import pytest
+
+import metering
+from custom_exceptions import QuotaExceededException
+
+USER_ID = 1
+DAY = "2024-05-01"
+
+
+@pytest.fixture
+def user(database):
+    database.add_user(USER_ID, "user@example.com")
+    database.update_minutes(USER_ID, max_minutes=10)
+    return USER_ID
+
+
+def reserved_minutes(database):
+    with database.db_lock:
+        return database.get_connection().execute(
+            "SELECT reserved_minutes FROM users WHERE user_id = ?", (USER_ID,)).fetchone()[0]
+
+
+def test_billable_minutes_rounds_up():
+    assert metering.billable_minutes(0) == 1
+    assert metering.billable_minutes(60) == 1
+    assert metering.billable_minutes(61) == 2
+
+
+def test_plan_minutes_takes_the_best_plan():
+    goods = [{"name": "Подписка 60 минут в день"}, {"name": "Подписка 120 минут"}, {"name": "Стикеры"}]
+    assert metering.plan_minutes(goods) == 120
+    assert metering.plan_minutes([{"name": "Стикеры"}]) == metering.DEFAULT_DAILY_MINUTES
+    assert metering.plan_minutes([]) == 0
+
+
+def test_reserve_is_refused_beyond_the_allowance(database, user):
+    assert database.reserve_minutes(user, 6, DAY)
+    assert not database.reserve_minutes(user, 5, DAY)
+    assert database.reserve_minutes(user, 4, DAY)
+    assert reserved_minutes(database) == 10
+
+
+def test_commit_turns_reserved_minutes_into_used(database, user):
+    assert database.reserve_minutes(user, 3, DAY)
+    database.commit_minutes(user, 3, DAY)
+    assert database.get_user_minutes(user, DAY) == (10, 3)
+    assert reserved_minutes(database) == 0
+
+
+def test_refund_frees_the_minutes(database, user):
+    assert database.reserve_minutes(user, 10, DAY)
+    database.refund_minutes(user, 10, DAY)
+    assert database.get_user_minutes(user, DAY) == (10, 0)
+    assert database.reserve_minutes(user, 10, DAY)
+
+
+def test_a_new_day_resets_the_counters(database, user):
+    assert database.reserve_minutes(user, 4, DAY)
+    database.commit_minutes(user, 4, DAY)
+    assert database.reserve_minutes(user, 2, DAY)
+    assert database.get_user_minutes(user, "2024-05-02") == (10, 0)
+
+    assert database.reserve_minutes(user, 10, "2024-05-02")
+    # The reservation from the day before is dropped, not charged on the new day.
+    database.commit_minutes(user, 2, DAY)
+    assert database.get_user_minutes(user, "2024-05-02") == (10, 0)
+
+
+def test_concurrent_reservations_never_overdraw(database, user):
+    results = []
+
+    def reserve():
+        results.append(database.reserve_minutes(user, 1, DAY))
+
+    threads = [threading.Thread(target=reserve) for _ in range(30)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 10
+    assert reserved_minutes(database) == 10
+
+
+def test_job_reservation_is_taken_once(database, user):
+    database.create_job("1:1", user, "{}", "queued")
+    assert database.reserve_job_minutes("1:1", user, 4, DAY)
+    # A resumed job keeps its reservation instead of taking the minutes again.
+    assert database.reserve_job_minutes("1:1", user, 4, DAY)
+    assert reserved_minutes(database) == 4
+
+
+def test_job_is_charged_once(database, user):
+    database.create_job("1:1", user, "{}", "queued")
+    assert database.reserve_job_minutes("1:1", user, 4, DAY)
+    database.settle_job_minutes("1:1", "committed")
+    database.settle_job_minutes("1:1", "committed")
+    database.settle_job_minutes("1:1", "refunded")
+    assert database.get_user_minutes(user, DAY) == (10, 4)
+    assert reserved_minutes(database) == 0
+    # A job that was charged does not reserve again when it runs once more.
+    assert database.reserve_job_minutes("1:1", user, 4, DAY)
+    assert reserved_minutes(database) == 0
+
+
+def test_reserve_raises_when_the_allowance_is_spent(database, user):
+    async def main():
+        reservation = await metering.reserve(user, 9 * 60)
+        with pytest.raises(QuotaExceededException):
+            await metering.reserve(user, 2 * 60)
+        await metering.refund(reservation)
+        await metering.commit(await metering.reserve(user, 2 * 60))
+
+    asyncio.run(main())
+    assert database.get_user_minutes(user, metering.today()) == (10, 2)
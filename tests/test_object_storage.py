@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+import object_storage  # noqa: E402
+import transcoder  # noqa: E402
+from conftest import needs_ffmpeg  # noqa: E402
+
+PART_SIZE = 5 * 1024 * 1024
+
+
+@pytest.fixture
+def s3(database, monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("aws_access_key_id", "testing")
+    monkeypatch.setenv("aws_secret_access_key", "testing")
+    monkeypatch.delenv("endpoint_url", raising=False)
+    monkeypatch.setattr(object_storage, "UPLOAD_PART_SIZE", PART_SIZE)
+    monkeypatch.setattr(object_storage, "DELETE_WAIT_INTERVAL", 0.01)
+    with moto.mock_aws():
+        object_storage._client = None
+        client = object_storage.get_client()
+        client.create_bucket(Bucket=object_storage.BUCKET)
+        yield client
+    object_storage._client = None
+
+
+def keys(client):
+    response = client.list_objects_v2(Bucket=object_storage.BUCKET, Prefix=object_storage.PREFIX)
+    return {item["Key"] for item in response.get("Contents", [])}
+
+
+async def chunks(data, size=1024 * 1024):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def test_equal_content_shares_one_object(s3):
+    async def main():
+        first = await object_storage.upload_bytes(b"audio", ".ogg")
+        second = await object_storage.upload_bytes(b"audio", ".ogg")
+        assert first == second == object_storage.content_key(hashlib.sha256(b"audio").hexdigest(), ".ogg")
+        assert keys(s3) == {first}
+
+        await object_storage.release(first)
+        # The other job still holds the object.
+        assert keys(s3) == {first}
+        await object_storage.release(second)
+        assert keys(s3) == set()
+
+    asyncio.run(main())
+
+
+def test_upload_file_is_content_addressed(s3, tmp_path):
+    path = tmp_path / "audio.ogg"
+    path.write_bytes(b"file content")
+
+    async def main():
+        key = await object_storage.upload_file(str(path), ".ogg")
+        assert key == object_storage.content_key(hashlib.sha256(b"file content").hexdigest(), ".ogg")
+        assert await object_storage.download(key) == b"file content"
+        assert await object_storage.exists(key)
+        await object_storage.release(key)
+        assert not await object_storage.exists(key)
+
+    asyncio.run(main())
+
+
+@needs_ffmpeg
+def test_converted_audio_is_stored_once(s3, wav_path, tmp_path):
+    async def main():
+        uploaded = []
+        for name in ["first.ogg", "second.ogg"]:
+            target = str(tmp_path / name)
+            await transcoder.transcode(wav_path, target)
+            uploaded.append(await object_storage.upload_file(target, transcoder.TARGET_SUFFIX))
+        assert uploaded[0] == uploaded[1]
+        assert keys(s3) == {uploaded[0]}
+
+    asyncio.run(main())
+
+
+def test_short_stream_is_one_put(s3):
+    async def main():
+        key = await object_storage.upload_stream(chunks(b"x" * 1000), object_storage.source_key("file", "ogg"))
+        assert await object_storage.download(key) == b"x" * 1000
+        await object_storage.release(key)
+
+    asyncio.run(main())
+
+
+def test_long_stream_is_a_multipart_upload(s3):
+    data = bytes(range(256)) * (PART_SIZE * 2 // 256 + 1000)
+
+    async def main():
+        key = await object_storage.upload_stream(chunks(data), object_storage.source_key("file", "ogg"))
+        assert await object_storage.download(key) == data
+        head = await asyncio.to_thread(s3.head_object, Bucket=object_storage.BUCKET, Key=key)
+        # Multipart ETags end with the number of parts.
+        assert head["ETag"].strip('"').endswith("-3")
+        await object_storage.release(key)
+
+    asyncio.run(main())
+
+
+def test_failed_stream_aborts_the_upload(s3, database):
+    async def failing():
+        yield b"x" * PART_SIZE
+        yield b"x" * PART_SIZE
+        raise RuntimeError("download failed")
+
+    key = object_storage.source_key("file", "ogg")
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await object_storage.upload_stream(failing(), key)
+
+    asyncio.run(main())
+    assert keys(s3) == set()
+    assert s3.list_multipart_uploads(Bucket=object_storage.BUCKET).get("Uploads", []) == []
+    assert database.get_leased_objects(0) == set()
+
+
+def test_sweeper_keeps_held_objects(s3, database, monkeypatch):
+    monkeypatch.setattr(object_storage, "ORPHAN_TTL", 1)
+    held = asyncio.run(object_storage.upload_bytes(b"held"))
+    s3.put_object(Bucket=object_storage.BUCKET, Key=object_storage.content_key("orphan"), Body=b"orphan")
+    time.sleep(1.5)
+    # Another job takes a hold on the object, the hold of the first one is older than ORPHAN_TTL.
+    database.acquire_object(held)
+    assert object_storage.sweep_orphans() == 1
+    assert keys(s3) == {held}
+
+
+def test_sweeper_removes_objects_of_dead_processes(s3):
+    asyncio.run(object_storage.upload_bytes(b"held"))
+    later = datetime.now(timezone.utc) + timedelta(seconds=object_storage.ORPHAN_TTL + 60)
+    assert object_storage.sweep_orphans(now=later) == 1
+    assert keys(s3) == set()
+
+
+def test_sweeper_ignores_recent_objects(s3):
+    s3.put_object(Bucket=object_storage.BUCKET, Key=object_storage.content_key("recent"), Body=b"recent")
+    assert object_storage.sweep_orphans() == 0
+    assert len(keys(s3)) == 1
@@ -0,0 +1,98 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import http_client
+import operation_poller
+from operation_poller import OperationPoller
+
+
+@pytest.fixture
+def operations(monkeypatch):
+    """
+    Fakes the Yandex operation endpoint. Maps an operation id to how long its poll takes
+    and how many polls it takes to finish, and records the polls.
+    """
+    monkeypatch.setattr(operation_poller, "MIN_FIRST_POLL", 0.01)
+    monkeypatch.setattr(operation_poller, "PROCESSING_RATIO", 0.0)
+    monkeypatch.setattr(operation_poller, "DEADLINE_SLACK", 5.0)
+    state = SimpleNamespace(latency={}, polls_needed={}, polls=[])
+
+    async def request(service, method, url, **kwargs):
+        operation_id = url.rsplit("/", 1)[1]
+        state.polls.append(operation_id)
+        await asyncio.sleep(state.latency.get(operation_id, 0))
+        done = state.polls.count(operation_id) >= state.polls_needed.get(operation_id, 1)
+        return SimpleNamespace(json=lambda: {"id": operation_id, "done": done})
+
+    monkeypatch.setattr(http_client, "request", request)
+    return state
+
+
+def test_a_slow_poll_does_not_hold_up_the_others(operations):
+    operations.latency["slow"] = 2.0
+
+    async def main():
+        poller = OperationPoller()
+        slow = asyncio.ensure_future(poller.wait("slow"))
+        await asyncio.sleep(0.05)
+        started = time.monotonic()
+        result = await poller.wait("fast")
+        elapsed = time.monotonic() - started
+        assert not slow.done()
+        slow.cancel()
+        await poller.stop()
+        return result, elapsed
+
+    result, elapsed = asyncio.run(main())
+    assert result["id"] == "fast"
+    assert elapsed < 1.0
+
+
+def test_waiting_twice_for_an_operation_joins_the_first_wait(operations):
+    operations.polls_needed["op"] = 3
+
+    async def main():
+        poller = OperationPoller()
+        results = await asyncio.gather(poller.wait("op"), poller.wait("op"))
+        assert len(poller) == 0
+        await poller.stop()
+        return results
+
+    first, second = asyncio.run(main())
+    assert first == second == {"id": "op", "done": True}
+    assert operations.polls.count("op") == 3
+
+
+def test_a_cancelled_waiter_leaves_the_others_waiting(operations):
+    operations.polls_needed["op"] = 2
+
+    async def main():
+        poller = OperationPoller()
+        first = asyncio.ensure_future(poller.wait("op"))
+        second = asyncio.ensure_future(poller.wait("op"))
+        await asyncio.sleep(0)
+        first.cancel()
+        result = await second
+        await poller.stop()
+        return result
+
+    assert asyncio.run(main())["done"]
+
+
+def test_an_operation_that_never_finishes_times_out(operations, monkeypatch):
+    monkeypatch.setattr(operation_poller, "DEADLINE_SLACK", 0.1)
+    operations.polls_needed["stuck"] = 1000
+
+    async def main():
+        poller = OperationPoller()
+        try:
+            with pytest.raises(TimeoutError):
+                await poller.wait("stuck")
+        finally:
+            await poller.stop()
+
+    asyncio.run(main())
+    assert operations.polls.count("stuck") > 1
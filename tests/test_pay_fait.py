@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+
+import Pay_Fait
+
+GOODS = {"data": {"goods": [{"name": "Подписка 60 минут в день"}]}}
+
+
+@pytest.mark.parametrize("response, goods", [
+    (GOODS, GOODS["data"]["goods"]),
+    ({"data": {"goods": []}}, []),
+    ({"error": "Unauthorized"}, None),
+    ({"data": None}, None),
+    (None, None),
+])
+def test_goods_of(response, goods):
+    assert Pay_Fait.goods_of(response) == goods
+
+
+def test_goods_checks_are_cached_and_coalesced(monkeypatch):
+    fetches = []
+
+    async def fetch_goods(user_id, email, password):
+        fetches.append(user_id)
+        await asyncio.sleep(0.01)
+        Pay_Fait.entitlement_cache[user_id] = (float("inf"), GOODS)
+        return GOODS
+
+    monkeypatch.setattr(Pay_Fait, "_fetch_goods", fetch_goods)
+    monkeypatch.setattr(Pay_Fait, "entitlement_cache", {})
+
+    async def main():
+        results = await asyncio.gather(*(Pay_Fait.auth_and_check_goods(1, "e", "p") for _ in range(5)))
+        results.append(await Pay_Fait.auth_and_check_goods(1, "e", "p"))
+        Pay_Fait.invalidate_entitlement(1)
+        results.append(await Pay_Fait.auth_and_check_goods(1, "e", "p"))
+        return results
+
+    assert asyncio.run(main()) == [GOODS] * 7
+    assert fetches == [1, 1]
@@ -0,0 +1,162 @@
+import asyncio
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+def test_identical_calls_share_one_run():
+    calls = []
+
+    async def fetch(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value * 2
+
+    async def main():
+        flight = SingleFlight("test")
+        results = await asyncio.gather(*(flight.run("key", fetch, 21) for _ in range(5)), flight.run("other", fetch, 1))
+        # The finished call is not shared with later callers.
+        results.append(await flight.run("key", fetch, 21))
+        return results
+
+    assert asyncio.run(main()) == [42] * 5 + [2, 42]
+    assert calls == [21, 1, 21]
+
+
+def test_calls_without_a_key_are_not_shared():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+
+    async def main():
+        flight = SingleFlight("test")
+        await asyncio.gather(flight.run(None, fetch), flight.run(None, fetch))
+
+    asyncio.run(main())
+    assert len(calls) == 2
+
+
+def test_every_caller_gets_the_exception():
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    async def main():
+        flight = SingleFlight("test")
+        return await asyncio.gather(flight.run("key", fail), flight.run("key", fail), return_exceptions=True)
+
+    assert [str(error) for error in asyncio.run(main())] == ["failed", "failed"]
+
+
+def test_a_cancelled_caller_leaves_the_call_running():
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def main():
+        flight = SingleFlight("test")
+        first = asyncio.ensure_future(flight.run("key", fetch))
+        second = asyncio.ensure_future(flight.run("key", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == "done"
+
+
+async def generate_text(calls, words):
+    calls.append(1)
+    text = ""
+    for word in words:
+        await asyncio.sleep(0.01)
+        text += word
+        yield text
+
+
+async def collect(items):
+    return [item async for item in items]
+
+
+def test_identical_streams_share_one_generator():
+    calls = []
+
+    async def main():
+        flight = SingleFlight("test")
+        first = []
+        late = None
+        async for text in flight.stream("key", generate_text, calls, "abc"):
+            first.append(text)
+            if late is None:
+                late = asyncio.ensure_future(collect(flight.stream("key", generate_text, calls, "abc")))
+        return first, await late
+
+    first, late = asyncio.run(main())
+    assert first == late == ["a", "ab", "abc"]
+    assert calls == [1]
+
+
+def test_a_stream_joined_late_starts_from_the_latest_item():
+    calls = []
+
+    async def main():
+        flight = SingleFlight("test")
+        first = asyncio.ensure_future(collect(flight.stream("key", generate_text, calls, "abc")))
+        await asyncio.sleep(0)
+        shared = flight._streams["key"]
+        while shared.latest != "ab":
+            await asyncio.sleep(0.001)
+        late = await collect(flight.stream("key", generate_text, calls, "abc"))
+        assert await first == ["a", "ab", "abc"]
+        return late
+
+    assert asyncio.run(main()) == ["ab", "abc"]
+    assert calls == [1]
+
+
+def test_a_failed_stream_raises_in_every_caller():
+    async def fail():
+        yield "a"
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    async def main():
+        flight = SingleFlight("test")
+        return await asyncio.gather(collect(flight.stream("key", fail)), collect(flight.stream("key", fail)),
+                                    return_exceptions=True)
+
+    assert [str(error) for error in asyncio.run(main())] == ["failed", "failed"]
+
+
+def test_streams_without_a_key_are_not_shared():
+    calls = []
+
+    async def main():
+        flight = SingleFlight("test")
+        return await asyncio.gather(collect(flight.stream(None, generate_text, calls, "ab")),
+                                    collect(flight.stream(None, generate_text, calls, "ab")))
+
+    assert asyncio.run(main()) == [["a", "ab"], ["a", "ab"]]
+    assert calls == [1, 1]
+
+
+@pytest.mark.parametrize("delay", [0, 0.05])
+def test_no_caller_misses_the_last_item(delay):
+    calls = []
+
+    async def slow_reader(flight):
+        items = []
+        async for item in flight.stream("key", generate_text, calls, "abcd"):
+            items.append(item)
+            await asyncio.sleep(delay)
+        return items
+
+    async def main():
+        flight = SingleFlight("test")
+        return await asyncio.gather(slow_reader(flight), collect(flight.stream("key", generate_text, calls, "abcd")))
+
+    slow, fast = asyncio.run(main())
+    assert slow[-1] == fast[-1] == "abcd"
+    assert calls == [1]
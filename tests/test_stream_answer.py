@@ -0,0 +1,106 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+
+import file_utils
+import transcript
+
+
+class FakeReply:
+    def __init__(self, text):
+        self.texts = [text]
+
+    async def edit_text(self, text, **kwargs):
+        self.texts.append(text)
+
+
+class FakeMessage:
+    """
+    Records the replies the bot sends and how they are edited.
+    """
+
+    def __init__(self, chat_id=100):
+        self.chat = SimpleNamespace(id=chat_id)
+        self.message_id = 7
+        self.replies = []
+        self.documents = []
+
+    async def answer(self, text, **kwargs):
+        self.replies.append(FakeReply(text))
+        return self.replies[-1]
+
+    async def answer_document(self, document, caption=None, **kwargs):
+        self.documents.append(caption)
+
+
+async def generate(*texts):
+    for text in texts:
+        yield text
+
+
+def stream(message, *texts):
+    return asyncio.run(file_utils.stream_answer(message, generate(*texts)))
+
+
+def test_the_reply_is_edited_as_the_answer_grows(monkeypatch):
+    monkeypatch.setattr(file_utils, "EDIT_INTERVAL", 0)
+    message = FakeMessage()
+    assert stream(message, "", "Привет", "Привет, мир", "Привет, мир!") == "Привет, мир!"
+    assert len(message.replies) == 1
+    assert message.replies[0].texts == ["Привет", "Привет, мир", "Привет, мир!"]
+    assert len(message.documents) == 1
+
+
+def test_edits_are_throttled_and_the_last_text_is_always_shown(monkeypatch):
+    monkeypatch.setattr(file_utils, "EDIT_INTERVAL", 60)
+    message = FakeMessage()
+    stream(message, "Один", "Один два", "Один два три")
+    assert message.replies[0].texts == ["Один", "Один два три"]
+
+
+def test_groups_are_edited_less_often(monkeypatch):
+    monkeypatch.setattr(file_utils, "EDIT_INTERVAL", 0)
+    monkeypatch.setattr(file_utils, "GROUP_EDIT_INTERVAL", 60)
+    message = FakeMessage(chat_id=-100)
+    stream(message, "Один", "Один два", "Один два три")
+    assert message.replies[0].texts == ["Один", "Один два три"]
+
+
+def test_a_long_answer_continues_in_new_messages(monkeypatch):
+    monkeypatch.setattr(file_utils, "EDIT_INTERVAL", 0)
+    message = FakeMessage()
+    text = "Предложение номер один. " * 400
+    stream(message, text[:3000], text)
+
+    first, *rest = message.replies
+    assert transcript.telegram_length(first.texts[1]) <= transcript.TELEGRAM_MESSAGE_LIMIT
+    assert first.texts[1].endswith("…")
+    assert [first.texts[-1]] + [reply.texts[0] for reply in rest] == transcript.split_message(text)
+
+
+def test_an_answer_that_never_showed_is_sent_whole():
+    message = FakeMessage()
+    assert stream(message, " ", "") == ""
+    assert message.replies == []
+    assert len(message.documents) == 1
+
+
+def failing_edits(monkeypatch, error):
+    async def edit_text(self, text, **kwargs):
+        raise TelegramBadRequest(method=None, message=error)
+
+    monkeypatch.setattr(FakeReply, "edit_text", edit_text)
+    monkeypatch.setattr(file_utils, "EDIT_INTERVAL", 0)
+
+
+def test_unmodified_edits_are_ignored(monkeypatch):
+    failing_edits(monkeypatch, "Bad Request: message is not modified")
+    assert stream(FakeMessage(), "Один", "Один два") == "Один два"
+
+
+def test_other_failed_edits_are_raised(monkeypatch):
+    failing_edits(monkeypatch, "Bad Request: message to edit not found")
+    with pytest.raises(TelegramBadRequest):
+        stream(FakeMessage(), "Один", "Один два")
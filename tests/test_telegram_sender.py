@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import GetMe, SendMessage
+
+import telegram_sender
+from telegram_sender import ErrorDigest, SendScheduler, ThrottlingMiddleware, TokenBucket
+
+
+def test_a_bucket_allows_a_burst_then_its_rate():
+    bucket = TokenBucket(rate=2, burst=3)
+    now = bucket.updated
+    for _ in range(3):
+        assert bucket.delay(now) == 0
+        bucket.take()
+    assert bucket.delay(now) == pytest.approx(0.5)
+    assert bucket.delay(now + 0.5) == 0
+
+
+def test_a_paused_bucket_waits_out_the_pause():
+    bucket = TokenBucket(rate=1000, burst=10)
+    bucket.pause(5)
+    assert bucket.delay(time.monotonic()) == pytest.approx(5, abs=0.1)
+
+
+async def granted(scheduler, chat_id, timeout=0.2, priority=telegram_sender.REPLY):
+    try:
+        await asyncio.wait_for(scheduler.acquire(chat_id, priority), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+def test_a_chat_out_of_tokens_does_not_hold_up_other_chats():
+    async def main():
+        scheduler = SendScheduler()
+        try:
+            results = [await granted(scheduler, 1) for _ in range(int(telegram_sender.CHAT_BURST) + 1)]
+            results.append(await granted(scheduler, 2))
+            return results
+        finally:
+            await scheduler.stop()
+
+    assert asyncio.run(main()) == [True] * int(telegram_sender.CHAT_BURST) + [False, True]
+
+
+def test_replies_go_before_reports_when_the_global_budget_is_short():
+    async def main():
+        scheduler = SendScheduler()
+        scheduler.bucket = TokenBucket(rate=20, burst=1)
+        scheduler.bucket.tokens = 0
+        order = []
+
+        async def send(chat_id, priority):
+            await scheduler.acquire(chat_id, priority)
+            order.append(priority)
+
+        try:
+            await asyncio.gather(send(1, telegram_sender.REPORT), send(2, telegram_sender.PREVIEW),
+                                 send(3, telegram_sender.REPLY))
+        finally:
+            await scheduler.stop()
+        return order
+
+    assert asyncio.run(main()) == [telegram_sender.REPLY, telegram_sender.PREVIEW, telegram_sender.REPORT]
+
+
+def test_retry_after_pauses_the_chat():
+    async def main():
+        scheduler = SendScheduler()
+        try:
+            scheduler.pause(1, 5)
+            return await granted(scheduler, 1), await granted(scheduler, 2)
+        finally:
+            await scheduler.stop()
+
+    assert asyncio.run(main()) == (False, True)
+
+
+@pytest.fixture
+def fast_chats(monkeypatch):
+    # A retry_after empties the bucket, the next token should not take seconds.
+    monkeypatch.setattr(telegram_sender, "GROUP_RATE", 1000.0)
+
+
+def call_middleware(method, failures, priority=telegram_sender.REPLY):
+    calls = []
+
+    async def make_request(bot, request):
+        calls.append(request)
+        if len(calls) <= failures:
+            raise TelegramRetryAfter(method=request, message="Flood control exceeded", retry_after=0)
+        return "sent"
+
+    async def main():
+        scheduler = SendScheduler()
+        try:
+            with telegram_sender.priority(priority):
+                return await ThrottlingMiddleware(scheduler)(make_request, None, method)
+        finally:
+            await scheduler.stop()
+
+    return asyncio.run(main()), len(calls)
+
+
+def test_a_message_is_sent_again_after_retry_after(fast_chats):
+    assert call_middleware(SendMessage(chat_id=-1, text="Привет"), failures=2) == ("sent", 3)
+
+
+def test_retries_are_limited(fast_chats, monkeypatch):
+    monkeypatch.setattr(telegram_sender, "MAX_RETRIES", 1)
+    with pytest.raises(TelegramRetryAfter):
+        call_middleware(SendMessage(chat_id=-1, text="Привет"), failures=5)
+
+
+def test_previews_are_not_sent_again():
+    with pytest.raises(TelegramRetryAfter):
+        call_middleware(SendMessage(chat_id=-1, text="Привет"), failures=1, priority=telegram_sender.PREVIEW)
+
+
+def test_other_methods_are_not_throttled():
+    assert call_middleware(GetMe(), failures=0) == ("sent", 1)
+
+
+class FakeBot:
+    def __init__(self):
+        self.texts = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.texts.append(text)
+
+
+def test_repeated_errors_are_sent_as_one_digest(monkeypatch):
+    monkeypatch.setenv("ERRORS_CHAT_ID", "-100")
+    bot = FakeBot()
+
+    async def main():
+        digest = ErrorDigest()
+        digest.bot = bot
+        await digest.report("Job 1 failed: timeout")
+        await digest.report("Job 2 failed: timeout", trace_id="abc")
+        await digest.report("Job 3 failed: timeout", trace_id="def")
+        await digest.report("Disk is full")
+        await digest.flush()
+        await digest.report("Job 4 failed: timeout")
+
+    asyncio.run(main())
+    assert bot.texts[:2] == ["Job 1 failed: timeout", "Disk is full"]
+    assert "2× Job 3 failed: timeout (last traces abc, def)" in bot.texts[2]
+    # The digest starts a new period, in which the first error of a kind goes out at once again.
+    assert bot.texts[3] == "Job 4 failed: timeout"
@@ -0,0 +1,54 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.types import Voice
+
+import audio_splitter
+import transcoder
+from conftest import needs_ffmpeg
+from custom_exceptions import ASRException
+
+
+@needs_ffmpeg
+@pytest.mark.parametrize("media", [None, SimpleNamespace(mime_type="video/mp4")])
+def test_transcode_writes_the_speech_target(wav_path, tmp_path, media):
+    target = str(tmp_path / ("speech" + transcoder.TARGET_SUFFIX))
+
+    async def main():
+        assert await transcoder.transcode(wav_path, target, media) == transcoder.TARGET_ENCODING
+        return await audio_splitter.probe_duration(target)
+
+    assert asyncio.run(main()) == pytest.approx(8, abs=0.1)
+    with open(target, 'rb') as file:
+        assert file.read(4) == b"OggS"
+
+
+@needs_ffmpeg
+def test_transcode_cuts_a_segment(wav_path, tmp_path):
+    target = str(tmp_path / ("segment" + transcoder.TARGET_SUFFIX))
+
+    async def main():
+        await transcoder.transcode(wav_path, target, start=2, duration=3)
+        return await audio_splitter.probe_duration(target)
+
+    assert asyncio.run(main()) == pytest.approx(3, abs=0.1)
+
+
+@needs_ffmpeg
+def test_transcode_fails_on_media_that_is_not_audio(tmp_path):
+    source = tmp_path / "broken.mp3"
+    source.write_bytes(b"not audio at all" * 100)
+    with pytest.raises(ASRException):
+        asyncio.run(transcoder.transcode(str(source), str(tmp_path / "broken.ogg")))
+
+
+@pytest.mark.parametrize("media, encoding", [
+    (Voice(file_id="v", file_unique_id="v", duration=10), "OGG_OPUS"),
+    (SimpleNamespace(mime_type="audio/mpeg", file_size=1_000_000, duration=100), "MP3"),
+    (SimpleNamespace(mime_type="audio/mpeg", file_size=10_000_000, duration=100), None),
+    (SimpleNamespace(mime_type="audio/x-wav", file_size=1_000_000, duration=100), None),
+    (SimpleNamespace(mime_type=None), None),
+])
+def test_native_encoding(media, encoding):
+    assert transcoder.native_encoding(media) == encoding
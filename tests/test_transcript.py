@@ -0,0 +1,62 @@
+import pytest
+
+import transcript
+from transcript import TELEGRAM_MESSAGE_LIMIT, split_message, telegram_length
+
+
+def test_telegram_length_counts_utf16_code_units():
+    assert telegram_length("abc") == 3
+    assert telegram_length("привет") == 6
+    # Characters outside the Basic Multilingual Plane take two code units.
+    assert telegram_length("😀") == 2
+    assert telegram_length("a😀b") == 4
+
+
+def test_short_text_is_one_message():
+    assert split_message("  Привет, мир.  ") == ["Привет, мир."]
+    assert split_message("") == []
+
+
+@pytest.mark.parametrize("word", ["слово", "😀😀😀", "a😀", "𝔘𝔫𝔦𝔠𝔬𝔡𝔢"])
+def test_chunks_fit_the_limit(word):
+    text = " ".join([word] * 3000)
+    chunks = split_message(text)
+    assert len(chunks) > 1
+    assert all(telegram_length(chunk) <= TELEGRAM_MESSAGE_LIMIT for chunk in chunks)
+    assert " ".join(chunks).split() == text.split()
+
+
+def test_emoji_are_never_cut_in_half():
+    text = "😀" * (TELEGRAM_MESSAGE_LIMIT + 10)
+    chunks = split_message(text)
+    assert all(telegram_length(chunk) <= TELEGRAM_MESSAGE_LIMIT for chunk in chunks)
+    assert "".join(chunks) == text
+    assert telegram_length(chunks[0]) == TELEGRAM_MESSAGE_LIMIT
+
+
+def test_odd_limit_with_astral_characters():
+    text = "😀" * 10
+    chunks = split_message(text, limit=5)
+    assert chunks == ["😀😀"] * 5
+
+
+def test_cuts_at_the_end_of_a_sentence():
+    sentence = "Это предложение заканчивается точкой. "
+    text = sentence * (TELEGRAM_MESSAGE_LIMIT // len(sentence) + 5)
+    chunks = split_message(text)
+    assert all(chunk.endswith(".") for chunk in chunks)
+
+
+def test_prefers_paragraph_breaks():
+    paragraph = "слово " * 400
+    text = "\n\n".join([paragraph.strip()] * 3)
+    chunks = split_message(text)
+    assert chunks == [paragraph.strip()] * 3
+
+
+def test_long_transcript_with_timestamps():
+    segments = [transcript.Segment(start, start + 10, f"Фраза номер {start} 😀.") for start in range(0, 7200, 10)]
+    text = transcript.to_text(segments, timestamps=True)
+    chunks = split_message(text)
+    assert all(telegram_length(chunk) <= TELEGRAM_MESSAGE_LIMIT for chunk in chunks)
+    assert "".join(chunks).replace("\n", "").replace(" ", "") == text.replace("\n", "").replace(" ", "")
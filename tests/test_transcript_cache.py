@@ -0,0 +1,61 @@
+import asyncio
+import shutil
+from types import SimpleNamespace
+
+import file_utils
+import transcoder
+import transcript
+import transcript_cache
+from conftest import needs_ffmpeg
+
+SEGMENTS = [transcript.Segment(0.0, 2.5, "Договорились созвониться в понедельник.")]
+
+
+def test_lookup_by_file_id_or_content_hash(cache_database):
+    transcript_cache.put_transcript("file-1", "hash-1", SEGMENTS)
+    assert transcript_cache.get_transcript(file_unique_id="file-1") == SEGMENTS
+    assert transcript_cache.get_transcript(file_unique_id="file-2", content_hash="hash-1") == SEGMENTS
+    assert transcript_cache.get_transcript(file_unique_id="file-2", content_hash="hash-2") is None
+    assert transcript_cache.get_transcript() is None
+
+
+def test_expired_transcripts_are_not_returned(cache_database, monkeypatch):
+    transcript_cache.put_transcript("file-1", "hash-1", SEGMENTS)
+    monkeypatch.setattr(transcript_cache, "CACHE_TTL", 0)
+    assert transcript_cache.get_transcript(file_unique_id="file-1") is None
+
+
+@needs_ffmpeg
+def test_transcoding_is_reproducible(wav_path, tmp_path):
+    async def convert(name):
+        target = str(tmp_path / name)
+        await transcoder.transcode(wav_path, target)
+        return await transcript_cache.async_file_sha256(target)
+
+    assert asyncio.run(convert("first.ogg")) == asyncio.run(convert("second.ogg"))
+
+
+@needs_ffmpeg
+def test_the_same_audio_sent_again_skips_recognition(database, cache_database, wav_path, monkeypatch):
+    recognised = []
+
+    async def recognize_audio(path, encoding, duration=None, on_ready=None):
+        recognised.append(path)
+        return SEGMENTS
+
+    class Bot:
+        async def download(self, media, destination):
+            shutil.copyfile(wav_path, destination)
+
+    monkeypatch.setattr(file_utils, "recognize_audio", recognize_audio)
+
+    async def main():
+        # Forwarded or re-uploaded files get a new file_unique_id, and the WAV has to be transcoded.
+        first = SimpleNamespace(file_unique_id="file-1", mime_type="audio/wav", duration=8)
+        second = SimpleNamespace(file_unique_id="file-2", mime_type="audio/wav", duration=8)
+        return await file_utils.download_media_file(Bot(), first), await file_utils.download_media_file(Bot(), second)
+
+    first, second = asyncio.run(main())
+    assert first == (SEGMENTS, False)
+    assert second == (SEGMENTS, True)
+    assert len(recognised) == 1
@@ -0,0 +1,86 @@
+import asyncio
+from collections import OrderedDict
+
+import pytest
+
+import transcript_index
+
+FILLER = "Потом мы долго обсуждали погоду и дорогу домой. "
+
+
+@pytest.fixture
+def index_store(cache_database, monkeypatch):
+    monkeypatch.setattr(transcript_index, "_memory", OrderedDict())
+    return cache_database
+
+
+def long_transcript():
+    parts = [FILLER * 100, "Бюджет проекта составит два миллиона рублей. ", FILLER * 100,
+             "Запуск назначили на пятнадцатое марта. ", FILLER * 100]
+    return "".join(parts)
+
+
+def test_split_chunks_keeps_whole_sentences():
+    text = "Первое предложение. Второе предложение! Третье? Четвёртое."
+    chunks = transcript_index.split_chunks(text, chunk_chars=40)
+    assert chunks == ["Первое предложение. Второе предложение!", "Третье? Четвёртое."]
+    assert transcript_index.split_chunks("", chunk_chars=40) == []
+
+
+def test_search_ranks_the_chunks_about_the_question():
+    index = transcript_index.build_index(long_transcript())
+    found = transcript_index.search(index, "Какой бюджет у проекта?", max_chars=transcript_index.CHUNK_CHARS)
+    assert len(found) == 1
+    assert "два миллиона" in found[0]
+
+
+def test_search_returns_chunks_in_transcript_order():
+    index = transcript_index.build_index(long_transcript())
+    found = transcript_index.search(index, "бюджет и запуск", max_chars=2 * transcript_index.CHUNK_CHARS)
+    assert ["два миллиона" in chunk for chunk in found] == [True, False]
+    assert "пятнадцатое марта" in found[1]
+
+
+@pytest.mark.parametrize("question, summary", [
+    ("О чём был разговор?", True),
+    ("Сделай краткий пересказ", True),
+    ("tl;dr", True),
+    ("Какой бюджет у проекта?", False),
+])
+def test_is_summary_question(question, summary):
+    assert transcript_index.is_summary_question(question) == summary
+
+
+def test_a_short_transcript_is_sent_whole():
+    prompt = asyncio.run(transcript_index.build_prompt("Короткий разговор.", "О чём он?", None))
+    assert prompt == "Context: \nКороткий разговор.\nPrompt:\nО чём он?"
+
+
+def test_a_question_about_a_long_transcript_gets_the_relevant_part(index_store):
+    text = long_transcript()
+    prompt = asyncio.run(transcript_index.build_prompt(text, "Когда запуск?", None))
+    assert "пятнадцатое марта" in prompt
+    assert len(prompt) <= transcript_index.RETRIEVAL_CHARS + 200 < len(text)
+
+
+def test_summaries_are_made_once_per_transcript(index_store, monkeypatch):
+    monkeypatch.setattr(transcript_index, "MAP_CHARS", 5000)
+    text = long_transcript()
+    prompts = []
+
+    async def complete(prompt):
+        prompts.append(prompt)
+        return f"Итог {len(prompts)}"
+
+    async def main():
+        return await transcript_index.build_prompt(text, "О чём был разговор?", complete)
+
+    first = asyncio.run(main())
+    calls = len(prompts)
+    assert calls > 1
+    assert "Часть 2: Итог" in first
+
+    # Loaded from transcripts.db rather than memory the second time.
+    transcript_index._memory.clear()
+    assert asyncio.run(main()) == first
+    assert len(prompts) == calls
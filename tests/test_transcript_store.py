@@ -0,0 +1,61 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import pytest
+
+import transcript_store
+
+CHAT_ID = 100
+
+
+@pytest.fixture
+def store(cache_database, monkeypatch):
+    monkeypatch.setattr(transcript_store, "_memory", OrderedDict())
+    monkeypatch.setattr(transcript_store, "_memory_bytes", 0)
+    return transcript_store
+
+
+def get(store, message_id):
+    return asyncio.run(store.async_get_document(CHAT_ID, message_id))
+
+
+def put(store, message_ids, text):
+    asyncio.run(store.async_put_documents(CHAT_ID, message_ids, text))
+
+
+def test_a_transcript_is_found_under_each_of_its_documents(store):
+    put(store, [1, 2], "Текст разговора")
+    assert [get(store, 1), get(store, 2), get(store, 3)] == ["Текст разговора", "Текст разговора", None]
+
+
+def test_a_transcript_stored_by_another_process_is_read_from_the_database(store):
+    put(store, [1], "Текст разговора")
+    store._memory.clear()
+    assert get(store, 1) == "Текст разговора"
+    assert (CHAT_ID, 1) in store._memory
+
+
+def test_memory_keeps_the_most_recently_used_texts(store, monkeypatch):
+    monkeypatch.setattr(store, "MEMORY_MAX_BYTES", 10)
+    put(store, [1], "aaaa")
+    put(store, [2], "bbbb")
+    get(store, 1)
+    put(store, [3], "cccc")
+    assert list(store._memory) == [(CHAT_ID, 1), (CHAT_ID, 3)]
+    assert store._memory_bytes == 8
+    # Evicted from memory only.
+    assert get(store, 2) == "bbbb"
+
+
+def test_the_oldest_transcripts_are_evicted_from_the_database(store, monkeypatch):
+    monkeypatch.setattr(store, "STORE_MAX_BYTES", 10)
+    for message_id in (1, 2, 3):
+        store.save_documents(CHAT_ID, [message_id], "xxxx")
+    assert [store.load_document(CHAT_ID, message_id) for message_id in (1, 2, 3)] == [None, "xxxx", "xxxx"]
+
+
+def test_transcripts_expire(store, monkeypatch):
+    store.save_documents(CHAT_ID, [1], "Текст разговора")
+    monkeypatch.setattr(time, "time", lambda now=time.time(): now + store.STORE_TTL + 1)
+    assert store.load_document(CHAT_ID, 1) is None
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+from contextlib import aclosing
+
+import aiofiles
+from aiogram.types import Voice
+
+from custom_exceptions import ASRException
+from job_queue import stage
+from media_pipeline import CHUNK_SIZE, read_chunks
+
+logger = logging.getLogger(__name__)
+
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+
+# Speech-optimised target: mono 16 kHz Opus in an OGG container, which Yandex STT accepts as OGG_OPUS.
+TARGET_SUFFIX = ".ogg"
+TARGET_ENCODING = "OGG_OPUS"
+TARGET_BITRATE = os.getenv("TRANSCODE_BITRATE", "24k")
+# Identifies the target settings, so objects made with different settings never share a key.
+TARGET_PROFILE = f"opus-16k-mono-{TARGET_BITRATE}"
+# Bitexact output leaves out the random OGG stream serial and the encoder version, so the same source
+# always converts to the same bytes and the content-hash cache and storage keys find it again.
+TARGET_ARGS = [
+    "-vn", "-ac", "1", "-ar", "16000",
+    "-c:a", "libopus", "-b:a", TARGET_BITRATE, "-application", "voip",
+    "-fflags", "+bitexact", "-flags:a", "+bitexact",
+    "-f", "ogg",
+]
+
+# Native sources above this bitrate are transcoded anyway: speech needs far less, and the smaller upload pays for it.
+NATIVE_MAX_BITRATE = int(os.getenv("NATIVE_MAX_BITRATE", "160000"))
+
+# Sources that the ASR accepts as is, by MIME type.
+NATIVE_ENCODINGS = {
+    "audio/opus": "OGG_OPUS",
+    "audio/mpeg": "MP3",
+    "audio/mp3": "MP3",
+}
+
+ENCODING_SUFFIXES = {
+    "OGG_OPUS": ".ogg",
+    "MP3": ".mp3",
+}
+
+# Containers that keep their index at the end of the file and cannot be demuxed from a pipe.
+SEEKABLE_MIME_TYPES = {"video/mp4", "video/quicktime", "audio/mp4", "audio/x-m4a", "audio/m4a"}
+
+
+def native_encoding(media):
+    """
+    Returns the ASR encoding of the media if it can be recognised without transcoding, otherwise None.
+
+    :param media: The Telegram media object (Voice, Audio, Video or Document).
+    """
+    if isinstance(media, Voice):
+        # Telegram voice notes are always OGG/Opus.
+        return "OGG_OPUS"
+    encoding = NATIVE_ENCODINGS.get(getattr(media, "mime_type", None) or "")
+    size = getattr(media, "file_size", None)
+    duration = getattr(media, "duration", None)
+    if encoding and size and duration and size * 8 / duration > NATIVE_MAX_BITRATE:
+        return None
+    return encoding
+
+
+def needs_seekable_input(media):
+    return (getattr(media, "mime_type", None) or "") in SEEKABLE_MIME_TYPES
+
+
+async def transcode(source_path, target_path, media=None, start=None, duration=None):
+    """
+    Converts the source file to the speech target format and writes it to `target_path`.
+
+    :param source_path: The path of the downloaded media.
+    :param target_path: Where to write the converted audio.
+    :param media: The Telegram media object, used to decide whether the input can be piped.
+    :param start: Where to start reading the source, in seconds. Cutting reads the source by path.
+    :param duration: How many seconds of the source to convert.
+    :return: The ASR encoding of the target file.
+    """
+    if start is None and not needs_seekable_input(media):
+        output = transcode_stream(read_chunks(source_path))
+    else:
+        output = transcode_stream(source_path=source_path, start=start, duration=duration)
+    # Closing the output kills ffmpeg at once when the conversion is cancelled.
+    async with aclosing(output), aiofiles.open(target_path, 'wb') as target:
+        async for chunk in output:
+            await target.write(chunk)
+    return TARGET_ENCODING
+
+
+async def transcode_stream(chunks=None, source_path=None, start=None, duration=None):
+    """
+    Converts media to the speech target format with an ffmpeg subprocess and yields the output chunk by chunk.
+
+    The input is either an async iterator of chunks fed to ffmpeg's stdin or a path ffmpeg reads itself.
+    Pipe writes wait for ffmpeg to drain, so only a few chunks are ever buffered on either side.
+    The number of concurrent transcodes is limited by the "transcode" stage.
+    """
+    cut_args = []
+    if start is not None:
+        cut_args += ["-ss", f"{start:.3f}"]
+    if duration is not None:
+        cut_args += ["-t", f"{duration:.3f}"]
+    args = [FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", *cut_args,
+            "-i", "pipe:0" if chunks is not None else source_path, *TARGET_ARGS, "pipe:1"]
+
+    async with stage("transcode"):
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.PIPE if chunks is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stderr = asyncio.ensure_future(process.stderr.read())
+        feed = asyncio.ensure_future(_feed_stdin(process, chunks)) if chunks is not None else None
+        try:
+            while chunk := await process.stdout.read(CHUNK_SIZE):
+                yield chunk
+            if feed is not None:
+                await feed
+            await process.wait()
+            errors = await stderr
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            if feed is not None and not feed.done():
+                feed.cancel()
+                await asyncio.gather(feed, return_exceptions=True)
+            # Closed early, e.g. by a consumer that failed: the reader must not outlive the generator.
+            if not stderr.done():
+                stderr.cancel()
+            await asyncio.gather(stderr, return_exceptions=True)
+
+    if process.returncode != 0:
+        logger.error(f"ffmpeg failed with code {process.returncode}: {errors.decode(errors='replace')}")
+        raise ASRException(f"Failed to convert audio: ffmpeg exited with code {process.returncode}")
+
+
+async def _feed_stdin(process, chunks):
+    try:
+        async for chunk in chunks:
+            process.stdin.write(chunk)
+            await process.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg stopped reading, its exit code tells what happened.
+        pass
+    finally:
+        process.stdin.close()
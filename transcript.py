@@ -0,0 +1,173 @@
+import json
+import os
+import re
+from collections import namedtuple
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+TELEGRAM_CAPTION_LIMIT = 1024
+
+# A paragraph ends when the channel changes or when it has run this many seconds.
+PARAGRAPH_SECONDS = float(os.getenv("PARAGRAPH_SECONDS", "60"))
+# Transcripts of shorter recordings are shown without timestamps.
+TIMESTAMPS_MIN_SECONDS = float(os.getenv("TIMESTAMPS_MIN_SECONDS", "90"))
+
+# Times are seconds from the start of the recording, None when the backend does not report them.
+# channel is the channel tag of a multichannel recording, confidence the backend's score from 0 to 1.
+Segment = namedtuple("Segment", ["start", "end", "text", "channel", "confidence"], defaults=(None, None))
+
+# Places to cut a long message at, best first.
+_break_res = (
+    re.compile(r"\n\s*\n"),
+    re.compile(r"\n"),
+    re.compile(r"[.!?…]+[»\"')\]]*\s+"),
+    re.compile(r"[,;:]\s+"),
+    re.compile(r"\s+"),
+)
+
+
+def from_text(text):
+    """
+    Wraps a plain-text transcript, e.g. one cached before segments were kept, in a single untimed segment.
+    """
+    return [Segment(None, None, text)]
+
+
+def dumps(segments):
+    """
+    Serialises segments compactly: one [start, end, text, channel, confidence] array per segment.
+    """
+    rows = [[_round(segment.start, 2), _round(segment.end, 2), segment.text, segment.channel,
+             _round(segment.confidence, 3)] for segment in segments]
+    return json.dumps(rows, ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(data):
+    return [Segment(*row) for row in json.loads(data)]
+
+
+def _round(value, digits):
+    return None if value is None else round(value, digits)
+
+
+def shift(segments, seconds):
+    """
+    Moves the segments of a part of a recording to the time the part starts at.
+    """
+    return [segment._replace(start=None if segment.start is None else segment.start + seconds,
+                             end=None if segment.end is None else segment.end + seconds)
+            for segment in segments]
+
+
+def duration(segments):
+    return max((segment.end for segment in segments if segment.end is not None), default=0.0)
+
+
+def format_timestamp(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def paragraphs(segments):
+    """
+    Groups consecutive segments into paragraphs, starting a new one when the channel changes
+    or the current one has run PARAGRAPH_SECONDS.
+    """
+    current = []
+    for segment in segments:
+        if not segment.text.strip():
+            continue
+        if current and (segment.channel != current[0].channel or (
+                segment.start is not None and current[0].start is not None
+                and segment.start - current[0].start >= PARAGRAPH_SECONDS)):
+            yield current
+            current = []
+        current.append(segment)
+    if current:
+        yield current
+
+
+def to_text(segments, timestamps=None):
+    """
+    Renders the transcript as paragraphs. Each paragraph starts with its time when `timestamps` is set,
+    which by default it is for recordings of TIMESTAMPS_MIN_SECONDS and longer, and with its channel
+    when the recording has more than one.
+    """
+    if timestamps is None:
+        timestamps = duration(segments) >= TIMESTAMPS_MIN_SECONDS
+    channels = len({segment.channel for segment in segments if segment.channel is not None}) > 1
+    lines = []
+    for paragraph in paragraphs(segments):
+        first = paragraph[0]
+        header = []
+        if timestamps and first.start is not None:
+            header.append(format_timestamp(first.start))
+        if channels and first.channel is not None:
+            header.append(f"канал {first.channel}")
+        text = " ".join(segment.text.strip() for segment in paragraph)
+        lines.append(f"[{', '.join(header)}] {text}" if header else text)
+    return "\n\n".join(lines)
+
+
+def _srt_time(seconds):
+    milliseconds = round(seconds * 1000)
+    return (f"{milliseconds // 3600000:02d}:{milliseconds % 3600000 // 60000:02d}:"
+            f"{milliseconds % 60000 // 1000:02d},{milliseconds % 1000:03d}")
+
+
+def to_srt(segments):
+    """
+    Renders the timed segments as SubRip subtitles, one cue per segment.
+
+    :return: The subtitles, or an empty string when the backend reported no times.
+    """
+    cues = []
+    for segment in segments:
+        if segment.start is None or not segment.text.strip():
+            continue
+        end = segment.end if segment.end is not None and segment.end > segment.start else segment.start + 1
+        cues.append(f"{len(cues) + 1}\n{_srt_time(segment.start)} --> {_srt_time(end)}\n{segment.text.strip()}\n")
+    return "\n".join(cues)
+
+
+def telegram_length(text):
+    """
+    Returns the length of the text as Telegram counts it against its limits, in UTF-16 code units.
+    """
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _fitting_prefix(text, limit):
+    """
+    Returns how many characters from the start of the text fit in `limit` UTF-16 code units.
+    """
+    if telegram_length(text[:limit]) <= limit:
+        return min(len(text), limit)
+    length = 0
+    for index, char in enumerate(text):
+        length += 2 if ord(char) > 0xFFFF else 1
+        if length > limit:
+            return index
+    return len(text)
+
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Splits the text into messages Telegram accepts. Cuts at the last paragraph break that fits, otherwise
+    at the end of a sentence, a clause or a word, and only cuts inside a word that is longer than a message.
+    """
+    chunks = []
+    text = text.strip()
+    while telegram_length(text) > limit:
+        window = text[:_fitting_prefix(text, limit)]
+        cut = len(window)
+        for break_re in _break_res:
+            # Cuts in the first half of the window would leave a lot of short messages.
+            ends = [match.end() for match in break_re.finditer(window) if match.end() >= len(window) // 2]
+            if ends:
+                cut = ends[-1]
+                break
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        chunks.append(text)
+    return chunks
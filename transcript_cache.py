@@ -0,0 +1,94 @@
+import asyncio
+import hashlib
+import os
+import time
+
+import cache_db
+import transcript
+
+CACHE_TTL = int(os.getenv("TRANSCRIPT_CACHE_TTL", str(30 * 24 * 3600)))
+CACHE_MAX_BYTES = int(os.getenv("TRANSCRIPT_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+
+def get_transcript(file_unique_id=None, content_hash=None):
+    """
+    Returns the cached transcript segments for the Telegram file id or the audio hash, or None.
+    Transcripts cached before segments were kept come back as one untimed segment.
+    """
+    if file_unique_id is None and content_hash is None:
+        return None
+
+    now = time.time()
+    with cache_db.cache_lock, cache_db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, text, segments FROM transcripts WHERE (file_unique_id = ? OR content_hash = ?) AND created_at > ? "
+            "ORDER BY file_unique_id = ? DESC LIMIT 1",
+            (file_unique_id, content_hash, now - CACHE_TTL, file_unique_id))
+        row = cursor.fetchone()
+        if row:
+            cursor.execute("UPDATE transcripts SET accessed_at = ? WHERE id = ?", (now, row[0]))
+            conn.commit()
+
+    if not row:
+        return None
+    return transcript.loads(row[2]) if row[2] else transcript.from_text(row[1])
+
+
+def put_transcript(file_unique_id, content_hash, segments):
+    """
+    Stores the transcript segments, along with their text, under both keys and evicts expired
+    and least recently used entries.
+    """
+    now = time.time()
+    text = transcript.to_text(segments)
+    serialised = transcript.dumps(segments)
+    size = len(text.encode('utf-8')) + len(serialised.encode('utf-8'))
+    with cache_db.cache_lock, cache_db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO transcripts (file_unique_id, content_hash, text, segments, size, created_at, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (file_unique_id) DO UPDATE SET content_hash = excluded.content_hash, text = excluded.text, "
+            "segments = excluded.segments, size = excluded.size, created_at = excluded.created_at, "
+            "accessed_at = excluded.accessed_at",
+            (file_unique_id, content_hash, text, serialised, size, now, now))
+        _evict(cursor, now)
+        conn.commit()
+
+
+def _evict(cursor, now):
+    cursor.execute("DELETE FROM transcripts WHERE created_at <= ?", (now - CACHE_TTL,))
+    cursor.execute("SELECT COALESCE(SUM(size), 0) FROM transcripts")
+    total = cursor.fetchone()[0]
+    if total <= CACHE_MAX_BYTES:
+        return
+
+    cursor.execute("SELECT id, size FROM transcripts ORDER BY accessed_at")
+    stale_ids = []
+    for row_id, size in cursor.fetchall():
+        if total <= CACHE_MAX_BYTES:
+            break
+        stale_ids.append((row_id,))
+        total -= size
+    cursor.executemany("DELETE FROM transcripts WHERE id = ?", stale_ids)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def async_get_transcript(file_unique_id=None, content_hash=None):
+    return await cache_db.run(get_transcript, file_unique_id, content_hash)
+
+
+async def async_put_transcript(file_unique_id, content_hash, segments):
+    await cache_db.run(put_transcript, file_unique_id, content_hash, segments)
+
+
+async def async_file_sha256(path):
+    return await asyncio.to_thread(file_sha256, path)
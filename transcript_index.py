@@ -0,0 +1,219 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import time
+from collections import Counter, OrderedDict
+
+import cache_db
+
+# Transcripts up to this size are still sent to the model whole.
+FULL_CONTEXT_CHARS = int(os.getenv("FULL_CONTEXT_CHARS", "12000"))
+CHUNK_CHARS = int(os.getenv("INDEX_CHUNK_CHARS", "1500"))
+# How much retrieved text goes into a question prompt, and into one map-step prompt.
+RETRIEVAL_CHARS = int(os.getenv("RETRIEVAL_CHARS", "8000"))
+MAP_CHARS = int(os.getenv("MAP_CHARS", "10000"))
+MAP_CONCURRENCY = int(os.getenv("MAP_CONCURRENCY", "4"))
+MEMORY_INDEXES = 32
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Cheap stemming for Russian and English: inflected forms usually share the first letters.
+STEM_LENGTH = 6
+
+SUMMARY_PATTERNS = re.compile(
+    r"о\s+ч[её]м|суть|кратк|резюм|итог|пересказ|summar|what\s+was\s+(it|this)\s+about|tl;?dr", re.IGNORECASE)
+STOP_WORDS = {
+    "и", "в", "во", "на", "не", "что", "как", "а", "но", "по", "к", "с", "со", "у", "о", "об", "за", "из", "от",
+    "до", "же", "ли", "бы", "то", "это", "так", "мы", "вы", "он", "она", "они", "я", "ты", "там", "тут", "для",
+    "the", "a", "an", "and", "or", "of", "to", "in", "on", "is", "was", "what", "it", "this", "that", "for",
+}
+
+_sentence_re = re.compile(r"(?<=[.!?…])\s+|\n+")
+_word_re = re.compile(r"\w+", re.UNICODE)
+
+_memory = OrderedDict()
+
+
+def transcript_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def tokenize(text):
+    return [word[:STEM_LENGTH] for word in _word_re.findall(text.lower()) if word not in STOP_WORDS]
+
+
+def split_chunks(text, chunk_chars=CHUNK_CHARS):
+    """
+    Splits the transcript into chunks of whole sentences of about `chunk_chars` characters.
+    """
+    chunks = []
+    current = ""
+    for sentence in _sentence_re.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if current and len(current) + len(sentence) + 1 > chunk_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def build_index(text):
+    chunks = split_chunks(text)
+    term_counts = [Counter(tokenize(chunk)) for chunk in chunks]
+    document_frequency = Counter()
+    for counts in term_counts:
+        document_frequency.update(counts.keys())
+    lengths = [sum(counts.values()) for counts in term_counts]
+    return {
+        "chunks": chunks,
+        "tf": [dict(counts) for counts in term_counts],
+        "df": dict(document_frequency),
+        "lengths": lengths,
+        "avgdl": sum(lengths) / len(lengths) if lengths else 0.0,
+        "summaries": None,
+    }
+
+
+def load_index(text):
+    """
+    Returns the index of the transcript, building and storing it on first use.
+    """
+    key = transcript_hash(text)
+    if key in _memory:
+        _memory.move_to_end(key)
+        return key, _memory[key]
+
+    with cache_db.cache_lock, cache_db.get_connection() as conn:
+        row = conn.execute("SELECT data FROM transcript_indexes WHERE transcript_hash = ?", (key,)).fetchone()
+    if row:
+        index = json.loads(row[0])
+    else:
+        # Built outside the lock, the other users of transcripts.db need not wait for it.
+        index = build_index(text)
+        with cache_db.cache_lock, cache_db.get_connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO transcript_indexes (transcript_hash, data, created_at) "
+                         "VALUES (?, ?, ?)", (key, json.dumps(index, ensure_ascii=False), time.time()))
+
+    _remember(key, index)
+    return key, index
+
+
+def save_summaries(key, index, summaries):
+    index["summaries"] = summaries
+    with cache_db.cache_lock, cache_db.get_connection() as conn:
+        conn.execute("UPDATE transcript_indexes SET data = ? WHERE transcript_hash = ?",
+                     (json.dumps(index, ensure_ascii=False), key))
+        conn.commit()
+    _remember(key, index)
+
+
+def _remember(key, index):
+    _memory[key] = index
+    _memory.move_to_end(key)
+    while len(_memory) > MEMORY_INDEXES:
+        _memory.popitem(last=False)
+
+
+def search(index, question, max_chars=RETRIEVAL_CHARS):
+    """
+    Ranks the chunks against the question with BM25 and returns the best ones that fit into `max_chars`,
+    in the order they appear in the transcript.
+    """
+    terms = tokenize(question)
+    total = len(index["chunks"])
+    scores = []
+    for position, (counts, length) in enumerate(zip(index["tf"], index["lengths"])):
+        score = 0.0
+        for term in terms:
+            frequency = counts.get(term)
+            if not frequency:
+                continue
+            df = index["df"][term]
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / (index["avgdl"] or 1))
+            score += idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        scores.append((score, position))
+
+    selected = []
+    used = 0
+    for score, position in sorted(scores, key=lambda item: (-item[0], item[1])):
+        size = len(index["chunks"][position])
+        if used + size > max_chars:
+            continue
+        selected.append(position)
+        used += size
+    return [index["chunks"][position] for position in sorted(selected)]
+
+
+def is_summary_question(question):
+    return bool(SUMMARY_PATTERNS.search(question or ""))
+
+
+def _group_chunks(chunks, max_chars):
+    groups = [[]]
+    size = 0
+    for chunk in chunks:
+        if groups[-1] and size + len(chunk) > max_chars:
+            groups.append([])
+            size = 0
+        groups[-1].append(chunk)
+        size += len(chunk)
+    return ["\n".join(group) for group in groups]
+
+
+async def summarize(key, index, complete):
+    """
+    Map step of the summary mode: summarises each part of the transcript concurrently. The result is
+    stored with the index so later summary questions about the same transcript skip it.
+    """
+    if index.get("summaries"):
+        return index["summaries"]
+
+    semaphore = asyncio.Semaphore(MAP_CONCURRENCY)
+
+    async def summarize_part(part):
+        async with semaphore:
+            return await complete(
+                f"Context: \n{part}\nPrompt:\nКратко перескажи этот фрагмент разговора, сохранив факты, "
+                f"имена, числа и договорённости.")
+
+    summaries = list(await asyncio.gather(*(summarize_part(part) for part in _group_chunks(index["chunks"], MAP_CHARS))))
+    await cache_db.run(save_summaries, key, index, summaries)
+    return summaries
+
+
+async def build_prompt(context, question, complete):
+    """
+    Builds the prompt for a question about a transcript.
+
+    Short transcripts are sent whole. For long ones, summary questions get a map-reduce prompt over
+    per-part summaries, and other questions get only the chunks that BM25 ranks as relevant.
+
+    :param context: The transcript text.
+    :param question: The user's question.
+    :param complete: A coroutine function prompt -> text used for the map step.
+    """
+    if len(context) <= FULL_CONTEXT_CHARS:
+        return f"Context: \n{context}\nPrompt:\n{question}"
+
+    key, index = await asyncio.to_thread(load_index, context)
+    if is_summary_question(question):
+        summaries = await summarize(key, index, complete)
+        parts = "\n\n".join(f"Часть {number}: {summary}" for number, summary in enumerate(summaries, 1))
+        return f"Context: \nКраткое содержание частей разговора по порядку:\n{parts}\nPrompt:\n{question}"
+
+    chunks = await asyncio.to_thread(search, index, question)
+    excerpt = "\n...\n".join(chunks)
+    return f"Context: \nФрагменты разговора, относящиеся к вопросу:\n{excerpt}\nPrompt:\n{question}"
+
+
+async def async_index_transcript(text):
+    if len(text) > FULL_CONTEXT_CHARS:
+        await asyncio.to_thread(load_index, text)
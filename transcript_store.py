@@ -0,0 +1,93 @@
+import os
+import time
+from collections import OrderedDict
+
+import cache_db
+import transcript_cache
+
+# Transcripts the bot sent as documents, by chat and message id, so questions asked in reply to them
+# need neither Telegram nor a temporary file. Recent ones are kept in memory, all of them in transcripts.db,
+# which worker processes share with the process that answers the questions.
+MEMORY_MAX_BYTES = int(os.getenv("TRANSCRIPT_STORE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+STORE_TTL = int(os.getenv("TRANSCRIPT_STORE_TTL", str(transcript_cache.CACHE_TTL)))
+STORE_MAX_BYTES = int(os.getenv("TRANSCRIPT_STORE_MAX_BYTES", str(100 * 1024 * 1024)))
+
+_memory = OrderedDict()
+_memory_bytes = 0
+
+
+def _remember(key, text):
+    """
+    Keeps the text in memory, dropping the least recently used texts once they take more than MEMORY_MAX_BYTES.
+    """
+    global _memory_bytes
+    size = len(text.encode('utf-8'))
+    if size > MEMORY_MAX_BYTES:
+        return
+    if key in _memory:
+        _memory_bytes -= len(_memory.pop(key).encode('utf-8'))
+    _memory[key] = text
+    _memory_bytes += size
+    while _memory_bytes > MEMORY_MAX_BYTES:
+        _, evicted = _memory.popitem(last=False)
+        _memory_bytes -= len(evicted.encode('utf-8'))
+
+
+def load_document(chat_id, message_id):
+    with cache_db.cache_lock, cache_db.get_connection() as conn:
+        row = conn.execute("SELECT text FROM sent_documents WHERE chat_id = ? AND message_id = ? AND created_at > ?",
+                           (chat_id, message_id, time.time() - STORE_TTL)).fetchone()
+    return row[0] if row else None
+
+
+def save_documents(chat_id, message_ids, text):
+    """
+    Stores the text under each of the messages and evicts expired and the oldest entries.
+    """
+    now = time.time()
+    size = len(text.encode('utf-8'))
+    with cache_db.cache_lock, cache_db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("INSERT OR REPLACE INTO sent_documents (chat_id, message_id, text, size, created_at) "
+                           "VALUES (?, ?, ?, ?, ?)",
+                           [(chat_id, message_id, text, size, now) for message_id in message_ids])
+        _evict(cursor, now)
+        conn.commit()
+
+
+def _evict(cursor, now):
+    cursor.execute("DELETE FROM sent_documents WHERE created_at <= ?", (now - STORE_TTL,))
+    cursor.execute("SELECT COALESCE(SUM(size), 0) FROM sent_documents")
+    total = cursor.fetchone()[0]
+    if total <= STORE_MAX_BYTES:
+        return
+
+    cursor.execute("SELECT chat_id, message_id, size FROM sent_documents ORDER BY created_at")
+    stale_keys = []
+    for chat_id, message_id, size in cursor.fetchall():
+        if total <= STORE_MAX_BYTES:
+            break
+        stale_keys.append((chat_id, message_id))
+        total -= size
+    cursor.executemany("DELETE FROM sent_documents WHERE chat_id = ? AND message_id = ?", stale_keys)
+
+
+async def async_get_document(chat_id, message_id):
+    """
+    Returns the text stored for the message, from memory when it is there, or None.
+    """
+    key = (chat_id, message_id)
+    text = _memory.get(key)
+    if text is not None:
+        _memory.move_to_end(key)
+        return text
+    text = await cache_db.run(load_document, chat_id, message_id)
+    if text is not None:
+        _remember(key, text)
+    return text
+
+
+async def async_put_documents(chat_id, message_ids, text):
+    for message_id in message_ids:
+        _remember((chat_id, message_id), text)
+    await cache_db.run(save_documents, chat_id, message_ids, text)
@@ -1,30 +1,47 @@
-import asyncio
+import json
 import os
 import logging
-import boto3
-import httpx
 from dotenv import load_dotenv
 
+import http_client
+import jobs
+import object_storage
+import transcript
+from custom_exceptions import ASRException
+from operation_poller import poller
+from single_flight import SingleFlight
+from transcript import Segment
+
 load_dotenv()
 
-session = boto3.session.Session()
-s3 = session.client(
-    service_name='s3',
-    endpoint_url=os.getenv('endpoint_url'),
-    aws_access_key_id=os.getenv('aws_access_key_id'),
-    aws_secret_access_key=os.getenv('aws_secret_access_key')
-)
-logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 
-# boto3.set_stream_logger('botocore', level='DEBUG')
-async def get_completion(prompt_text):
+# Formats of the synchronous recognition API, by ASR encoding.
+SYNC_FORMATS = {"OGG_OPUS": "oggopus"}
+
+COMPLETION_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+COMPLETION_OPTIONS = {
+    "temperature": 0.6,
+    "maxTokens": "2000"
+}
+
+completions = SingleFlight("yandex_completion")
+
+
+def model_options():
+    """
+    Returns everything besides the prompt that affects the completion, for cache keys.
+    """
+    return {"backend": "yandex", "modelUri": os.getenv('YANDEX_MODEL_LINK'), **COMPLETION_OPTIONS}
+
+
+def completion_request(prompt_text, stream=False):
     prompt = {
         "modelUri": os.getenv('YANDEX_MODEL_LINK'),
         "completionOptions": {
-            "stream": False,
-            "temperature": 0.6,
-            "maxTokens": "2000"
+            "stream": stream,
+            **COMPLETION_OPTIONS
         },
         "messages": [
             {
@@ -37,36 +54,55 @@ async def get_completion(prompt_text):
             },
         ]
     }
-    url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Api-Key {os.getenv('YANDEX_API_KEY')}"
     }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=prompt)
+    return headers, prompt
+
+
+async def get_completion(prompt_text):
+    """
+    Returns the completion for the prompt. Identical prompts asked at the same time share one request.
+    """
+    return await completions.run(prompt_text, _request_completion, prompt_text)
+
+
+async def _request_completion(prompt_text):
+    headers, prompt = completion_request(prompt_text)
+    response = await http_client.request("yandex_llm", "POST", COMPLETION_URL, headers=headers, json=prompt)
     result = response.json()['result']['alternatives'][0]['message']['text']
-    print(result)
+    logger.debug(f"Completion: {result}")
     return result
 
 
-def upload_file(file_path):
-    s3.upload_file(file_path, 'sonnyroot', file_path)
-    return file_path
+async def stream_completion(prompt_text):
+    """
+    Yields the completion text as it grows. Every item is the whole text generated so far.
+    Identical prompts asked at the same time share one generation.
+    """
+    async for text in completions.stream(prompt_text, _stream_completion, prompt_text):
+        yield text
+
+
+async def _stream_completion(prompt_text):
+    headers, prompt = completion_request(prompt_text, stream=True)
+    async with http_client.stream("yandex_llm", "POST", COMPLETION_URL, headers=headers, json=prompt) as response:
+        if response.is_error:
+            await response.aread()
+            response.raise_for_status()
+        # The streaming endpoint sends one JSON object per line, each with the full text so far.
+        async for line in response.aiter_lines():
+            if not line.strip():
+                continue
+            yield json.loads(line)['result']['alternatives'][0]['message']['text']
 
 
 async def delete_file(filename):
-    url = f"https://storage.yandexcloud.net/sonnyroot/{filename}"
-    api_key = os.getenv('YANDEX_API_KEY')
-    headers = {
-        "Authorization": f"Bearer  {api_key}",
-    }
-    async with httpx.AsyncClient() as client:
-        response = await client.delete(url, headers=headers)
-        print(response.status_code)
-    return response.status_code
+    await object_storage.delete(filename)
 
 
-async def stt(file_path):
+async def stt(file_path, encoding="MP3"):
     url = "https://transcribe.api.cloud.yandex.net/speech/stt/v2/longRunningRecognize"
     api_key = os.getenv('YANDEX_API_KEY_STT')
     headers = {
@@ -76,52 +112,93 @@ async def stt(file_path):
         "config": {
             "specification": {
                 "literature_text": True,
-                "audioEncoding": "MP3",
+                "audioEncoding": encoding,
             }
         },
         "audio": {
-            "uri": f"https://storage.yandexcloud.net/sonnyroot/{file_path}"
+            "uri": object_storage.public_url(file_path)
         }
     }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=body)
-    print(response.json())
+    response = await http_client.request("yandex_stt", "POST", url, headers=headers, json=body)
+    logger.info(f"Started recognition operation {response.json().get('id')} for {file_path}")
     return response
 
 
-async def check(response, interval):
-    operation_id = response.json()['id']
-    url = f"https://operation.api.cloud.yandex.net/operations/{operation_id}"
-    api_key = os.getenv('YANDEX_API_KEY_STT')
-    headers = {
-        "Authorization": f"Api-Key {api_key}",
-    }
-    max_attempts = 5
+async def check(response, audio_seconds=None):
+    return await wait_operation(response.json()['id'], audio_seconds)
+
+
+async def wait_operation(operation_id, audio_seconds=None):
+    """
+    Waits for a long-running recognition, also one started before a restart, and returns its segments.
+    """
+    result = await poller.wait(operation_id, audio_seconds)
+    if 'error' in result:
+        raise ASRException(f"Recognition failed: {result['error'].get('message')}", status_code=result['error'].get('code'))
 
-    attempts = 0
-    while attempts < max_attempts:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers)
-            print(response.json())
-        if response.json()['done']:
-            data = response.json()['response']['chunks']
-            final_text = ''
-            for item in data:
-                if item['alternatives']:
-                    text = item['alternatives'][0]['text']
-                    final_text += text + ' '
-            return final_text.strip()
+    return parse_chunks(result['response'].get('chunks', []))
 
-        attempts += 1
-        await asyncio.sleep(interval)
 
-    raise TimeoutError("Превышено максимальное количество попыток опроса API.")
+def parse_chunks(chunks):
+    """
+    Turns the utterances of a long-running recognition result into transcript segments, timed by their first
+    and last words when the result has word times.
+    """
+    segments = []
+    for chunk in chunks:
+        if not chunk['alternatives']:
+            continue
+        alternative = chunk['alternatives'][0]
+        words = alternative.get('words') or []
+        segments.append(Segment(
+            _duration_seconds(words[0]['startTime']) if words else None,
+            _duration_seconds(words[-1]['endTime']) if words else None,
+            alternative['text'],
+            chunk.get('channelTag'),
+            alternative.get('confidence'),
+        ))
+    return segments
 
 
-async def get_text_from_audio(file_path):
+def _duration_seconds(value):
+    # Durations come as strings like "1.250s".
+    return float(str(value).rstrip('s'))
+
+
+async def recognize_object(key, encoding="MP3", audio_seconds=None):
+    response = await stt(key, encoding)
+    operation_id = response.json()['id']
+    await jobs.record_operation(operation_id)
+    segments = await wait_operation(operation_id, audio_seconds)
+    logger.debug(f"Recognised {len(segments)} segments")
+    return segments
+
+
+async def get_text_from_audio(file_path, encoding="MP3", audio_seconds=None):
     ...
-    file_path = upload_file(file_path)
-    response = await stt(file_path)
-    text = await check(response, 5)
-    print(text)
-    return text
+    key = await object_storage.upload_file(file_path, os.path.splitext(file_path)[1])
+    try:
+        return transcript.to_text(await recognize_object(key, encoding, audio_seconds))
+    finally:
+        await object_storage.release(key)
+
+
+async def recognize_sync(content, encoding="OGG_OPUS", audio_seconds=None):
+    """
+    Recognises a short recording (up to 30 seconds and 1 MB) with the synchronous SpeechKit API,
+    which needs neither object storage nor polling. The API returns only the text, so the recording
+    is one segment.
+    """
+    if encoding not in SYNC_FORMATS:
+        raise ASRException(f"Synchronous recognition does not support {encoding}")
+    url = "https://stt.api.cloud.yandex.net/speech/v1/stt:recognize"
+    headers = {
+        "Authorization": f"Api-Key {os.getenv('YANDEX_API_KEY_STT')}",
+    }
+    params = {"lang": "ru-RU", "format": SYNC_FORMATS[encoding]}
+    response = await http_client.request("yandex_stt_sync", "POST", url, headers=headers, params=params,
+                                         content=content)
+    result = response.json()
+    if response.is_error or 'result' not in result:
+        raise ASRException(f"Recognition failed: {result.get('error_message')}", status_code=response.status_code)
+    return [Segment(0.0, audio_seconds, result['result'])]